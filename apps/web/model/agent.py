@@ -1,28 +1,65 @@
 import math
 import random
+import threading
 import numpy as np
 import torch
-from custom_types import ParamsAgent
-from typing import List
-from replay import ExperienceReplay, Transition
-from utils import get_two_channels
+from custom_types import Inference, ParamsAgent
+from inference import get_inference_backend
+from modules import CompiledForward, soft_update
+from typing import Callable, List
+from replay import Batch, BatchPrefetcher, ExperienceReplay, PrioritizedExperienceReplay, to_tensors
+from utils import StateEncoder
 from os.path import join
 from pathlib import Path
 import torch.nn as nn
 
 
 class DQNAgent:
-    def __init__(self, net: nn.Module, params: ParamsAgent, device: torch.device, load_model_path: str | None = None) -> None:
+    def __init__(self, net: nn.Module, params: ParamsAgent, device: torch.device, load_model_path: str | None = None,
+                 memory: ExperienceReplay | None = None) -> None:
         self.net = net
-        self.criterion = getattr(
-            torch.nn, params['criterion']['name'])(**params['criterion']['config'])
-        self.memory = ExperienceReplay(maxlen=params['memory__maxlen'],
-                                       batch_size=params['batch_size'])
+        prioritized = params.get('memory__prioritized')
+        if memory is not None:
+            # e.g. a memory shared with other processes
+            self.memory = memory
+        elif prioritized is None:
+            self.memory = ExperienceReplay(maxlen=params['memory__maxlen'],
+                                           batch_size=params['batch_size'],
+                                           packed=params.get('memory__packed', False))
+        else:
+            self.memory = PrioritizedExperienceReplay(maxlen=params['memory__maxlen'],
+                                                      batch_size=params['batch_size'],
+                                                      packed=params.get('memory__packed', False),
+                                                      **prioritized)
+        if isinstance(self.memory, PrioritizedExperienceReplay):
+            # keep the loss of every sample to weight it by its importance-sampling weight
+            self.criterion = getattr(
+                torch.nn, params['criterion']['name'])(**{**params['criterion']['config'], 'reduction': 'none'})
+        else:
+            self.criterion = getattr(
+                torch.nn, params['criterion']['name'])(**params['criterion']['config'])
         self.params = params
         self.device = device
         self.eps_threshold = 0.
+        # inputs of the forward passes of `exploit` and `exploit_batch`, which are grown on demand
+        self.encoder = StateEncoder(capacity=1, device=device)
+        # forward passes of the policy and the target, compiled if `compile` is not None
+        self.policy_forward: Callable[[torch.Tensor], torch.Tensor] = self.net.policy
+        self.target_forward: Callable[[torch.Tensor], torch.Tensor] = self.net.target
+        compile_params = params.get('compile')
+        if compile_params is not None:
+            self.policy_forward = CompiledForward(
+                self.net.policy, compile_params)
+            self.target_forward = CompiledForward(
+                self.net.target, compile_params)
+        # started by the first call to `optimize`, so that agents which only act never start it
+        self.prefetcher: BatchPrefetcher | None = None
+        self._memory_lock = threading.Lock()
         if load_model_path is not None:
             self._load(load_model_path)
+        # runtime of the forward passes of `exploit` and `exploit_batch`
+        self.inference = get_inference_backend(
+            params.get('inference', Inference(name='torch', config={})), self.net.policy, self.policy_forward)
         self.optimizer = getattr(torch.optim, params['optimizer']['name'])(
             self.net.policy.parameters(), **params['optimizer']['config'])
 
@@ -39,8 +76,7 @@ class DQNAgent:
         Returns:
             - The chosen action.
         """
-        self.eps_threshold = self.params['epsilon']['end'] + (self.params['epsilon']['start'] - self.params['epsilon']['end']) \
-            * math.exp(-1. * num_steps / self.params['epsilon']['decay'])
+        self.update_eps_threshold(num_steps)
         if random.random() > self.eps_threshold:
             # exploit learnt actions while not enforcing it is valid
             return self.exploit(state, valid_actions, enforce_valid_action)
@@ -49,6 +85,45 @@ class DQNAgent:
             # explore actions
             return np.random.choice(valid_actions)
 
+    def act_batch(self, states: np.ndarray, valid_actions: np.ndarray, num_steps: int, enforce_valid_action: bool) -> np.ndarray:
+        """
+        Batched version of `act`: draws exploration for every state and predicts the actions of all
+        the exploiting states with a single forward pass.
+
+        Args:
+            - `states`: array of shape (N, observation_space, action_space) with the states.
+            - `valid_actions`: boolean array of shape (N, action_space) with the valid actions of every state.
+            - `num_steps`: current total number of steps taken during training.
+            - `enforce_valid_action`: whether to enforce that the action is valid or not.
+
+        Returns:
+            - Array of shape (N) with the chosen actions.
+        """
+        self.update_eps_threshold(num_steps)
+        exploit = np.random.random(len(states)) > self.eps_threshold
+        # explore actions, i.e. a random valid action for every state
+        actions = np.argmax(np.random.random(
+            valid_actions.shape) * valid_actions, axis=1)
+        if exploit.any():
+            # exploit learnt actions while not enforcing they are valid
+            actions[exploit] = self.exploit_batch(
+                states[exploit], valid_actions[exploit], enforce_valid_action)
+        return actions
+
+    def autocast(self) -> torch.autocast:
+        """
+        Returns the context in which forward passes are run, which casts them to bfloat16 if `precision`
+        is 'bfloat16', while weights, gradients and optimizer states stay in float32.
+
+        Returns:
+            - The autocast context.
+        """
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.params.get('precision', 'float32') == 'bfloat16'
+        )
+
     def cache(self, state: np.ndarray, action: int, next_state: np.ndarray | None, reward: float) -> None:
         """
         Pushes a transition into memory.
@@ -59,7 +134,16 @@ class DQNAgent:
             - `next_state`:  the state at time t + 1.
             - `reward`: the reward after performing the action.
         """
-        self.memory.push(state, action, next_state, reward)
+        with self._memory_lock:
+            self.memory.push(state, action, next_state, reward)
+
+    def close(self) -> None:
+        """
+        Stops the batch prefetcher, if any.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
 
     @torch.no_grad()
     def exploit(self, state: np.ndarray, valid_actions: List[int], enforce_valid_action: bool) -> int:
@@ -75,12 +159,9 @@ class DQNAgent:
         Returns:
             - The chosen action.
         """
-        tensor_state = torch.tensor(
-            data=get_two_channels(np.expand_dims(state, 0)),
-            dtype=torch.float,
-            device=self.device
-        )
-        output = self.net(tensor_state, 'policy').squeeze().cpu().numpy()
+        with self.autocast():
+            output = self.inference(self.encoder.encode(
+                state[None])).squeeze().float().cpu().numpy()
         if enforce_valid_action:
             # only outputs in valid actions can be considered
             all_actions = np.arange(self.params['out_features'])
@@ -91,49 +172,60 @@ class DQNAgent:
         else:
             return int(np.argmax(output, keepdims=False))
 
-    def optimize(self) -> float:
+    @torch.no_grad()
+    def exploit_batch(self, states: np.ndarray, valid_actions: np.ndarray, enforce_valid_action: bool) -> np.ndarray:
+        """
+        Batched version of `exploit`, which predicts the actions of all `states` with a single forward pass.
+
+        Args:
+            - `states`: array of shape (N, observation_space, action_space) with the states.
+            - `valid_actions`: boolean array of shape (N, action_space) with the valid actions of every state.
+            - `enforce_valid_action`: if True, it enforces that the actions are valid.
+
+        Returns:
+            - Array of shape (N) with the chosen actions.
+        """
+        with self.autocast():
+            output = self.inference(self.encoder.encode(states))
+        if enforce_valid_action:
+            # only outputs in valid actions can be considered
+            output = output.masked_fill(
+                ~torch.from_numpy(valid_actions).to(self.device), -torch.inf)
+        return output.argmax(1).cpu().numpy()
+
+    def optimize(self, num_batches: int = 1) -> float:
         """ 
-        Performs one step of the optimization on the policy network.
+        Performs `num_batches` steps of the optimization on the policy network, whose batches are
+        sampled from memory at once. If `prefetch` is not None, they are taken from the batch prefetcher
+        instead, which is (re)started whenever `num_batches` changes.
+
+        Args:
+            - `num_batches`: number of optimization steps.
 
         Returns:
-            - The computed loss.
+            - The mean of the computed losses.
         """
-        transitions = self.memory.recall()
-        batch = Transition(*zip(*transitions))
-        # (batch_size x 2 x observation_space x action_space)
-        state_batch = torch.tensor(
-            data=get_two_channels(np.stack(batch.state)),
-            device=self.device,
-            dtype=torch.float
-        )
-        # (batch_size x 1)
-        action_batch = torch.tensor(
-            data=np.stack(batch.action),
-            device=self.device,
-            dtype=torch.long
-        ).unsqueeze(1)
-        # compute current Q values
-        # (batch_size, 1)
-        q_pred = self.net(state_batch, 'policy').gather(
-            dim=1,
-            index=action_batch)
-        # compute expected Q values
-        # (batch_size, 1)
-        q_next = self._get_expected_state_action_values(
-            batch.next_state, batch.reward)
-        # compute loss
-        loss = self.criterion(q_pred, q_next)
-        # set gradients to none instead of zero (reduces the number of memory operations)
-        self.optimizer.zero_grad(set_to_none=True)
-        # compute gradients
-        loss.backward()
-        # in-place gradient clipping
-        if self.params['clip_grads'] is not None:
-            getattr(torch.nn.utils,
-                    self.params['clip_grads']['name'])(self.net.policy.parameters(), **self.params['clip_grads']['config'])
-        # optimize the model
-        self.optimizer.step()
-        return loss.item()
+        prefetch = self.params.get('prefetch')
+        if prefetch is None:
+            with self._memory_lock:
+                batches = to_tensors(self.memory.recall(num_batches))
+        else:
+            if self.prefetcher is None or self.prefetcher.num_batches != num_batches:
+                self.close()
+                self.prefetcher = BatchPrefetcher(
+                    memory=self.memory,
+                    lock=self._memory_lock,
+                    num_batches=num_batches,
+                    depth=prefetch,
+                    device=self.device
+                )
+            batches = self.prefetcher.get()
+        batch_size = self.memory.batch_size
+        losses = []
+        for start in range(0, num_batches * batch_size, batch_size):
+            losses.append(self._optimize_batch(Batch(*(
+                None if field is None else field[start:start + batch_size] for field in batches))))
+        return float(np.mean(losses))
 
     def save(self, checkpoints_dir_path: str, model_id: str, current_step: int) -> None:
         """
@@ -168,79 +260,62 @@ class DQNAgent:
             - `episode`: current episode of the training.
         """
         if self.params['target_update']['mode'] == 'soft':
-            # soft update of the target network's weights
-            target_net_state_dict = self.net.target.state_dict()
-            policy_net_state_dict = self.net.policy.state_dict()
-
-            for key in policy_net_state_dict:
-                target_net_state_dict[key] = policy_net_state_dict[key] * \
-                    self.params['target_update']['config']['tau'] + target_net_state_dict[key] * \
-                    (1-self.params['target_update']['config']['tau'])
-
-            self.net.target.load_state_dict(target_net_state_dict)
+            # soft update of the target network's weights, in place
+            soft_update(self.net.target, self.net.policy,
+                        self.params['target_update']['config']['tau'])
 
         else:
             # hard update of the target network's weights
-            if episode + 1 % self.params['target_update']['config']['period'] == 0:
+            if (episode + 1) % self.params['target_update']['config']['period'] == 0:
                 self.net.target.load_state_dict(self.net.policy.state_dict())
 
+    def update_eps_threshold(self, num_steps: int) -> None:
+        """
+        Decays the epsilon threshold exponentially with the number of steps.
+
+        Args:
+            - `num_steps`: current total number of steps taken during training.
+        """
+        self.eps_threshold = self.params['epsilon']['end'] + (self.params['epsilon']['start'] - self.params['epsilon']['end']) \
+            * math.exp(-1. * num_steps / self.params['epsilon']['decay'])
+
     @torch.no_grad()
-    def _get_expected_state_action_values(self, next_state: tuple, rewards: tuple) -> torch.Tensor:
+    def _get_expected_state_action_values(self, next_states: torch.Tensor, rewards: torch.Tensor, non_final: torch.Tensor) -> torch.Tensor:
         """
         Computes expected Q values.
 
         Args:
-            - `next_states`: tuple of next state numpy arrays.
-            - `rewards`: tensor with the stacked rewards.
-            - `batch_size`: the size of the batch.
+            - `next_states`: tensor with the two-channel next states.
+            - `rewards`: tensor with the rewards.
+            - `non_final`: boolean tensor which is False for the transitions whose next state is final.
         """
         # (batch_size)
-        reward_batch = torch.tensor(
-            data=np.stack(rewards),
-            device=self.device,
-            dtype=torch.float
-        )
+        reward_batch = rewards.to(self.device, non_blocking=True)
         # (batch_size)
-        q_next = torch.zeros(
-            size=reward_batch.size(),
-            device=self.device
-        )
-        # batch_size
-        non_final_mask = torch.tensor(
-            data=tuple(map(lambda s: s is not None, next_state)),
-            device=self.device,
-            dtype=torch.bool
-        )
-        # (batch_size - final_states, 2, observation_space, action_space)
-        non_final_next_states = torch.tensor(
-            data=get_two_channels(np.concatenate(
-                [np.expand_dims(s, 0) for s in next_state if s is not None])),
-            device=self.device,
-            dtype=torch.float
-        )
+        non_final_mask = non_final.to(self.device, non_blocking=True)
+        # (batch_size, 2, observation_space, action_space)
+        next_state_batch = next_states.to(self.device, non_blocking=True)
 
-        if self.params['double']:
-            # use both policy and target to approximate the q values of the next states
-            # (batch_size - final_states, action_space)
-            output = self.net(non_final_next_states, 'policy')
-            # (batch_size, 1)
-            best_actions = output.argmax(1).unsqueeze(1)
-            # (batch_size, 1)
-            q_pred = self.net(non_final_next_states, 'target').gather(
-                dim=1, index=best_actions)
-            # use mask to keep q values for non final states zero
-            # (batch_size)
-            q_next[non_final_mask] = q_pred.squeeze(1)
+        with self.autocast():
+            if self.params['double']:
+                # use both policy and target to approximate the q values of the next states
+                # (batch_size, action_space)
+                output = self.policy_forward(next_state_batch)
+                # (batch_size, 1)
+                best_actions = output.argmax(1).unsqueeze(1)
+                # (batch_size)
+                q_pred = self.target_forward(next_state_batch).gather(
+                    dim=1, index=best_actions).squeeze(1).float()
 
-        else:
-            # get the q values of the non-final next states using the target network
-            # (batch_size - final_states, action_space)
-            output = self.net(non_final_next_states, 'target')
-            # (batch_size - final_states)
-            q_pred = output.max(1)[0]
-            # use mask to keep q values for non final states zero
-            # (batch_size)
-            q_next[non_final_mask] = q_pred
+            else:
+                # get the q values of the next states using the target network
+                # (batch_size, action_space)
+                output = self.target_forward(next_state_batch)
+                # (batch_size)
+                q_pred = output.max(1)[0].float()
+        # use mask to keep q values for final states zero
+        # (batch_size)
+        q_next = torch.where(non_final_mask, q_pred, 0.)
         # apply the discount factor, subtract from the reward and add a dimension
         # (batch_size, 1)
         return (reward_batch - (self.params['gamma'] * q_next)).unsqueeze(1)
@@ -262,3 +337,52 @@ class DQNAgent:
         self.net.load_state_dict(state_dict=state_dict)
         print(
             f"Model at {checkpoint_path} with an epsilon threshold of {eps_threshold} has been loaded")
+
+    def _optimize_batch(self, batch: Batch) -> float:
+        """ 
+        Performs one step of the optimization on the policy network with `batch`.
+
+        Args:
+            - `batch`: the batch sampled from memory, with tensors instead of arrays except for the indices.
+
+        Returns:
+            - The computed loss.
+        """
+        # (batch_size x 2 x observation_space x action_space)
+        state_batch = batch.state.to(self.device, non_blocking=True)
+        # (batch_size x 1)
+        action_batch = batch.action.to(
+            self.device, non_blocking=True).unsqueeze(1)
+        # compute current Q values
+        # (batch_size, 1)
+        with self.autocast():
+            q_pred = self.policy_forward(state_batch).gather(
+                dim=1,
+                index=action_batch).float()
+        # compute expected Q values
+        # (batch_size, 1)
+        q_next = self._get_expected_state_action_values(
+            batch.next_state, batch.reward, batch.non_final)
+        # compute loss
+        if isinstance(self.memory, PrioritizedExperienceReplay):
+            # weight the loss of every sample and feed its TD error back as its new priority
+            weight_batch = batch.weight.to(
+                self.device, non_blocking=True).unsqueeze(1)
+            loss = (self.criterion(q_pred, q_next) * weight_batch).mean()
+            td_errors = (q_pred - q_next).detach().squeeze(1).cpu().numpy()
+            with self._memory_lock:
+                self.memory.update_priorities(batch.index, td_errors)
+        else:
+            loss = self.criterion(q_pred, q_next)
+        # set gradients to none instead of zero (reduces the number of memory operations)
+        self.optimizer.zero_grad(set_to_none=True)
+        # compute gradients
+        loss.backward()
+        # in-place gradient clipping
+        if self.params['clip_grads'] is not None:
+            getattr(torch.nn.utils,
+                    self.params['clip_grads']['name'])(self.net.policy.parameters(), **self.params['clip_grads']['config'])
+        # optimize the model
+        self.optimizer.step()
+        self.inference.update()
+        return loss.item()
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+
+import argparse
+import copy
+import itertools
+import random
+import tempfile
+import numpy as np
+import time
+import torch
+import tracemalloc
+from bitboard import from_observations
+from constants import COMPILE_CACHE_DIR_PATH
+from custom_types import ParamsAgent, ParamsEnv, ParamsEval, ParamsTrain
+from agent import DQNAgent
+from env import ConnectFourEnv, BitboardConnectFourEnv, VectorConnectFourEnv
+from evaluation import evaluate, get_puzzle_suites
+from modules import CNNResNet, CompiledForward, ConnectFourNet, fuse_for_inference, soft_update
+from puzzles import play_games
+from replay import ExperienceReplay
+from solver import Solver
+from torch.profiler import profile, ProfilerActivity
+from training import train
+from typing import Callable, Literal
+from utils import StateEncoder, encode_bitboards, encode_boards, get_two_channels
+
+params_env: ParamsEnv = {
+    'action_space': 7,
+    'observation_space': 6,
+    'rewards': {
+        'win': 1.,
+        'loss': -1.,
+        'draw': 0,
+        'prolongation': -0.
+    }
+}
+
+
+def benchmark_compile(repeats: int, cache_dir: str | None) -> None:
+    """
+    Prints the warm-up time and the latency of the policy of `ConnectFourNet` run eagerly, with TorchScript
+    and with `torch.compile`, for acting, i.e. a forward pass without gradients on a single state, and
+    for learning, i.e. a forward and a backward pass on a batch of 512 states.
+
+    Args:
+        - `repeats`: number of calls.
+        - `cache_dir`: directory of the cache of `torch.compile`, or None to disable it.
+    """
+    policy = ConnectFourNet(out_features=7).policy
+    forwards: dict[str, Callable[[torch.Tensor], torch.Tensor]] = {
+        'eager': policy,
+        'script': CompiledForward(policy, {'name': 'script', 'config': {}, 'cache_dir': None}),
+        'compile': CompiledForward(policy, {'name': 'compile', 'config': {}, 'cache_dir': cache_dir})
+    }
+    print(f"{'':<24}{'warm-up (s)':>12}{'us/call':>12}")
+    for batch_size, learn in ((1, False), (512, True)):
+        x = torch.randn(batch_size, 2, 6, 7)
+        policy.train(learn)
+        for name, forward in forwards.items():
+            def call() -> None:
+                if learn:
+                    forward(x).sum().backward()
+                else:
+                    with torch.no_grad():
+                        forward(x)
+            start = time.perf_counter()
+            # the profiling executor of TorchScript optimizes on the second call
+            call()
+            call()
+            warm_up = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(repeats):
+                call()
+            elapsed = time.perf_counter() - start
+            title = f"{name} ({'learn' if learn else 'act'}, {batch_size})"
+            print(f"{title:<24}{warm_up:>12.2f}{elapsed / repeats * 1e6:>12.1f}")
+
+
+def benchmark_encoding(batch_size: int, repeats: int) -> None:
+    """
+    Prints the time taken by every way of encoding a batch of boards into the float32 input of the
+    networks, together with the number of tensor allocations and the bytes allocated per call. Tensor
+    allocations are counted with the torch profiler and numpy temporaries with `tracemalloc`, as their peak size.
+
+    Args:
+        - `batch_size`: number of boards per call.
+        - `repeats`: number of calls.
+    """
+    vector_env = VectorConnectFourEnv(
+        params=params_env, num_envs=batch_size, device=torch.device('cpu'))
+    vector_env.reset()
+    valid_actions = vector_env.get_valid_actions()
+    for _ in range(20):
+        # play some random moves so that boards are not empty
+        actions = np.argmax(np.random.random(
+            valid_actions.shape) * valid_actions, axis=1)
+        observations, _, _, valid_actions, _ = vector_env.step(actions)
+    bitboards = np.stack(from_observations(observations), axis=1)
+    rows, cols = observations.shape[1:]
+    encoder = StateEncoder(capacity=batch_size, device=torch.device('cpu'))
+    encoders = {
+        'torch.tensor(get_two_channels)': lambda: torch.tensor(get_two_channels(observations), dtype=torch.float),
+        'encode_boards': lambda: encode_boards(observations),
+        'encode_bitboards': lambda: encode_bitboards(bitboards, rows, cols),
+        'StateEncoder.encode': lambda: encoder.encode(observations),
+        'StateEncoder.encode_bitboards': lambda: encoder.encode_bitboards(bitboards)
+    }
+    print(f"{'':<32}{'us/call':>10}{'tensors':>10}{'tensor B':>12}{'numpy B':>12}")
+    for name, encode in encoders.items():
+        encode()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            encode()
+        elapsed = time.perf_counter() - start
+
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            for _ in range(repeats):
+                encode()
+        # frees are reported as separate events with negative sizes
+        allocations = [event.self_cpu_memory_usage for event in prof.events()
+                       if event.self_cpu_memory_usage > 0]
+        tracemalloc.start()
+        encode()
+        _, numpy_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:<32}{elapsed / repeats * 1e6:>10.1f}{len(allocations) / repeats:>10.1f}"
+              f"{sum(allocations) / repeats:>12.0f}{numpy_peak:>12}")
+
+
+def benchmark_env(num_steps: int) -> None:
+    """
+    Prints the number of random steps per second taken by every environment backend.
+
+    Args:
+        - `num_steps`: number of steps to take with each backend.
+    """
+    device = torch.device('cpu')
+    for env_class in (ConnectFourEnv, BitboardConnectFourEnv):
+        env = env_class(params=params_env, device=device)
+        env.reset()
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            _, _, is_done = env.step(np.random.choice(env.get_valid_actions()))
+            if is_done:
+                env.reset()
+            else:
+                env.switch_turn()
+        elapsed = time.perf_counter() - start
+        print(f"{env_class.__name__:<30}{num_steps / elapsed:>14.0f} steps/s")
+
+    for num_envs in (64, 1024):
+        vector_env = VectorConnectFourEnv(
+            params=params_env, num_envs=num_envs, device=device)
+        vector_env.reset()
+        valid_actions = vector_env.get_valid_actions()
+        num_iterations = max(num_steps // num_envs, 1)
+        start = time.perf_counter()
+        for _ in range(num_iterations):
+            # pick a random valid action in every game
+            actions = np.argmax(np.random.random(
+                valid_actions.shape) * valid_actions, axis=1)
+            _, _, _, valid_actions, _ = vector_env.step(actions)
+        elapsed = time.perf_counter() - start
+        title = f'{VectorConnectFourEnv.__name__} ({num_envs})'
+        print(
+            f"{title:<30}{num_iterations * num_envs / elapsed:>14.0f} steps/s")
+
+
+def benchmark_fuse(batch_size: int, repeats: int) -> None:
+    """
+    Prints the latency of the policy of `CNNResNet` without gradients, in evaluation mode, with its batch
+    normalizations folded by `fuse_for_inference`, and folded in channels last memory format, on a single
+    state and on a batch of `batch_size` states, along with the largest difference of their outputs.
+
+    Args:
+        - `batch_size`: number of states in the batch.
+        - `repeats`: number of timed forward passes on a single state, those on a batch are a tenth.
+    """
+    policy = CNNResNet(out_features=params_env['action_space']).policy
+    # fill the running statistics of the batch normalizations with those of random boards
+    with torch.no_grad():
+        for _ in range(10):
+            policy(torch.randint(0, 2, [256, 2, 6, 7], dtype=torch.float))
+    policy.eval()
+    states = torch.randint(0, 2, [batch_size, 2, 6, 7], dtype=torch.float)
+    variants = {
+        'eval': (policy, states),
+        'fused': (fuse_for_inference(policy), states),
+        'fused channels last': (fuse_for_inference(policy, channels_last=True),
+                                states.contiguous(memory_format=torch.channels_last))
+    }
+    with torch.no_grad():
+        expected = policy(states)
+        for name, (module, x) in variants.items():
+            for size, num_repeats in ((1, repeats), (batch_size, max(repeats // 10, 1))):
+                module(x[:size])
+                start = time.perf_counter()
+                for _ in range(num_repeats):
+                    module(x[:size])
+                elapsed = time.perf_counter() - start
+                title = f'{name} ({size})'
+                print(f"{title:<30}{elapsed / num_repeats * 1e6:>12.1f} us/forward")
+            print(f"{'':<30}{(module(x) - expected).abs().max().item():>12.2e} max abs diff")
+
+
+def benchmark_precision(episodes: int, batch_size: int, repeats: int) -> None:
+    """
+    Compares float32 and bfloat16 autocast: prints the optimization steps per second on batches of
+    `batch_size`, the states per second predicted at batch 1 and `batch_size`, and the win rate and
+    puzzle accuracy after training for `episodes` episodes from the same seed.
+
+    Args:
+        - `episodes`: number of training episodes.
+        - `batch_size`: size of the batches.
+        - `repeats`: number of timed calls.
+    """
+    device = torch.device('cpu')
+    env = BitboardConnectFourEnv(params=params_env, device=device)
+    results = {}
+    precision: Literal['float32', 'bfloat16']
+    for precision in ('float32', 'bfloat16'):
+        random.seed(0)
+        np.random.seed(0)
+        torch.manual_seed(0)
+        params_agent, params_train, params_eval = _get_params(
+            precision, episodes, batch_size)
+        agent = DQNAgent(net=ConnectFourNet(out_features=7),
+                         params=params_agent, device=device)
+        with tempfile.TemporaryDirectory() as checkpoints_dir_path:
+            train_history, _, _, _ = train(agent=agent, env=env, params_train=params_train, params_eval=params_eval,
+                                           checkpoints_dir_path=checkpoints_dir_path, device=device)
+        agent.net.policy.eval()
+        evaluation = evaluate(agent=agent, env=env,
+                              params=params_eval, device=device)
+        states = np.zeros([batch_size, 6, 7], dtype=np.int8)
+        valid_actions = np.ones([batch_size, 7], dtype=bool)
+        timings = []
+        for call in (lambda: agent.exploit_batch(states[:1], valid_actions[:1], True),
+                     lambda: agent.exploit_batch(
+                         states, valid_actions, True),
+                     lambda: agent.optimize()):
+            call()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                call()
+            timings.append((time.perf_counter() - start) / repeats)
+        results[precision] = [1 / timings[0], batch_size / timings[1], 1 / timings[2],
+                              train_history['updates'].sum() / train_history['learn_time'].sum(),
+                              evaluation[6] * 100, evaluation[9], evaluation[10]]
+        agent.close()
+
+    print(f"{'':<12}{'act/s (1)':>12}{f'act/s ({batch_size})':>14}{'opt/s':>10}{'train opt/s':>13}"
+          f"{'win (%)':>10}{'fnsh (%)':>10}{'blck (%)':>10}")
+    for precision, (act, act_batch, optimize, train_optimize, win, finish, block) in results.items():
+        print(f"{precision:<12}{act:>12.0f}{act_batch:>14.0f}{optimize:>10.1f}{train_optimize:>13.1f}"
+              f"{win:>10.1f}{finish:>10.2f}{block:>10.2f}")
+
+
+def benchmark_replay(maxlen: int, batch_size: int, num_recalls: int, packed: bool) -> None:
+    """
+    Fills an `ExperienceReplay` of size `maxlen` with transitions from random games and prints the
+    time it takes to sample a batch and the memory taken per transition.
+
+    Args:
+        - `maxlen`: size of the memory.
+        - `batch_size`: size of the sampled batches.
+        - `num_recalls`: number of batches to sample.
+        - `packed`: whether to store the states as bitboards.
+    """
+    num_envs = 1024
+    memory = ExperienceReplay(
+        maxlen=maxlen, batch_size=batch_size, packed=packed)
+    vector_env = VectorConnectFourEnv(
+        params=params_env, num_envs=num_envs, device=torch.device('cpu'))
+    states = vector_env.reset()
+    valid_actions = vector_env.get_valid_actions()
+    start = time.perf_counter()
+    while len(memory) < maxlen:
+        actions = np.argmax(np.random.random(
+            valid_actions.shape) * valid_actions, axis=1)
+        next_states, rewards, dones, valid_actions, info = vector_env.step(
+            actions)
+        for i in range(num_envs):
+            memory.push(states[i], actions[i], None if dones[i]
+                        else next_states[i], rewards[i])
+        states = next_states
+    push_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(num_recalls):
+        memory.recall()
+    recall_elapsed = time.perf_counter() - start
+    memory_bytes = sum(value.nbytes for value in vars(
+        memory).values() if isinstance(value, np.ndarray))
+    print(f"{'push':<30}{push_elapsed / len(memory) * 1e6:>10.2f} us/transition\n"
+          f"{'recall':<30}{recall_elapsed / num_recalls * 1e3:>10.3f} ms/batch\n"
+          f"{'memory':<30}{memory_bytes / maxlen:>10.1f} bytes/transition")
+
+
+def benchmark_solver(num_positions: int, depth: int) -> None:
+    """
+    Prints the average time and the nodes searched per second by `Solver` to solve exactly positions
+    reached by random play at the end, in the late middle and in the middle of the game, and by the
+    search `depth` plies deep of `best_move` from the empty board. Every set of positions is the same
+    on every run.
+
+    Args:
+        - `num_positions`: number of positions of every set.
+        - `depth`: depth of `best_move`.
+    """
+    sets = {'end': 28, 'late middle': 22, 'middle': 18}
+    for name, num_moves in sets.items():
+        boards = _get_random_positions(num_moves, num_positions, seed=num_moves)
+        solver = Solver()
+        num_nodes, elapsed = 0, 0.
+        for board in boards:
+            # every position is solved from scratch
+            solver.reset()
+            start = time.perf_counter()
+            solver.solve(board)
+            elapsed += time.perf_counter() - start
+            num_nodes += solver.nodes
+        title = f'{name} ({num_moves} moves)'
+        print(f"{title:<30}{elapsed / len(boards) * 1e3:>12.1f} ms/position{num_nodes / elapsed:>12.0f} nodes/s")
+
+    solver = Solver()
+    start = time.perf_counter()
+    solver.best_move(np.zeros([6, 7], dtype=np.int8), depth)
+    elapsed = time.perf_counter() - start
+    title = f'best_move (depth {depth})'
+    print(f"{title:<30}{elapsed * 1e3:>12.1f} ms/position{solver.nodes / elapsed:>12.0f} nodes/s")
+
+
+def benchmark_target_update(repeats: int, tau: float = 0.005) -> None:
+    """
+    Prints the time taken by a soft update of the target network by blending the state dicts and
+    loading the result, and by `modules.soft_update`, for every network.
+
+    Args:
+        - `repeats`: number of updates.
+        - `tau`: the weight of the policy.
+    """
+    def load_blended_state_dict(target: torch.nn.Module, policy: torch.nn.Module) -> None:
+        target_state_dict = target.state_dict()
+        policy_state_dict = policy.state_dict()
+        for key in policy_state_dict:
+            target_state_dict[key] = policy_state_dict[key] * \
+                tau + target_state_dict[key] * (1 - tau)
+        target.load_state_dict(target_state_dict)
+
+    connect_four_net = ConnectFourNet(out_features=7)
+    cnn_res_net = CNNResNet(out_features=7)
+    nets = {
+        'ConnectFourNet': (connect_four_net.target, connect_four_net.policy),
+        'CNNResNet': (cnn_res_net.target, cnn_res_net.policy)
+    }
+    for name, (target, policy) in nets.items():
+        for method, update in (('state_dict', load_blended_state_dict), ('soft_update', lambda target, policy: soft_update(target, policy, tau))):
+            update(target, policy)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                update(target, policy)
+            elapsed = time.perf_counter() - start
+            title = f'{name} ({method})'
+            print(f"{title:<30}{elapsed / repeats * 1e6:>10.1f} us/update")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connect Four benchmarks.")
+    parser.add_argument('benchmark', choices=['compile', 'encoding', 'env', 'fuse', 'precision', 'replay', 'solver', 'target'])
+    parser.add_argument('--steps', type=int, default=100000)
+    parser.add_argument('--episodes', type=int, default=2000)
+    parser.add_argument('--maxlen', type=int, default=1250000)
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--repeats', type=int, default=1000)
+    parser.add_argument('--positions', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=8)
+    parser.add_argument('--packed', action='store_true')
+    parser.add_argument('--cache-dir', default=COMPILE_CACHE_DIR_PATH)
+    args = parser.parse_args()
+
+    if args.benchmark == 'compile':
+        benchmark_compile(repeats=args.repeats, cache_dir=args.cache_dir)
+    elif args.benchmark == 'encoding':
+        benchmark_encoding(batch_size=args.batch_size, repeats=args.repeats)
+    elif args.benchmark == 'env':
+        benchmark_env(num_steps=args.steps)
+    elif args.benchmark == 'fuse':
+        benchmark_fuse(batch_size=args.batch_size, repeats=args.repeats)
+    elif args.benchmark == 'precision':
+        benchmark_precision(episodes=args.episodes,
+                            batch_size=args.batch_size, repeats=args.repeats)
+    elif args.benchmark == 'replay':
+        benchmark_replay(maxlen=args.maxlen,
+                         batch_size=args.batch_size, num_recalls=args.repeats, packed=args.packed)
+    elif args.benchmark == 'solver':
+        benchmark_solver(num_positions=args.positions, depth=args.depth)
+    elif args.benchmark == 'target':
+        benchmark_target_update(repeats=args.repeats)
+
+
+def _get_params(precision: Literal['float32', 'bfloat16'], episodes: int,
+                batch_size: int) -> tuple[ParamsAgent, ParamsTrain, ParamsEval]:
+    """
+    Returns the parameters of the agent, the training and the evaluations of the precision benchmark.
+    """
+    params_agent: ParamsAgent = {
+        'batch_size': batch_size,
+        'clip_grads': None,
+        'compile': None,
+        'criterion': {'name': 'HuberLoss', 'config': {}},
+        'double': True,
+        'epsilon': {'start': 0.9, 'end': 0.05, 'decay': episodes * 25 / 7.5},
+        'gamma': 0.99,
+        'inference': {'name': 'torch', 'config': {}},
+        'memory__maxlen': episodes * 25,
+        'memory__packed': False,
+        'memory__prioritized': None,
+        'optimizer': {'name': 'SGD', 'config': {'lr': 1e-2, 'momentum': 0.9}},
+        'out_features': 7,
+        'precision': precision,
+        'prefetch': None,
+        'target_update': {'mode': 'soft', 'config': {'tau': 0.005}}
+    }
+    params_train: ParamsTrain = {
+        'batch_size': batch_size,
+        'batches_per_update': 1,
+        'checkpoint': {'save_every': None, 'save_on_exit': False},
+        'display_period': episodes,
+        'enforce_valid_action': False,
+        'episodes': episodes,
+        'parallel_games': 16,
+        'replay_ratio': None,
+        'scheduler': None
+    }
+    params_eval: ParamsEval = {
+        'asynchronous': False,
+        'enforce_valid_action': False,
+        'episodes': 500,
+        'move_quality_path': None,
+        'period': episodes,
+        'puzzles_path': None,
+        'vectorized': True
+    }
+    return params_agent, params_train, params_eval
+
+
+def _get_random_positions(num_moves: int, num_positions: int, seed: int) -> np.ndarray:
+    """
+    Returns `num_positions` different positions with `num_moves` counters, not won by either player, reached
+    by random play seeded with `seed`.
+    """
+    positions: dict[bytes, np.ndarray] = {}
+    for batch in itertools.count(seed):
+        # the positions after `num_moves` steps, the games which finished early were reset and have fewer counters
+        env, _, _ = next(itertools.islice(play_games(batch, num_positions, num_steps=num_moves + 1), num_moves, None))
+        for observation in env.observations[env.num_counters == num_moves]:
+            positions.setdefault(observation.tobytes(), observation)
+        if len(positions) >= num_positions:
+            break
+    return np.stack(list(positions.values())[:num_positions])
+
+
+if __name__ == '__main__':
+    main()
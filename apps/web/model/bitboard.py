@@ -0,0 +1,233 @@
+import numpy as np
+from functools import lru_cache
+
+# Every column takes `rows + 1` bits, i.e. one bit per row plus an empty sentinel bit on top, so
+# that four aligned counters can be found with shifts without wrapping around columns. Bit
+# `col * (rows + 1) + row` is set if a counter sits in column `col` at height `row` (0 is the bottom).
+
+
+def get_bitboard_height(rows: int, cols: int) -> int:
+    """
+    Returns the number of bits taken by every column of a `rows` x `cols` board.
+
+    Args:
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - The number of bits per column.
+    """
+    height = rows + 1
+    if height * cols > 64:
+        raise ValueError(
+            f"A {rows}x{cols} board does not fit in a 64-bit bitboard.")
+    return height
+
+
+@lru_cache(maxsize=None)
+def get_cell_shifts(rows: int, cols: int) -> np.ndarray:
+    """
+    Returns the bit index of every cell of a `rows` x `cols` observation.
+
+    Args:
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - Array of shape (`rows`, `cols`) and type uint64 with the bit index of each cell.
+    """
+    height = get_bitboard_height(rows, cols)
+    row_indices = np.arange(rows - 1, -1, -1, dtype=np.uint64)[:, None]
+    col_indices = np.arange(cols, dtype=np.uint64)[None, :]
+    shifts = col_indices * np.uint64(height) + row_indices
+    shifts.flags.writeable = False
+    return shifts
+
+
+@lru_cache(maxsize=None)
+def get_cell_bits(rows: int, cols: int) -> np.ndarray:
+    """
+    Returns the bit of every cell of a `rows` x `cols` observation, flattened.
+
+    Args:
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - Array of shape (`rows` * `cols`) and type uint64 with the bit of each cell set.
+    """
+    bits = (np.uint64(1) << get_cell_shifts(rows, cols)).ravel()
+    bits.flags.writeable = False
+    return bits
+
+
+def get_winning_cells(positions: np.ndarray, masks: np.ndarray, rows: int, cols: int) -> np.ndarray:
+    """
+    Returns the empty cells, playable or not, which would complete four aligned counters of `positions`.
+
+    Args:
+        - `positions`: uint64 array with the counters of one player on every board.
+        - `masks`: uint64 array with the counters of both players on every board.
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - uint64 array with the same shape as `positions` with the bits of the cells set.
+    """
+    height = rows + 1
+    board = np.uint64(sum(((1 << rows) - 1) << col * height for col in range(cols)))
+    one, two, three = np.uint64(1), np.uint64(2), np.uint64(3)
+    # vertical, bits shifted beyond 64 are dropped, which are not on the board anyway
+    wins = (positions << one) & (positions << two) & (positions << three)
+    for shift in (np.uint64(height), np.uint64(height - 1), np.uint64(height + 1)):
+        # horizontal, diagonal and anti-diagonal
+        pairs = (positions << shift) & (positions << two * shift)
+        wins |= pairs & ((positions << three * shift) | (positions >> shift))
+        pairs = (positions >> shift) & (positions >> two * shift)
+        wins |= pairs & ((positions << shift) | (positions >> three * shift))
+    return wins & (board ^ masks)
+
+
+def is_win(bitboard: int, rows: int) -> bool:
+    """
+    Checks whether there are four aligned counters in `bitboard` either vertically, horizontally,
+    diagonally or anti-diagonally.
+
+    Args:
+        - `bitboard`: counters of one player.
+        - `rows`: number of rows of the board.
+
+    Returns:
+        - True if there are four aligned counters.
+    """
+    height = rows + 1
+    for shift in (1, height, height - 1, height + 1):
+        pairs = bitboard & (bitboard >> shift)
+        if pairs & (pairs >> (2 * shift)):
+            return True
+    return False
+
+
+def are_wins(bitboards: np.ndarray, rows: int) -> np.ndarray:
+    """
+    Vectorized version of `is_win`.
+
+    Args:
+        - `bitboards`: uint64 array with the counters of one player on every board.
+        - `rows`: number of rows of the board.
+
+    Returns:
+        - Boolean array with the same shape as `bitboards`.
+    """
+    height = rows + 1
+    wins = np.zeros(bitboards.shape, dtype=bool)
+    for shift in (1, height, height - 1, height + 1):
+        pairs = bitboards & (bitboards >> np.uint64(shift))
+        wins |= (pairs & (pairs >> np.uint64(2 * shift))) != 0
+    return wins
+
+
+def mirror(bitboard: int, rows: int, cols: int) -> int:
+    """
+    Flips a bitboard left to right, i.e. moves the bits of column `col` to column `cols - 1 - col`.
+    Columns never carry into each other when adding bitboards in which every column fits, e.g. the
+    counters of one player plus those of both, so the sum can be flipped as well.
+
+    Args:
+        - `bitboard`: bitboard of a `rows` x `cols` board.
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - The flipped bitboard.
+    """
+    height = rows + 1
+    column = (1 << height) - 1
+    mirrored = 0
+    for col in range(cols):
+        mirrored |= ((bitboard >> col * height) & column) << (cols - 1 - col) * height
+    return mirrored
+
+
+def mirrors(bitboards: np.ndarray, rows: int, cols: int) -> np.ndarray:
+    """
+    Vectorized version of `mirror`.
+
+    Args:
+        - `bitboards`: uint64 array of bitboards of `rows` x `cols` boards.
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - uint64 array with the same shape as `bitboards`.
+    """
+    height = rows + 1
+    column = np.uint64((1 << height) - 1)
+    mirrored = np.zeros_like(bitboards)
+    for col in range(cols):
+        mirrored |= ((bitboards >> np.uint64(col * height)) & column) << np.uint64((cols - 1 - col) * height)
+    return mirrored
+
+
+def to_observations(p1: np.ndarray, p2: np.ndarray, rows: int, cols: int) -> np.ndarray:
+    """
+    Decodes bitboards into observations with values 0, 1 or 2.
+
+    Args:
+        - `p1`: uint64 array of shape (N) with the counters of player 1.
+        - `p2`: uint64 array of shape (N) with the counters of player 2.
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - Array of shape (N, `rows`, `cols`) and type int8.
+    """
+    shifts = get_cell_shifts(rows, cols)
+    observations = ((p1[:, None, None] >> shifts) & np.uint64(1)).astype(np.int8)
+    observations += 2 * ((p2[:, None, None] >> shifts) &
+                         np.uint64(1)).astype(np.int8)
+    return observations
+
+
+def from_observations(observations: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Encodes observations with values 0, 1 or 2 into one bitboard per player.
+
+    Args:
+        - `observations`: array of shape (N, rows, cols).
+
+    Returns:
+        - Tuple with two uint64 arrays of shape (N) with the counters of player 1 and player 2.
+    """
+    _, rows, cols = observations.shape
+    bits = get_cell_bits(rows, cols)
+    cells = observations.reshape(len(observations), -1)
+    # every bit is set in a single cell, so adding them up is the same as or-ing them
+    p1 = (cells == 1).astype(np.uint64) @ bits
+    p2 = (cells == 2).astype(np.uint64) @ bits
+    return p1, p2
+
+
+def play_moves(bitboards: np.ndarray, players: np.ndarray, actions: np.ndarray, rows: int) -> np.ndarray:
+    """
+    Returns the bitboards that result from dropping a counter of `players` in column `actions` of
+    every board. Full columns are left untouched.
+
+    Args:
+        - `bitboards`: uint64 array of shape (N, 2) with the counters of player 1 and player 2.
+        - `players`: array of shape (N) with the player, 1 or 2, who drops the counter.
+        - `actions`: array of shape (N) with the column indices.
+        - `rows`: number of rows of the board.
+
+    Returns:
+        - uint64 array of shape (N, 2) with the new bitboards.
+    """
+    offsets = actions.astype(np.uint64) * np.uint64(rows + 1)
+    mask = bitboards[:, 0] | bitboards[:, 1]
+    column = np.uint64((1 << rows) - 1) << offsets
+    # adding the bottom bit of the column to the mask carries up to its first empty cell
+    new_counters = (mask + (np.uint64(1) << offsets)) & column
+    next_bitboards = bitboards.copy()
+    next_bitboards[np.arange(len(bitboards)), players - 1] |= new_counters
+    return next_bitboards
+
@@ -2,8 +2,12 @@ import numpy as np
 from os.path import join
 
 CHECKPOINTS_DIR_PATH = join('exports', 'checkpoints')
+COMPILE_CACHE_DIR_PATH = join('exports', 'compile_cache')
 FIGURES_DIR_PATH = join('exports', 'figures')
+LEAGUE_PATH = join('exports', 'league.jsonl')
+MOVE_QUALITY_PATH = join('exports', 'move_quality.npz')
 POLICIES_DIR_PATH = join('exports', 'policies')
+PUZZLES_PATH = join('exports', 'puzzles.npz')
 
 blocks_boards_solutions = [
     # horizontal
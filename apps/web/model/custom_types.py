@@ -1,4 +1,4 @@
-from typing import TypedDict, Literal
+from typing import NotRequired, TypedDict, Literal
 
 
 class Config(TypedDict):
@@ -19,6 +19,11 @@ class ClipGrads(Config):
     name: Literal['clip_grad_norm_', 'clip_grad_value_']
 
 
+class Compile(Config):
+    name: Literal['compile', 'script']
+    cache_dir: str | None
+
+
 class Criterion(Config):
     name: Literal['L1Loss', 'NLLLoss', 'NLLLoss2d', 'PoissonNLLLoss', 'GaussianNLLLoss', 'KLDivLoss',
                   'MSELoss', 'BCELoss', 'BCEWithLogitsLoss', 'HingeEmbeddingLoss', 'MultiLabelMarginLoss',
@@ -27,6 +32,10 @@ class Criterion(Config):
                   'TripletMarginWithDistanceLoss', 'CTCLoss']
 
 
+class Inference(Config):
+    name: Literal['torch', 'onnxruntime']
+
+
 class Optimizer(Config):
     name: Literal['Adadelta', 'Adagrad', 'Adam', 'AdamW', 'SparseAdam',
                   'Adamax', 'ASGD', 'SGD', 'RAdam', 'Rprop', 'RMSprop', 'NAdam', 'LBFGS']
@@ -38,6 +47,13 @@ class Scheduler(Config):
                   'CyclicLR', 'CosineAnnealingWarmRestarts', 'OneCycleLR', 'PolynomialLR', 'LRScheduler']
 
 
+class Prioritized(TypedDict):
+    alpha: float
+    beta_start: float
+    beta_steps: int
+    epsilon: float
+
+
 class Rewards(TypedDict):
     win: float
     loss: float
@@ -53,16 +69,28 @@ class Checkpoint(TypedDict):
 class ParamsAgent(TypedDict):
     batch_size: int
     clip_grads: ClipGrads | None
+    compile: NotRequired[Compile | None]
     criterion: Criterion
     double: bool
     epsilon: Epsilon
     gamma: float
+    inference: NotRequired[Inference]
     memory__maxlen: int
+    memory__packed: NotRequired[bool]
+    memory__prioritized: NotRequired[Prioritized | None]
     optimizer: Optimizer
     out_features: int
+    precision: NotRequired[Literal['float32', 'bfloat16']]
+    prefetch: NotRequired[int | None]
     target_update: Target_Update
 
 
+class ParamsDistributed(TypedDict):
+    actors: int
+    log_period: float
+    sync_period: int
+
+
 class ParamsEnv(TypedDict):
     action_space: int
     observation_space: int
@@ -70,15 +98,22 @@ class ParamsEnv(TypedDict):
 
 
 class ParamsEval(TypedDict):
+    asynchronous: NotRequired[bool]
     enforce_valid_action: bool
     episodes: int
+    move_quality_path: NotRequired[str | None]
     period: int
+    puzzles_path: NotRequired[str | None]
+    vectorized: NotRequired[bool]
 
 
 class ParamsTrain(TypedDict):
     batch_size: int
+    batches_per_update: NotRequired[int]
     checkpoint: Checkpoint
     display_period: int
     enforce_valid_action: bool
     episodes: int
+    parallel_games: NotRequired[int]
+    replay_ratio: NotRequired[float | None]
     scheduler: None | Scheduler
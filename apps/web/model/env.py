@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+from bitboard import are_wins, get_bitboard_height, is_win
 from custom_types import ParamsEnv
 from typing import List
 
@@ -138,3 +139,184 @@ class ConnectFourEnv:
         self.is_done = False
         self.turn = 1
         self.winner = None
+
+
+class BitboardConnectFourEnv(ConnectFourEnv):
+    """
+    Connect Four environment with the same contract as `ConnectFourEnv`, but which keeps the counters of
+    each player in a 64-bit bitboard and the height of every column, so that drops, valid actions and
+    winner checks only take a few shift and bitwise operations. The observation is still kept as a
+    `observation_space` x `action_space` int8 array, which is updated with a single write every step.
+    """
+
+    def __init__(self, params: ParamsEnv, device: torch.device):
+        super().__init__(params, device)
+        self.bitboard_height = get_bitboard_height(
+            params['observation_space'], params['action_space'])
+        self.bitboards: List[int] = [0, 0]
+        self.heights: List[int] = [0] * params['action_space']
+        self.num_counters = 0
+
+    def get_valid_actions(self) -> List[int]:
+        """
+        Returns a list with all the valid actions for the current board
+        """
+        rows = self.params['observation_space']
+        return [col for col, height in enumerate(self.heights) if height < rows]
+
+    def step(self, action: int) -> tuple[np.ndarray, float, float]:
+        """
+        Drops a counter in column `action`, checks for a winner and for a draw and returns the state
+        and the reward.
+
+        Args:
+            - `action`: a valid column index
+
+        Returns:
+            - A tuple of numpy arrays with the new state and the reward
+        """
+        row = self.heights[action]
+        if row >= self.params['observation_space']:
+            raise ValueError(f"Column {action} is full.")
+        self.board[self.params['observation_space'] - 1 - row, action] = self.turn
+        self.bitboards[self.turn - 1] |= 1 << (action * self.bitboard_height + row)
+        self.heights[action] = row + 1
+        self.num_counters += 1
+        self._check_winner()._check_draw()
+        reward = self._get_reward()
+        return self.board.copy(), reward, float(self.is_done)
+
+    def _get_reward(self) -> float:
+        """
+        Returns the obtained reward. It only penalizes rolongations after eight total moves.
+
+        Returns:
+            - The reward.
+        """
+        if (self.is_done):
+            if (self.winner is None):  # if draw
+                return self.params['rewards']['draw']
+            else:  # if win
+                return self.params['rewards']['win']
+        else:  # do not penalize if players have not played at least 4 times
+            return self.params['rewards']['prolongation'] if self.num_counters > 8 else 0.
+
+    def _check_draw(self) -> None:
+        """
+        Checks if the board is full. If it is, it sets `is_done` to True.
+        """
+        if (self.winner is None) & (self.num_counters == self.board.size):
+            self.is_done = True
+
+    def _check_winner(self):
+        """
+        Checks whether the counters of the player in turn, i.e. the only ones that may have changed,
+        contain four aligned counters. If they do, sets `is_done` to True and `winner` to the player in turn.
+        """
+        if is_win(self.bitboards[self.turn - 1], self.params['observation_space']):
+            self.is_done = True
+            self.winner = self.turn
+        return self
+
+    def _reset(self) -> None:
+        """
+        Sets board, bitboards, column heights, is_done flag, turn and winner to their initial state
+        """
+        super()._reset()
+        self.bitboards = [0, 0]
+        self.heights = [0] * self.params['action_space']
+        self.num_counters = 0
+
+
+class VectorConnectFourEnv:
+    """
+    Batch of `num_envs` Connect Four games kept in bitboards, which are all stepped at once from an array
+    of actions. Unlike `ConnectFourEnv`, turns are switched by `step` and finished games are reset automatically.
+    """
+
+    def __init__(self, params: ParamsEnv, num_envs: int, device: torch.device):
+        self.device = device
+        self.params = params
+        self.num_envs = num_envs
+        self.rows = params['observation_space']
+        self.cols = params['action_space']
+        self.bitboard_height = get_bitboard_height(self.rows, self.cols)
+        self.bitboards = np.zeros(shape=[num_envs, 2], dtype=np.uint64)
+        self.heights = np.zeros(shape=[num_envs, self.cols], dtype=np.int8)
+        self.num_counters = np.zeros(shape=[num_envs], dtype=np.int8)
+        self.observations = np.zeros(
+            shape=[num_envs, self.rows, self.cols], dtype=np.int8)
+        self.turns = np.ones(shape=[num_envs], dtype=np.int8)
+
+    def get_valid_actions(self) -> np.ndarray:
+        """
+        Returns a boolean array of shape (num_envs, action_space) with the valid actions of every board.
+        """
+        return self.heights < self.rows
+
+    def reset(self) -> np.ndarray:
+        """
+        Resets all the games and returns a copy of the current states.
+        """
+        self._reset(np.ones(shape=[self.num_envs], dtype=bool))
+        return self.observations.copy()
+
+    def step(self, actions: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, dict[str, np.ndarray]]:
+        """
+        Drops a counter of the player in turn in every game, checks for winners and draws, switches the
+        turn of the unfinished games and resets the finished ones. Invalid actions end the game with a
+        `loss` reward and leave the board untouched.
+
+        Args:
+            - `actions`: array of shape (num_envs) with a column index per game.
+
+        Returns:
+            - A tuple with the new states, the rewards, the done flags and the valid actions masks of every
+            game, and a dictionary with the `final_observations` (the states before the automatic reset),
+            the `winners` (0 if there is none) and the `invalid` actions masks.
+        """
+        envs = np.arange(self.num_envs)
+        rows = self.heights[envs, actions]
+        invalid = rows >= self.rows
+        valid_envs, valid_actions, valid_rows = envs[~invalid], actions[~invalid], rows[~invalid]
+        players = self.turns[valid_envs]
+        bits = np.uint64(1) << (valid_actions.astype(np.uint64) * np.uint64(self.bitboard_height) +
+                                valid_rows.astype(np.uint64))
+        self.bitboards[valid_envs, players - 1] |= bits
+        self.heights[valid_envs, valid_actions] += 1
+        self.num_counters[valid_envs] += 1
+        self.observations[valid_envs, self.rows - 1 -
+                          valid_rows, valid_actions] = players
+
+        wins = np.zeros(shape=[self.num_envs], dtype=bool)
+        wins[valid_envs] = are_wins(
+            self.bitboards[valid_envs, players - 1], self.rows)
+        draws = ~wins & ~invalid & (
+            self.num_counters == self.rows * self.cols)
+        dones = invalid | wins | draws
+
+        rewards = np.where(self.num_counters > 8,
+                           self.params['rewards']['prolongation'], 0.)
+        rewards[wins] = self.params['rewards']['win']
+        rewards[draws] = self.params['rewards']['draw']
+        rewards[invalid] = self.params['rewards']['loss']
+        info = {
+            'final_observations': self.observations.copy(),
+            'winners': np.where(wins, self.turns, 0).astype(np.int8),
+            'invalid': invalid
+        }
+
+        self.turns[~dones] = 3 - self.turns[~dones]
+        self._reset(dones)
+        return self.observations.copy(), rewards, dones, self.get_valid_actions(), info
+
+    def _reset(self, envs: np.ndarray) -> None:
+        """
+        Sets the boards, bitboards, column heights and turns of the games in the boolean mask `envs`
+        to their initial state.
+        """
+        self.bitboards[envs] = 0
+        self.heights[envs] = 0
+        self.num_counters[envs] = 0
+        self.observations[envs] = 0
+        self.turns[envs] = 1
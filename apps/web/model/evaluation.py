@@ -0,0 +1,511 @@
+import io
+import numpy as np
+import queue
+import random
+import torch
+import torch.nn as nn
+import traceback
+from agent import DQNAgent
+from constants import finishes_boards_solutions, blocks_boards_solutions
+from custom_types import ParamsAgent, ParamsEnv, ParamsEval
+from env import BitboardConnectFourEnv, ConnectFourEnv, VectorConnectFourEnv
+from replay import ExperienceReplay
+from functools import lru_cache
+from move_quality import get_phase_bounds, load_move_quality
+from puzzles import load_puzzles
+from typing import Any, Callable, List
+from utils import get_two_channels
+
+
+class AsyncEvaluator:
+    """
+    Runs `evaluate` in a background process on snapshots of the policy weights, so that training never
+    waits for an evaluation. Evaluations are returned in the order the snapshots were submitted, tagged
+    with the episode at which the snapshot was taken and the training metrics recorded with it.
+
+    At most `max_queued` snapshots wait to be evaluated, so if evaluating is slower than training, the
+    oldest snapshot still waiting is dropped for every new one, and its evaluation is never returned.
+    If the background process fails or dies, the next call to `collect` raises a RuntimeError.
+    """
+
+    def __init__(self, net: nn.Module, params_agent: ParamsAgent, params_env: ParamsEnv, params_eval: ParamsEval,
+                 max_queued: int = 2) -> None:
+        context = torch.multiprocessing.get_context('spawn')
+        self.num_pending = 0
+        self.num_dropped = 0
+        self._snapshots = context.Queue(maxsize=max_queued)
+        self._evaluations = context.Queue()
+        # training metrics of the snapshots not evaluated yet, which never leave this process
+        self._metrics: dict[int, Any] = {}
+        self._process = context.Process(
+            target=_run_evaluator,
+            kwargs={
+                'net': _to_bytes(net),
+                'params_agent': params_agent,
+                'params_env': params_env,
+                'params_eval': params_eval,
+                'snapshots': self._snapshots,
+                'evaluations': self._evaluations,
+                'seed': random.randrange(2 ** 32)
+            },
+            daemon=True
+        )
+        self._process.start()
+
+    def submit(self, episode: int, policy: nn.Module, metrics: Any = None) -> None:
+        """
+        Sends a snapshot of the weights of `policy` to be evaluated, dropping the oldest snapshot still
+        waiting if there are already `max_queued`.
+
+        Args:
+            - `episode`: episode at which the snapshot is taken.
+            - `policy`: the policy to evaluate.
+            - `metrics`: training metrics at the time of the snapshot, returned with its evaluation.
+        """
+        snapshot = (episode, _to_bytes(policy.state_dict()))
+        while True:
+            try:
+                self._snapshots.put_nowait(snapshot)
+                break
+            except queue.Full:
+                try:
+                    stale_episode, _ = self._snapshots.get_nowait()
+                except queue.Empty:
+                    # the background process took it in the meantime
+                    continue
+                del self._metrics[stale_episode]
+                self.num_pending -= 1
+                self.num_dropped += 1
+        self._metrics[episode] = metrics
+        self.num_pending += 1
+
+    def collect(self, block: bool = False) -> List[tuple[int, list, Any]]:
+        """
+        Returns the evaluations finished so far, or waits for all the pending ones if `block` is True.
+
+        Returns:
+            - List of tuples with the episode of the snapshot, the evaluation metrics and the training
+            metrics submitted with the snapshot.
+        """
+        evaluations = []
+        while self.num_pending > 0:
+            try:
+                episode, evaluation = self._evaluations.get(timeout=0.1) if block else \
+                    self._evaluations.get_nowait()
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(
+                        f"The evaluator process has died with exit code {self._process.exitcode}.")
+                if block:
+                    continue
+                break
+            if episode is None:
+                # the background process failed and sent its traceback
+                raise RuntimeError(f"The evaluator process has failed:\n{evaluation}")
+            evaluations.append((episode, evaluation, self._metrics.pop(episode)))
+            self.num_pending -= 1
+        return evaluations
+
+    def close(self, wait: bool = True) -> List[tuple[int, list, Any]]:
+        """
+        Stops the background process.
+
+        Args:
+            - `wait`: whether to wait for the pending evaluations, or to discard them.
+
+        Returns:
+            - The evaluations which had not been collected yet.
+        """
+        evaluations = self.collect(block=True) if wait else []
+        if self._process.is_alive():
+            # discard the snapshots still waiting, so that there is room for the sentinel
+            try:
+                while True:
+                    self._snapshots.get_nowait()
+            except queue.Empty:
+                pass
+            self._snapshots.put(None)
+            self._process.join(timeout=10)
+            if self._process.is_alive():
+                self._process.terminate()
+        # snapshots still on their way to a dead process would otherwise keep this one from exiting
+        self._snapshots.cancel_join_thread()
+        if self.num_dropped > 0:
+            print(f"{self.num_dropped} snapshots were not evaluated since evaluating was slower than training")
+        self.num_pending = 0
+        self._metrics.clear()
+        return evaluations
+
+
+class PuzzleSuite:
+    """
+    Set of puzzle boards with their solutions, stored as tensors on `device` together with the masks
+    of legal moves, so that the whole suite is scored with a few forward passes of `batch_size` boards.
+    """
+
+    def __init__(self, boards: np.ndarray, solutions: np.ndarray, device: torch.device, batch_size: int = 8192) -> None:
+        self.batch_size = batch_size
+        self.observations = torch.tensor(
+            data=get_two_channels(boards),
+            dtype=torch.float,
+            device=device
+        )
+        # a column is legal while its top cell is empty
+        self.valid_actions = torch.tensor(boards[:, 0] == 0, device=device)
+        self.solutions = torch.tensor(solutions, device=device)
+
+    def __len__(self) -> int:
+        return len(self.observations)
+
+    def score(self, policy: Callable[[torch.Tensor], torch.Tensor]) -> float:
+        """
+        Returns the percentage of puzzles in which `policy` picks a solution among the legal moves.
+
+        Args:
+            - `policy`: the policy to score, or any other forward pass of it, e.g. an inference backend.
+
+        Returns:
+            - Percentage of solved puzzles.
+        """
+        num_solved = 0.
+        with torch.no_grad():
+            for start in range(0, len(self), self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                outputs = policy(self.observations[batch]).masked_fill(
+                    ~self.valid_actions[batch], -torch.inf)
+                actions = outputs.argmax(dim=1, keepdim=True)
+                num_solved += self.solutions[batch].gather(1, actions).sum().item()
+        return num_solved / len(self) * 100
+
+
+class MoveQualitySuite:
+    """
+    Set of positions labelled with the score of every legal move, stored as tensors on `device`, which
+    measures how close the moves picked by a policy are to the best ones with a few forward passes of
+    `batch_size` boards. A move is optimal if it has the best score, and a blunder if it changes the
+    outcome for the worse, i.e. it turns a win into a draw or a loss, or a draw into a loss.
+    """
+
+    def __init__(self, boards: np.ndarray, scores: np.ndarray, device: torch.device, batch_size: int = 8192) -> None:
+        self.batch_size = batch_size
+        self.observations = torch.tensor(
+            data=get_two_channels(boards),
+            dtype=torch.float,
+            device=device
+        )
+        # a column is legal while its top cell is empty
+        self.valid_actions = torch.tensor(boards[:, 0] == 0, device=device)
+        self.scores = torch.tensor(scores, dtype=torch.float, device=device)
+        self.best_scores = self.scores.masked_fill(~self.valid_actions, -torch.inf).max(dim=1).values
+        counters = torch.tensor((boards != 0).sum(axis=(1, 2)), device=device)
+        self.phases = [(counters >= start) & (counters < end)
+                       for start, end in get_phase_bounds(*boards.shape[1:])]
+
+    def __len__(self) -> int:
+        return len(self.observations)
+
+    def score(self, policy: Callable[[torch.Tensor], torch.Tensor]) -> list[float]:
+        """
+        Returns the percentage of positions in which `policy` picks an optimal move among the legal moves,
+        its average score loss, i.e. the difference between the best score and that of its move, and the
+        percentage of positions of the opening, the middle game and the endgame in which it blunders, which
+        is nan for the phases without positions.
+
+        Args:
+            - `policy`: the policy to score, or any other forward pass of it, e.g. an inference backend.
+
+        Returns:
+            - List with the percentage of optimal moves, the average score loss and the percentages of
+            blunders of every phase.
+        """
+        chosen_scores = []
+        with torch.no_grad():
+            for start in range(0, len(self), self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                outputs = policy(self.observations[batch]).masked_fill(
+                    ~self.valid_actions[batch], -torch.inf)
+                actions = outputs.argmax(dim=1, keepdim=True)
+                chosen_scores.append(self.scores[batch].gather(1, actions).squeeze(1))
+        scores = torch.cat(chosen_scores)
+        blunders = torch.sign(scores) < torch.sign(self.best_scores)
+        return [(scores == self.best_scores).sum().item() / len(self) * 100,
+                (self.best_scores - scores).sum().item() / len(self)] + \
+            [blunders[phase].sum().item() / phase.sum().item() * 100 if phase.any() else np.nan
+             for phase in self.phases]
+
+
+def evaluate(agent: DQNAgent, env: ConnectFourEnv, params: ParamsEval, device: torch.device) -> list:
+    """
+    Evaluates policy in `agent` agains a random agent in both turns, i.e. both strategies. If `vectorized`
+    is True, all the games are played at once in lockstep. If `move_quality_path` is given, the moves of the
+    policy in the positions labelled by the solver in that file are scored too.
+
+    Args:
+        - `agent`: agent of type `DQNAgent`.
+        - `env`: environment of type `ConnectFourEnv`.
+        - `params`: object of type `ParamsEval` with the evaluation parameters.
+        - `device`: torch device.
+
+    Returns:
+        - A list with the evaluation metrics.
+    """
+    agent.net.policy.eval()
+    # act with the current weights
+    agent.inference.refresh()
+    if params.get('vectorized', False):
+        episodes_rewards, episodes_steps, rates = _play_games_in_lockstep(
+            agent=agent,
+            params_env=env.params,
+            params=params,
+            device=device
+        )
+
+    else:
+        episodes_rewards, episodes_steps, rates = _play_games(
+            agent=agent,
+            env=env,
+            params=params
+        )
+
+    values, counts = np.unique(rates, return_counts=True)
+    value_counts = dict(zip(values, counts))
+    win_rate = value_counts[1] / \
+        len(rates) if 1 in value_counts else 0
+    draw_rate = value_counts[0] / len(rates) if 0 in value_counts else 0
+    loss_rate = 1 - win_rate - draw_rate
+
+    finish_suite, block_suite = get_puzzle_suites(device, params.get('puzzles_path'))
+    with agent.autocast():
+        finish_perc = finish_suite.score(agent.inference)
+        block_perc = block_suite.score(agent.inference)
+
+    evaluation = [np.median(episodes_rewards), np.mean(episodes_rewards), np.std(episodes_rewards), np.median(
+        episodes_steps),  np.mean(episodes_steps), np.std(episodes_steps),
+        win_rate, loss_rate, draw_rate, finish_perc, block_perc]
+    if params.get('move_quality_path') is not None:
+        with agent.autocast():
+            evaluation += get_move_quality_suite(device, params['move_quality_path']).score(agent.inference)
+    agent.net.policy.train()
+    return evaluation
+
+
+@lru_cache(maxsize=None)
+def get_move_quality_suite(device: torch.device, move_quality_path: str) -> MoveQualitySuite:
+    """
+    Returns the suite of the positions labelled by `move_quality.py` on `device`, which is built only once
+    per device and path, i.e. the positions are loaded on the first evaluation.
+
+    Args:
+        - `device`: torch device.
+        - `move_quality_path`: path to the labelled positions.
+
+    Returns:
+        - The move quality suite.
+    """
+    return MoveQualitySuite(*load_move_quality(move_quality_path), device)
+
+
+@lru_cache(maxsize=None)
+def get_puzzle_suites(device: torch.device, puzzles_path: str | None = None) -> tuple[PuzzleSuite, PuzzleSuite]:
+    """
+    Returns the finish and block puzzle suites on `device`, which are built only once per device and path,
+    i.e. the puzzles are loaded on the first evaluation.
+
+    Args:
+        - `device`: torch device.
+        - `puzzles_path`: path to the puzzles generated by `puzzles.py`, if None, those in `constants.py`.
+
+    Returns:
+        - Tuple with the finish and the block puzzle suites.
+    """
+    if puzzles_path is not None:
+        suites = load_puzzles(puzzles_path)
+        return PuzzleSuite(*suites['finishes'], device), PuzzleSuite(*suites['blocks'], device)
+
+    return PuzzleSuite(*_to_arrays(finishes_boards_solutions), device), \
+        PuzzleSuite(*_to_arrays(blocks_boards_solutions), device)
+
+
+def _play_games(agent: DQNAgent, env: ConnectFourEnv, params: ParamsEval) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Plays `episodes` games one by one between the policy in `agent` and a random agent.
+
+    Args:
+        - `agent`: agent of type `DQNAgent`.
+        - `env`: environment of type `ConnectFourEnv`.
+        - `params`: object of type `ParamsEval` with the evaluation parameters.
+
+    Returns:
+        - Array with the rewards of the agent in every game.
+        - Array with the steps of every game.
+        - Array with the result of every game for the agent: 1 if won, 0 if drawn and -1 if lost.
+    """
+    episodes_rewards = []
+    episodes_steps = []
+    rates = np.zeros([params['episodes']], dtype=np.int8)
+    for episode in range(0, params['episodes']):
+        player = np.random.choice([1, 2])
+        state = env.reset()
+        episode_rewards = 0.
+        episode_steps = 0
+        while True:
+            valid_actions = env.get_valid_actions()
+            if player == env.turn:
+                action = agent.exploit(
+                    state, valid_actions, params['enforce_valid_action'])
+                if not params['enforce_valid_action'] and action not in valid_actions:
+                    episode_rewards += env.params['rewards']['loss']
+                    episodes_rewards.append(episode_rewards)
+                    episodes_steps.append(episode_steps)
+                    rates[episode] = -1
+                    break
+
+            else:
+                action = np.random.choice(valid_actions)
+
+            next_state, reward, is_done = env.step(action)
+            episode_steps += 1
+            if is_done:
+                if env.winner == player:
+                    episode_rewards += reward
+
+                episodes_rewards.append(episode_rewards)
+                episodes_steps.append(episode_steps)
+                rates[episode] = 0 if env.winner is None else 1 if env.winner == player else -1
+                break
+
+            if env.turn == player:
+                episode_rewards += reward
+
+            state = next_state
+            env.switch_turn()
+
+    return np.array(episodes_rewards), np.array(episodes_steps), rates
+
+
+def _play_games_in_lockstep(agent: DQNAgent, params_env: ParamsEnv, params: ParamsEval,
+                            device: torch.device) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Plays `episodes` games at once between the policy in `agent` and a random agent, with a single
+    forward pass per ply for all the games in which it is the turn of the agent and vectorized random
+    moves for the rest. The rewards, steps and results are computed as in `_play_games`.
+
+    Args:
+        - `agent`: agent of type `DQNAgent`.
+        - `params_env`: `ParamsEnv` object with the parameters of the environment.
+        - `params`: object of type `ParamsEval` with the evaluation parameters.
+        - `device`: torch device.
+
+    Returns:
+        - Array with the rewards of the agent in every game.
+        - Array with the steps of every game.
+        - Array with the result of every game for the agent: 1 if won, 0 if drawn and -1 if lost.
+    """
+    env = VectorConnectFourEnv(
+        params=params_env,
+        num_envs=params['episodes'],
+        device=device
+    )
+    players = np.random.choice([1, 2], size=params['episodes'])
+    episodes_rewards = np.zeros([params['episodes']], dtype=np.float64)
+    episodes_steps = np.zeros([params['episodes']], dtype=np.int64)
+    rates = np.zeros([params['episodes']], dtype=np.int8)
+    # games which have not finished yet, finished games are reset by the environment and ignored
+    playing = np.ones([params['episodes']], dtype=bool)
+    states = env.reset()
+    valid_actions = env.get_valid_actions()
+    while playing.any():
+        agent_turn = playing & (env.turns == players)
+        # random valid actions for the rest of the games
+        actions = np.argmax(np.random.random(
+            valid_actions.shape) * valid_actions, axis=1)
+        if agent_turn.any():
+            actions[agent_turn] = agent.exploit_batch(
+                states[agent_turn], valid_actions[agent_turn], params['enforce_valid_action'])
+        states, rewards, dones, valid_actions, info = env.step(actions)
+
+        # only the agent can take invalid actions, which are lost games that do not count as a step
+        invalid = playing & info['invalid']
+        episodes_rewards[invalid] += params_env['rewards']['loss']
+        rates[invalid] = -1
+        stepped = playing & ~info['invalid']
+        episodes_steps[stepped] += 1
+        finished = stepped & dones
+        won = finished & (info['winners'] == players)
+        episodes_rewards[won] += rewards[won]
+        rates[finished] = np.where(
+            info['winners'][finished] == 0, 0, np.where(won[finished], 1, -1))
+        ongoing = stepped & ~dones
+        episodes_rewards[ongoing & agent_turn] += rewards[ongoing & agent_turn]
+        playing &= ~dones
+
+    return episodes_rewards, episodes_steps, rates
+
+
+def _run_evaluator(net: bytes, params_agent: ParamsAgent, params_env: ParamsEnv, params_eval: ParamsEval,
+                   snapshots, evaluations, seed: int) -> None:
+    """
+    Background process of `AsyncEvaluator`: evaluates every snapshot of weights received in `snapshots`
+    and puts the episode and the evaluation metrics in `evaluations`, until it receives None. If it
+    fails, it puts None and the traceback instead and stops.
+
+    Args:
+        - `net`: serialized network.
+        - `params_agent`: `ParamsAgent` object with the parameters of the agent.
+        - `params_env`: `ParamsEnv` object with the parameters of the environment.
+        - `params_eval`: `ParamsEval` object with the parameters of the evaluations.
+        - `snapshots`: queue with the episodes and serialized weights to evaluate.
+        - `evaluations`: queue where the episodes and evaluation metrics are put.
+        - `seed`: seed of the random number generators of the process.
+    """
+    try:
+        # leave the rest of the cores to training
+        torch.set_num_threads(1)
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        device = torch.device('cpu')
+        agent = DQNAgent(
+            net=torch.load(io.BytesIO(net), map_location=device, weights_only=False),
+            params=params_agent,
+            device=device,
+            # evaluations do not use the memory
+            memory=ExperienceReplay(maxlen=1, batch_size=1)
+        )
+        env = BitboardConnectFourEnv(
+            params=params_env,
+            device=device
+        )
+        while (snapshot := snapshots.get()) is not None:
+            episode, state_dict = snapshot
+            agent.net.policy.load_state_dict(torch.load(
+                io.BytesIO(state_dict), map_location=device))
+            evaluations.put((episode, evaluate(
+                agent=agent,
+                env=env,
+                params=params_eval,
+                device=device
+            )))
+    except BaseException:
+        evaluations.put((None, traceback.format_exc()))
+
+
+def _to_arrays(boards_solutions: list) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the stacked boards and the masks of the solutions of a list of boards and solutions.
+    """
+    boards = np.stack([board for board, _ in boards_solutions])
+    solutions = np.zeros(shape=[len(boards), boards.shape[-1]], dtype=bool)
+    for i, (_, solution) in enumerate(boards_solutions):
+        # a puzzle can be solved by any of the given actions
+        solutions[i, solution] = True
+    return boards, solutions
+
+
+def _to_bytes(obj: object) -> bytes:
+    """
+    Serializes `obj` with `torch.save`.
+    """
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.getvalue()
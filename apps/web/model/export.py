@@ -0,0 +1,319 @@
+import importlib.util
+import inspect
+import io
+import json
+import numpy as np
+import onnx
+import time
+import torch
+import torch.nn as nn
+import warnings
+from constants import blocks_boards_solutions, finishes_boards_solutions
+from modules import fuse_for_inference
+from os.path import basename, getsize, join
+from pathlib import Path
+from puzzles import play_games
+from typing import Any, Callable
+from utils import get_two_channels
+
+
+def export_onnx(policy: nn.Module, policies_dir_path: str, model_id: str, device: torch.device, opset_version: int = 17,
+                optimize: bool = True, quantize: bool = True, num_runs: int = 1000) -> dict:
+    """
+    Exports a policy into ONNX format to `policies_dir_path`, with a dynamic batch dimension. If `optimize`
+    is True, the graph is optimized offline by ONNX Runtime with the basic, hardware-independent
+    optimizations, e.g. constant folding and redundant node elimination, and if `quantize` is True,
+    an int8 sibling `{model_id}.int8.onnx` is written whose matrix multiplications have dynamically
+    quantized weights. Both require the optional `onnxruntime` package, without it only the unoptimized
+    model is saved.
+
+    A manifest `{model_id}.json` is written next to the models, with the file size, the input and output
+    signature and the median CPU latency at batch size 1 of every variant, if `onnxruntime` is installed.
+
+    Args:
+        - `policy`: model to be exported
+        - `policies_dir_path`: path to the policies directory
+        - `model_id`: id of the model
+        - `device`: torch device.
+        - `opset_version`: ONNX opset.
+        - `optimize`: whether to optimize the graph.
+        - `quantize`: whether to write the int8 variant.
+        - `num_runs`: number of runs to measure the latency.
+
+    Returns:
+        - The manifest.
+    """
+    Path(policies_dir_path).mkdir(
+        parents=True,
+        exist_ok=True
+    )
+    file_path = join(policies_dir_path, f'{model_id}.onnx')
+    model = export_to_bytes(policy.to(device), opset_version)
+    try:
+        import onnxruntime  # type: ignore[import-untyped]
+    except ImportError:
+        onnxruntime = None
+        if optimize or quantize:
+            warnings.warn(
+                "Optimizing and quantizing ONNX models requires onnxruntime, install it with "
+                "`poetry run pip install onnxruntime`. Saving the unoptimized model only.")
+            optimize = quantize = False
+
+    if optimize:
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC
+        # the session writes the optimized graph to this file when it is created
+        options.optimized_model_filepath = file_path
+        onnxruntime.InferenceSession(
+            model, sess_options=options, providers=['CPUExecutionProvider'])
+    else:
+        with open(file_path, 'wb') as file:
+            file.write(model)
+    variants = [(file_path, False)]
+    print(f"Model in ONNX format saved to {file_path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic  # type: ignore[import-untyped]
+
+        quantized_file_path = join(policies_dir_path, f'{model_id}.int8.onnx')
+        # convolutions are left in float32, since few runtimes have integer convolutions, e.g. the web ones
+        quantize_dynamic(
+            model_input=file_path,
+            model_output=quantized_file_path,
+            op_types_to_quantize=['MatMul', 'Gemm'],
+            weight_type=QuantType.QInt8
+        )
+        variants.append((quantized_file_path, True))
+        print(f"Quantized model in ONNX format saved to {quantized_file_path}")
+
+    manifest = {
+        'model_id': model_id,
+        'opset_version': opset_version,
+        'optimized': optimize,
+        'variants': [_describe(path, quantized, num_runs if onnxruntime is not None else 0)
+                     for path, quantized in variants]
+    }
+    manifest_path = join(policies_dir_path, f'{model_id}.json')
+    with open(manifest_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    print(f"Manifest saved to {manifest_path}")
+    return manifest
+
+
+def export_to_bytes(policy: nn.Module, opset_version: int = 17) -> bytes:
+    """
+    Exports `policy` in evaluation mode, with its batch normalizations folded by `fuse_for_inference`, to
+    ONNX with a dynamic batch dimension, with input `input` and output `output`. The graph is float32 even
+    if the policy is trained with autocast.
+
+    Args:
+        - `policy`: the policy.
+        - `opset_version`: ONNX opset.
+
+    Returns:
+        - The serialized ONNX model.
+    """
+    parameter = next(policy.parameters())
+    dummy_input = torch.zeros(
+        [1, 2, 6, 7], dtype=torch.float, device=parameter.device)
+    buffer = io.BytesIO()
+    # newer versions of torch default to the dynamo exporter, which does not export to a buffer
+    kwargs: dict[str, Any] = {'dynamo': False} if 'dynamo' in inspect.signature(
+        torch.onnx.export).parameters else {}
+    with torch.autocast(device_type=parameter.device.type, enabled=False):
+        torch.onnx.export(
+            fuse_for_inference(policy),
+            (dummy_input,),
+            buffer,  # type: ignore[arg-type]
+            export_params=True,
+            opset_version=opset_version,
+            do_constant_folding=True,
+            input_names=['input'],
+            output_names=['output'],
+            dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+            **kwargs
+        )
+    return buffer.getvalue()
+
+
+def verify_onnx(policy: nn.Module, policies_dir_path: str, model_id: str, device: torch.device,
+                num_positions: int = 10000, batch_sizes: tuple[int, ...] = (1, 8, 64, 512), num_runs: int = 200,
+                atol: float = 1e-4, min_agreement: float = 0.98, seed: int = 0) -> dict | None:
+    """
+    Checks every variant in the manifest written by `export_onnx` against `policy`, on the finish and
+    block puzzle boards and on `num_positions` legal positions reached by random play. A variant passes if
+    its greedy legal action agrees with that of the policy in at least a fraction `min_agreement` of the
+    positions and, unless it is quantized, its Q values are within `atol` of those of the policy.
+
+    The median and 99th percentile latencies of the policy, in PyTorch on `device`, and of every variant,
+    in ONNX Runtime on one CPU thread, are measured for every batch size in `batch_sizes`. The report is
+    saved as `{model_id}.verification.json` next to the models. Variants which fail are deleted and removed
+    from the manifest, so that they are never shipped, and if none passes an error is raised. Requires the
+    optional `onnxruntime` package, without it the verification is skipped.
+
+    Args:
+        - `policy`: the exported policy.
+        - `policies_dir_path`: path to the policies directory.
+        - `model_id`: id of the model.
+        - `device`: torch device.
+        - `num_positions`: number of random positions.
+        - `batch_sizes`: batch sizes at which the latency is measured.
+        - `num_runs`: number of runs to measure the latency at every batch size.
+        - `atol`: maximum absolute difference of the Q values of the unquantized variants.
+        - `min_agreement`: minimum fraction of positions with the same greedy action.
+        - `seed`: seed of the random play.
+
+    Returns:
+        - The report, or None if it is skipped.
+    """
+    if importlib.util.find_spec('onnxruntime') is None:
+        warnings.warn(
+            "Verifying ONNX models requires onnxruntime, install it with `poetry run pip install onnxruntime`.")
+        return None
+
+    manifest_path = join(policies_dir_path, f'{model_id}.json')
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    states = _get_positions(num_positions, seed)
+    # a column is legal while its top cell is empty
+    valid_actions = (states[:, :, 0] == 0).all(axis=1)
+
+    training = policy.training
+    policy.eval()
+    try:
+        with torch.no_grad(), torch.autocast(device_type=device.type, enabled=False):
+            def forward(states: np.ndarray) -> np.ndarray:
+                return policy(torch.from_numpy(states).to(device)).cpu().numpy()
+
+            expected = forward(states)
+            policy_latencies = {size: _measure_latency(forward, size, num_runs) for size in batch_sizes}
+    finally:
+        policy.train(training)
+    expected_actions = np.where(valid_actions, expected, -np.inf).argmax(axis=1)
+
+    variants = []
+    for variant in manifest['variants']:
+        run = _get_runner(_create_session(join(policies_dir_path, variant['file'])))
+        outputs = run(states)
+        actions = np.where(valid_actions, outputs, -np.inf).argmax(axis=1)
+        max_abs_diff = float(np.abs(outputs - expected).max())
+        agreement = float((actions == expected_actions).mean())
+        variants.append({
+            'file': variant['file'],
+            'max_abs_diff': max_abs_diff,
+            'mean_abs_diff': float(np.abs(outputs - expected).mean()),
+            'action_agreement': agreement,
+            'passed': agreement >= min_agreement and (variant['quantized'] or max_abs_diff <= atol),
+            'latency_us': {size: _measure_latency(run, size, num_runs) for size in batch_sizes}
+        })
+
+    report = {
+        'model_id': model_id,
+        'num_positions': len(states),
+        'atol': atol,
+        'min_agreement': min_agreement,
+        'policy': {'device': device.type, 'latency_us': policy_latencies},
+        'variants': variants
+    }
+    report_path = join(policies_dir_path, f'{model_id}.verification.json')
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    for variant in variants:
+        print(f"{variant['file']}: {'passed' if variant['passed'] else 'failed'}, max abs diff "
+              f"{variant['max_abs_diff']:.2e}, action agreement {variant['action_agreement']:.2%}")
+    print(f"Verification report saved to {report_path}")
+
+    failed = {variant['file'] for variant in variants if not variant['passed']}
+    if len(failed) == len(variants):
+        raise RuntimeError(f"No ONNX variant of {model_id} passed the verification, see {report_path}.")
+    if failed:
+        for file_name in failed:
+            Path(join(policies_dir_path, file_name)).unlink(missing_ok=True)
+        manifest['variants'] = [variant for variant in manifest['variants'] if variant['file'] not in failed]
+        with open(manifest_path, 'w') as file:
+            json.dump(manifest, file, indent=2)
+        print(f"Failed variants {', '.join(sorted(failed))} removed from {manifest_path}")
+    return report
+
+
+def _create_session(file_path: str) -> Any:
+    """
+    Returns an ONNX Runtime CPU session of the model in `file_path` run on a single thread.
+    """
+    import onnxruntime  # type: ignore[import-untyped]
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = 1
+    options.inter_op_num_threads = 1
+    return onnxruntime.InferenceSession(
+        file_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def _describe(file_path: str, quantized: bool, num_runs: int) -> dict:
+    """
+    Returns the file name, size, signature and latency, measured if `num_runs` is positive, of the ONNX
+    model in `file_path`.
+    """
+    model = onnx.load(file_path)
+    return {
+        'file': basename(file_path),
+        'quantized': quantized,
+        'size_bytes': getsize(file_path),
+        'inputs': [_get_signature(value) for value in model.graph.input],
+        'outputs': [_get_signature(value) for value in model.graph.output],
+        'latency_us': _measure_latency(_get_runner(_create_session(file_path)), 1, num_runs)['p50'] if num_runs > 0 else None
+    }
+
+
+def _get_positions(num_positions: int, seed: int) -> np.ndarray:
+    """
+    Returns the finish and block puzzle boards followed by `num_positions` legal positions reached by
+    random play, as two-channel float32 states.
+    """
+    num_envs = max(min(num_positions, 256), 1)
+    positions = [env.observations.copy()
+                 for env, _, _ in play_games(seed, num_envs, num_steps=-(-num_positions // num_envs))]
+    puzzles = np.stack([board for board, _ in finishes_boards_solutions + blocks_boards_solutions])
+    boards = np.concatenate([puzzles, *positions])[:len(puzzles) + num_positions]
+    return get_two_channels(boards).astype(np.float32)
+
+
+def _get_runner(session: Any) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Returns a function that runs the ONNX Runtime `session` on a batch of states.
+    """
+    name = session.get_inputs()[0].name
+
+    def run(states: np.ndarray) -> np.ndarray:
+        return session.run(None, {name: states})[0]
+
+    return run
+
+
+def _get_signature(value: onnx.ValueInfoProto) -> dict:
+    """
+    Returns the name, type and shape, with the names of the dynamic dimensions, of a graph input or output.
+    """
+    tensor_type = value.type.tensor_type
+    return {
+        'name': value.name,
+        'dtype': onnx.TensorProto.DataType.Name(tensor_type.elem_type).lower(),
+        'shape': [dim.dim_param if dim.dim_param else dim.dim_value for dim in tensor_type.shape.dim]
+    }
+
+
+def _measure_latency(run: Callable[[np.ndarray], Any], batch_size: int, num_runs: int) -> dict:
+    """
+    Returns the median and the 99th percentile latency in microseconds of `run` on a batch of
+    `batch_size` empty boards.
+    """
+    states = np.zeros([batch_size, 2, 6, 7], dtype=np.float32)
+    # warm up
+    run(states)
+    latencies = np.zeros(num_runs)
+    for i in range(num_runs):
+        start = time.perf_counter()
+        run(states)
+        latencies[i] = time.perf_counter() - start
+    p50, p99 = np.percentile(latencies * 1e6, [50, 99])
+    return {'p50': round(float(p50), 2), 'p99': round(float(p99), 2)}
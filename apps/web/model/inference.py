@@ -0,0 +1,144 @@
+import torch
+import torch.nn as nn
+from abc import ABC, abstractmethod
+from custom_types import Inference
+from export import export_to_bytes
+from modules import fuse_for_inference
+from typing import Callable
+
+
+class InferenceBackend(ABC):
+    """
+    Runtime that predicts the Q values of the policy on batches of two-channel states. Backends which
+    hold a copy of the weights must be told when those of the policy change, either with `update`,
+    after every optimization step, or with `refresh`, after the weights are replaced.
+    """
+
+    @abstractmethod
+    def __call__(self, states: torch.Tensor) -> torch.Tensor:
+        """
+        Predicts the Q values of `states`.
+
+        Args:
+            - `states`: float32 tensor of shape (N, 2, rows, cols).
+
+        Returns:
+            - Tensor of shape (N, action_space) on the device of `states`.
+        """
+
+    def refresh(self) -> None:
+        """
+        Brings the backend up to date with the current weights of the policy.
+        """
+
+    def update(self) -> None:
+        """
+        Notifies the backend that the weights of the policy have changed.
+        """
+
+
+class TorchBackend(InferenceBackend):
+    """
+    Runs the forward pass of the policy in PyTorch. By default `forward` is used, i.e. either the policy
+    itself or its compiled forward pass, so it is always up to date.
+
+    If `fuse` is True, it runs instead a copy of the policy in evaluation mode with its batch normalizations
+    folded into the convolutions, made by `fuse_for_inference` with `channels_last`, which is made again
+    every `refresh_period` calls to `update` or whenever `refresh` is called, so acting lags at most that
+    many optimization steps behind the policy.
+    """
+
+    def __init__(self, policy: nn.Module, forward: Callable[[torch.Tensor], torch.Tensor], fuse: bool = False,
+                 channels_last: bool = False, refresh_period: int = 100) -> None:
+        self.policy = policy
+        self.forward = forward
+        self.fuse = fuse
+        self.channels_last = channels_last
+        self.refresh_period = refresh_period
+        self._num_updates = 0
+        self.refresh()
+
+    def __call__(self, states: torch.Tensor) -> torch.Tensor:
+        if self.fuse and self.channels_last:
+            states = states.contiguous(memory_format=torch.channels_last)
+        return self.forward(states)
+
+    def refresh(self) -> None:
+        if self.fuse:
+            self.forward = fuse_for_inference(self.policy, self.channels_last)
+        self._num_updates = 0
+
+    def update(self) -> None:
+        if self.fuse:
+            self._num_updates += 1
+            if self._num_updates >= self.refresh_period:
+                self.refresh()
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """
+    Runs the policy in an ONNX Runtime CPU session built from an in-memory export of `policy`, with
+    `intra_op_num_threads` and `inter_op_num_threads` threads (0 lets ONNX Runtime decide). The policy
+    is exported again and the session swapped every `refresh_period` calls to `update`, so acting lags
+    at most that many optimization steps behind the policy, or whenever `refresh` is called.
+
+    Requires the optional `onnxruntime` package.
+    """
+
+    def __init__(self, policy: nn.Module, intra_op_num_threads: int = 1, inter_op_num_threads: int = 1,
+                 refresh_period: int = 100) -> None:
+        try:
+            import onnxruntime  # type: ignore[import-untyped]
+        except ImportError as error:
+            raise ImportError(
+                "The 'onnxruntime' inference backend requires onnxruntime, install it with "
+                "`poetry run pip install onnxruntime`.") from error
+
+        self.policy = policy
+        self.refresh_period = refresh_period
+        self._onnxruntime = onnxruntime
+        self._options = onnxruntime.SessionOptions()
+        self._options.intra_op_num_threads = intra_op_num_threads
+        self._options.inter_op_num_threads = inter_op_num_threads
+        self._num_updates = 0
+        self.refresh()
+
+    def __call__(self, states: torch.Tensor) -> torch.Tensor:
+        outputs = self._session.run(
+            None, {'input': states.detach().cpu().numpy()})[0]
+        return torch.from_numpy(outputs).to(states.device)
+
+    def refresh(self) -> None:
+        self._session = self._onnxruntime.InferenceSession(
+            export_to_bytes(self.policy),
+            sess_options=self._options,
+            providers=['CPUExecutionProvider']
+        )
+        self._num_updates = 0
+
+    def update(self) -> None:
+        self._num_updates += 1
+        if self._num_updates >= self.refresh_period:
+            self.refresh()
+
+
+def get_inference_backend(params: Inference, policy: nn.Module,
+                          forward: Callable[[torch.Tensor], torch.Tensor]) -> InferenceBackend:
+    """
+    Builds the inference backend `name` with the keyword arguments in `config`.
+
+    Args:
+        - `params`: `Inference` object with the name and the configuration of the backend.
+        - `policy`: the policy.
+        - `forward`: the forward pass of the policy in PyTorch, e.g. compiled.
+
+    Returns:
+        - The inference backend.
+    """
+    if params['name'] == 'torch':
+        return TorchBackend(policy, forward, **params['config'])
+
+    elif params['name'] == 'onnxruntime':
+        return OnnxRuntimeBackend(policy, **params['config'])
+
+    raise ValueError(f"Unknown inference backend {params['name']}.")
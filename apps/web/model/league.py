@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import json
+import math
+import modules
+import multiprocessing as mp
+import numpy as np
+import time
+import torch
+import torch.nn as nn
+from collections import defaultdict
+from constants import CHECKPOINTS_DIR_PATH, LEAGUE_PATH
+from custom_types import ParamsEnv
+from env import VectorConnectFourEnv
+from functools import lru_cache
+from glob import glob
+from os.path import dirname, exists, join
+from pathlib import Path
+from typing import Any, Literal
+from utils import encode_bitboards
+
+_openings: Any = None
+
+
+def fit_ratings(results: list[dict], players: list[str], num_bootstraps: int = 1000, confidence: float = 0.95,
+                prior: float = 1., seed: int = 0) -> dict[str, dict[str, float]]:
+    """
+    Fits the Bradley-Terry model to the results of the matches between `players`, in which a draw counts as
+    half a win for each player, and returns the ratings on the Elo scale, i.e. a difference of 400 points
+    means ten times the odds of winning, centered at 0. Every player also draws `prior` virtual games
+    against a player rated 0, so that the ratings of players who win or lose all their games stay finite.
+    The confidence intervals are the percentiles of the ratings fitted to `num_bootstraps` resamples of
+    the games of every match.
+
+    Args:
+        - `results`: list with the results of the matches, as returned by `run_league`.
+        - `players`: names of the players, results of the matches of other players are ignored.
+        - `num_bootstraps`: number of bootstrap resamples.
+        - `confidence`: confidence level of the intervals.
+        - `prior`: number of virtual draws of every player.
+        - `seed`: seed of the resamples.
+
+    Returns:
+        - Dictionary with the rating, the lower and the upper bound of its confidence interval, the number
+        of games and the score, i.e. the fraction of points won, of every player.
+    """
+    index = {player: i for i, player in enumerate(players)}
+    results = [result for result in results if all(player in index for player in result['players'])]
+    pairs = np.array([[index[player] for player in result['players']] for result in results],
+                     dtype=np.int64).reshape(-1, 2)
+    counts = np.array([[result['wins'], result['draws'], result['losses']] for result in results],
+                      dtype=np.int64).reshape(-1, 3)
+    ratings = _fit_bradley_terry(pairs, counts, len(players), prior)
+
+    rng = np.random.default_rng(seed)
+    games = counts.sum(axis=1)
+    probabilities = counts / np.maximum(games, 1)[:, None]
+    bootstraps = np.stack([
+        _fit_bradley_terry(pairs, rng.multinomial(games, probabilities), len(players), prior)
+        for _ in range(num_bootstraps)
+    ]) if len(results) > 0 else np.zeros((1, len(players)))
+    lower, upper = np.percentile(bootstraps, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+
+    num_games = np.zeros(len(players))
+    points = np.zeros(len(players))
+    for (a, b), (wins, draws, losses) in zip(pairs, counts):
+        num_games[[a, b]] += wins + draws + losses
+        points[a] += wins + draws / 2
+        points[b] += losses + draws / 2
+    return {
+        player: {
+            'rating': float(ratings[i]),
+            'lower': float(lower[i]),
+            'upper': float(upper[i]),
+            'games': int(num_games[i]),
+            'score': float(points[i] / num_games[i]) if num_games[i] > 0 else math.nan
+        } for i, player in enumerate(players)
+    }
+
+
+def load_policy(path: str, device: torch.device) -> nn.Module:
+    """
+    Loads the policy of a checkpoint saved by `DQNAgent.save`, whose network class is given by the prefix of
+    the model id, e.g. `ConnectFourNet` in `ConnectFourNet_2024_01_01_T_00_00_00.chkpt`, with its batch
+    normalizations folded into the convolutions.
+
+    Args:
+        - `path`: path to the checkpoint.
+        - `device`: torch device.
+
+    Returns:
+        - The policy in evaluation mode.
+    """
+    net_name = Path(path).stem.split('_')[0]
+    net_class = getattr(modules, net_name, None)
+    if not isinstance(net_class, type) or not issubclass(net_class, modules.Module):
+        raise ValueError(f"Unknown network {net_name} of the checkpoint {path}.")
+    net = net_class(7)
+    net.load_state_dict(torch.load(path, map_location=device)['state_dict'])
+    return modules.fuse_for_inference(net.policy)
+
+
+def load_results(path: str) -> list[dict]:
+    """
+    Loads the results of the matches written by `run_league`, without the settings of the league.
+
+    Args:
+        - `path`: path to the `.jsonl` file.
+
+    Returns:
+        - List with the results of the matches, or an empty list if the file does not exist.
+    """
+    return [record for record in _load_records(path) if 'settings' not in record]
+
+
+def run_league(checkpoint_paths: list[str], results_path: str, processes: int,
+               schedule: Literal['round-robin', 'swiss'] = 'round-robin', rounds: int | None = None,
+               num_openings: int = 50, opening_plies: int = 2, seed: int = 0) -> list[dict]:
+    """
+    Plays a league between the policies of `checkpoint_paths`, named after their model ids, either a single
+    round in which every player meets every other one, or `rounds` Swiss rounds, in which players with the
+    same points meet and no pair meets twice if it can be avoided, the last player without a bye sitting
+    out when the number of players is odd. The matches of every round are played across a pool of
+    `processes` processes. In every match both policies play greedily the same `num_openings` random
+    openings of `opening_plies` plies, once with each color, all the games of the match in lockstep, with
+    a single forward pass per policy and ply.
+
+    The result of every match is appended to `results_path` as soon as it ends, so a league stopped halfway
+    is resumed by running it again with the same arguments, which only plays the missing matches. The file
+    starts with the schedule and the settings of the openings, and a league is not resumed from a file
+    written with different ones, whose results would not be comparable.
+
+    Args:
+        - `checkpoint_paths`: paths to the checkpoints.
+        - `results_path`: path to the `.jsonl` file with the results.
+        - `processes`: number of processes.
+        - `schedule`: either 'round-robin' or 'swiss'.
+        - `rounds`: number of Swiss rounds, if None, the ceiling of the binary logarithm of the number of players.
+        - `num_openings`: number of openings of every match, at most all the sequences of `opening_plies` moves.
+        - `opening_plies`: number of random moves of every opening, fewer than those of the shortest game.
+        - `seed`: seed of the openings.
+
+    Returns:
+        - List with the results of the matches, which hold the round, the names of both players and the
+        wins, draws and losses of the first one.
+    """
+    if not 0 <= opening_plies < 7:
+        raise ValueError(f"The openings must have between 0 and 6 plies, got {opening_plies}.")
+    if schedule not in ('round-robin', 'swiss'):
+        raise ValueError(f"Unknown schedule {schedule}.")
+
+    paths = {Path(path).stem: path for path in checkpoint_paths}
+    players = list(paths)
+    rng = np.random.default_rng(seed)
+    sequences = np.array(list(itertools.product(range(7), repeat=opening_plies)), dtype=np.int64)
+    openings = sequences[rng.choice(len(sequences), size=min(num_openings, len(sequences)), replace=False)]
+    if schedule == 'round-robin':
+        num_rounds = 1
+    else:
+        num_rounds = rounds if rounds is not None else max(math.ceil(math.log2(len(players))), 1)
+
+    settings = {'num_openings': num_openings, 'opening_plies': opening_plies, 'schedule': schedule, 'seed': seed}
+    records = _load_records(results_path)
+    if records and records[0].get('settings') != settings:
+        raise ValueError(f"{results_path} was written by a league with settings {records[0].get('settings')}, "
+                         f"not {settings}, use another path.")
+
+    results = [result for result in records[1:] if all(player in paths for player in result['players'])]
+    Path(dirname(results_path) or '.').mkdir(
+        parents=True,
+        exist_ok=True
+    )
+    context = mp.get_context('spawn')
+    with context.Pool(processes, initializer=_init_worker, initargs=(openings,)) as pool, \
+            open(results_path, 'a') as file:
+        if not records:
+            file.write(json.dumps({'settings': settings}) + '\n')
+            file.flush()
+        for round_ in range(num_rounds):
+            if schedule == 'round-robin':
+                pairs = list(itertools.combinations(players, 2))
+            else:
+                pairs = _pair_swiss(players, [result for result in results if result['round'] < round_])
+            played = {frozenset(result['players']) for result in results if result['round'] == round_}
+            matches = [(round_, a, b, paths[a], paths[b]) for a, b in pairs if frozenset((a, b)) not in played]
+            start = time.perf_counter()
+            for result in pool.imap_unordered(_play_match, matches):
+                results.append(result)
+                file.write(json.dumps(result) + '\n')
+                file.flush()
+            if matches:
+                print(f"Round {round_ + 1}: {len(matches)} matches played in {time.perf_counter() - start:.1f} s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plays a league between checkpoints of the policy and rates them.")
+    parser.add_argument('checkpoints', nargs='*',
+                        help="paths to the checkpoints, by default all those in the checkpoints directory")
+    parser.add_argument('--schedule', choices=['round-robin', 'swiss'], default='round-robin')
+    parser.add_argument('--rounds', type=int, default=None)
+    parser.add_argument('--openings', type=int, default=50)
+    parser.add_argument('--opening-plies', type=int, default=2)
+    parser.add_argument('--processes', type=int, default=mp.cpu_count())
+    parser.add_argument('--bootstraps', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--path', default=LEAGUE_PATH)
+    args = parser.parse_args()
+
+    checkpoint_paths = args.checkpoints or sorted(glob(join(CHECKPOINTS_DIR_PATH, '*.chkpt')))
+    if len(checkpoint_paths) < 2:
+        parser.error("at least two checkpoints are needed")
+    results = run_league(checkpoint_paths=checkpoint_paths, results_path=args.path, processes=args.processes,
+                         schedule=args.schedule, rounds=args.rounds, num_openings=args.openings,
+                         opening_plies=args.opening_plies, seed=args.seed)
+    players = [Path(path).stem for path in checkpoint_paths]
+    ratings = fit_ratings(results, players, num_bootstraps=args.bootstraps, seed=args.seed)
+    print(f"{'Checkpoint':<40}{'Rating':>10}{'95% CI':>20}{'Games':>8}{'Score':>8}")
+    for player, rating in sorted(ratings.items(), key=lambda item: -item[1]['rating']):
+        interval = f"[{rating['lower']:.0f}, {rating['upper']:.0f}]"
+        print(f"{player:<40}{rating['rating']:>10.0f}{interval:>20}{rating['games']:>8}{rating['score']:>8.3f}")
+
+
+def _fit_bradley_terry(pairs: np.ndarray, counts: np.ndarray, num_players: int, prior: float,
+                       tolerance: float = 1e-9, max_iterations: int = 10000) -> np.ndarray:
+    """
+    Returns the Bradley-Terry ratings on the Elo scale of the matches between the players of `pairs` with
+    the wins, draws and losses of the first player in `counts`, fitted by minorization-maximization.
+    """
+    games = np.zeros((num_players, num_players))
+    np.add.at(games, (pairs[:, 0], pairs[:, 1]), counts.sum(axis=1))
+    np.add.at(games, (pairs[:, 1], pairs[:, 0]), counts.sum(axis=1))
+    points = np.zeros(num_players)
+    np.add.at(points, pairs[:, 0], counts[:, 0] + counts[:, 1] / 2)
+    np.add.at(points, pairs[:, 1], counts[:, 2] + counts[:, 1] / 2)
+    # the virtual draws against a player of strength 1
+    points += prior / 2
+    strengths = np.ones(num_players)
+    for _ in range(max_iterations):
+        new_strengths = points / ((games / (strengths[:, None] + strengths[None, :])).sum(axis=1) +
+                                  prior / (strengths + 1))
+        converged = np.abs(np.log(new_strengths / strengths)).max() < tolerance
+        strengths = new_strengths
+        if converged:
+            break
+    ratings = 400 * np.log10(strengths)
+    return ratings - ratings.mean()
+
+
+@lru_cache(maxsize=None)
+def _get_policy(path: str) -> nn.Module:
+    """
+    Returns the policy of the checkpoint in `path`, which is loaded only once per worker of `run_league`.
+    """
+    return load_policy(path, torch.device('cpu'))
+
+
+def _init_worker(openings: np.ndarray) -> None:
+    """
+    Sets the openings of a worker of `run_league`, and leaves the rest of the cores to the other workers.
+    """
+    global _openings
+    torch.set_num_threads(1)
+    _openings = openings
+
+
+def _load_records(path: str) -> list[dict]:
+    """
+    Returns the records of the `.jsonl` file written by `run_league`, the settings of the league followed by
+    the results of the matches, or an empty list if the file does not exist.
+    """
+    if not exists(path):
+        return []
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _pair_swiss(players: list[str], results: list[dict]) -> list[tuple[str, str]]:
+    """
+    Returns the pairs of a Swiss round given the results of the previous ones, in which every player, from the
+    one with the most points down, meets the next one with the most points it has not met yet, if any.
+    """
+    points: dict[str, float] = defaultdict(float)
+    met: set[frozenset[str]] = set()
+    byes: set[str] = set()
+    for result in results:
+        a, b = result['players']
+        points[a] += result['wins'] + result['draws'] / 2
+        points[b] += result['losses'] + result['draws'] / 2
+        met.add(frozenset((a, b)))
+    for round_ in {result['round'] for result in results}:
+        paired = {player for result in results if result['round'] == round_ for player in result['players']}
+        byes.update(player for player in players if player not in paired)
+
+    standings = sorted(players, key=lambda player: -points[player])
+    if len(standings) % 2 == 1:
+        # the lowest ranked player without a bye sits out
+        bye = next((player for player in reversed(standings) if player not in byes), standings[-1])
+        standings.remove(bye)
+    pairs = []
+    while standings:
+        player = standings.pop(0)
+        opponent = next((other for other in standings if frozenset((player, other)) not in met), standings[0])
+        standings.remove(opponent)
+        pairs.append((player, opponent))
+    return pairs
+
+
+def _play_match(match: tuple[int, str, str, str, str]) -> dict:
+    """
+    Plays every opening twice between two policies, once with each color, all the games in lockstep, and
+    returns the round, the names of both players and the wins, draws and losses of the first one.
+    """
+    round_, name_a, name_b, path_a, path_b = match
+    policies = (_get_policy(path_a), _get_policy(path_b))
+    num_openings, opening_plies = _openings.shape
+    params_env: ParamsEnv = {
+        'action_space': 7,
+        'observation_space': 6,
+        'rewards': {'win': 1., 'loss': -1., 'draw': 0., 'prolongation': 0.}
+    }
+    env = VectorConnectFourEnv(params=params_env, num_envs=2 * num_openings, device=torch.device('cpu'))
+    env.reset()
+    for ply in range(opening_plies):
+        env.step(np.tile(_openings[:, ply], 2))
+    # the first policy plays first in the first half of the games and second in the other half
+    players = np.repeat(np.array([1, 2], dtype=np.int8), num_openings)
+    results = np.zeros(2 * num_openings, dtype=np.int8)
+    # finished games are reset by the environment and ignored
+    playing = np.ones(2 * num_openings, dtype=bool)
+    valid_actions = env.get_valid_actions()
+    while playing.any():
+        actions = np.zeros(2 * num_openings, dtype=np.int64)
+        for policy, turn in zip(policies, (env.turns == players, env.turns != players)):
+            moving = playing & turn
+            if moving.any():
+                with torch.no_grad():
+                    outputs = policy(encode_bitboards(env.bitboards[moving], env.rows, env.cols)).masked_fill(
+                        ~torch.from_numpy(valid_actions[moving]), -torch.inf)
+                actions[moving] = outputs.argmax(dim=1).numpy()
+        _, _, dones, valid_actions, info = env.step(actions)
+        finished = playing & dones
+        winners = info['winners'][finished]
+        results[finished] = np.where(winners == 0, 0, np.where(winners == players[finished], 1, -1))
+        playing &= ~dones
+
+    return {
+        'round': round_,
+        'players': [name_a, name_b],
+        'wins': int((results == 1).sum()),
+        'draws': int((results == 0).sum()),
+        'losses': int((results == -1).sum())
+    }
+
+
+if __name__ == '__main__':
+    main()
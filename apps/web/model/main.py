@@ -4,10 +4,12 @@ import numpy as np
 import random
 import torch
 from agent import DQNAgent
-from constants import CHECKPOINTS_DIR_PATH, FIGURES_DIR_PATH, POLICIES_DIR_PATH
-from custom_types import ParamsAgent, ParamsEnv, ParamsEval, ParamsTrain
-from env import ConnectFourEnv
-from training import train, plot, export_onnx
+from constants import CHECKPOINTS_DIR_PATH, COMPILE_CACHE_DIR_PATH, FIGURES_DIR_PATH, MOVE_QUALITY_PATH, \
+    POLICIES_DIR_PATH, PUZZLES_PATH
+from custom_types import ParamsAgent, ParamsDistributed, ParamsEnv, ParamsEval, ParamsTrain
+from env import BitboardConnectFourEnv
+from export import export_onnx, verify_onnx
+from training import train, train_distributed, plot
 from modules import ConnectFourNet
 
 SEED = 29
@@ -33,13 +35,25 @@ def main():
     }
 
     params_eval: ParamsEval = {
+        # evaluate in a background process
+        'asynchronous': True,
         'enforce_valid_action': False,
         'episodes': 100,
-        'period': 25
+        # positions labelled by move_quality.py to score the moves of the policy against the solver, if any
+        'move_quality_path': None,
+        # 'move_quality_path': MOVE_QUALITY_PATH,
+        'period': 25,
+        # puzzles generated by puzzles.py, if None, those in constants.py
+        'puzzles_path': None,
+        # 'puzzles_path': PUZZLES_PATH,
+        # play all the evaluation games at once
+        'vectorized': True
     }
 
     params_train: ParamsTrain = {
         'batch_size': 512,
+        # batches sampled at once and optimized on in a row, the target is updated once after them
+        'batches_per_update': 1,
         'checkpoint': {
             'save_every':  20000,
             'save_on_exit': True
@@ -47,6 +61,11 @@ def main():
         'display_period': 1000,
         'enforce_valid_action': False,
         'episodes': 50000,
+        # number of self-play games played in lockstep
+        'parallel_games': 1,
+        # batches optimized on per environment step, if None, `batches_per_update` per episode
+        'replay_ratio': None,
+        # 'replay_ratio': 0.25,
         'scheduler': {
             'name': 'MultiStepLR',
             'config': {
@@ -56,12 +75,25 @@ def main():
         }
     }
 
+    params_distributed: ParamsDistributed = {
+        # number of actor processes, if zero, acting and learning take turns in this process
+        'actors': 0,
+        # seconds between throughput logs
+        'log_period': 60.,
+        # learner updates between publications of the policy weights to the actors
+        'sync_period': 100
+    }
+
     params_agent: ParamsAgent = {
         'batch_size': params_train['batch_size'],
         'clip_grads': None,
         #  'clip_grads': {'name': 'clip_grad_norm_',
         #                 'config': {'max_norm': 1.0,
         #                            'norm_type': 2}},
+        'compile': None,
+        # 'compile': {'name': 'compile',
+        #             'config': {'mode': 'reduce-overhead'},
+        #             'cache_dir': COMPILE_CACHE_DIR_PATH},
         'criterion': {
             'name': 'HuberLoss',
             'config': {}
@@ -75,7 +107,30 @@ def main():
             'decay': params_train['episodes'] * 25 / 7.5
         },
         'gamma': 0.99,
+        # runtime of the forward passes used to act and to evaluate
+        'inference': {'name': 'torch', 'config': {}},
+        # 'inference': {'name': 'torch',
+        #               # act with a copy of the policy with its batch normalizations folded, e.g. of CNNResNet
+        #               'config': {'fuse': True,
+        #                          'channels_last': False,
+        #                          # optimization steps between copies of the policy
+        #                          'refresh_period': 100}},
+        # 'inference': {'name': 'onnxruntime',
+        #               'config': {'intra_op_num_threads': 1,
+        #                          'inter_op_num_threads': 1,
+        #                          # optimization steps between exports of the policy
+        #                          'refresh_period': 100}},
         'memory__maxlen': params_train['episodes'] * 25,
+        # store states as bitboards and rebuild next states when sampling
+        'memory__packed': False,
+        # 'memory__packed': True,
+        'memory__prioritized': None,
+        # 'memory__prioritized': {
+        #     'alpha': 0.6,
+        #     'beta_start': 0.4,
+        #     'beta_steps': params_train['episodes'],
+        #     'epsilon': 1e-5
+        # },
         'optimizer': {
             'name': 'SGD',
             'config': {
@@ -84,6 +139,11 @@ def main():
                 # 'weight_decay': 0.001
             }
         },
+        # forward passes in 'bfloat16' autocast, with float32 weights, or in 'float32'
+        'precision': 'float32',
+        # number of batches sampled ahead in a background thread, if None, they are sampled on demand
+        'prefetch': None,
+        # 'prefetch': 2,
         'target_update': {
             'mode': 'soft',
             'config': {
@@ -113,20 +173,32 @@ def main():
     )
 
     # environment
-    env = ConnectFourEnv(
+    env = BitboardConnectFourEnv(
         params=params_env,
         device=device
     )
 
     # train
-    args = train(
-        agent=agent,
-        env=env,
-        params_train=params_train,
-        params_eval=params_eval,
-        checkpoints_dir_path=CHECKPOINTS_DIR_PATH,
-        device=device
-    )
+    if params_distributed['actors'] > 0:
+        args = train_distributed(
+            agent=agent,
+            env=env,
+            params_train=params_train,
+            params_eval=params_eval,
+            params_distributed=params_distributed,
+            checkpoints_dir_path=CHECKPOINTS_DIR_PATH,
+            device=device
+        )
+
+    else:
+        args = train(
+            agent=agent,
+            env=env,
+            params_train=params_train,
+            params_eval=params_eval,
+            checkpoints_dir_path=CHECKPOINTS_DIR_PATH,
+            device=device
+        )
 
     # export onnx
     _, _, _, model_id = args
@@ -137,6 +209,14 @@ def main():
         device=device
     )
 
+    # check the exported variants against the policy, the failing ones are removed and training fails if none passes
+    verify_onnx(
+        policy=agent.net.policy,
+        policies_dir_path=POLICIES_DIR_PATH,
+        model_id=model_id,
+        device=device
+    )
+
     # plot training results
     plot(
         *args,
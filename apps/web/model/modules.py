@@ -1,11 +1,24 @@
+import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import copy
+import warnings
+from custom_types import Compile
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from typing import Literal, List
 
 
 class Module(nn.Module):
+    def train(self, mode: bool = True) -> 'Module':
+        super().train(mode)
+        # the target of a network only predicts the expected values, so its batch normalizations, if any,
+        # always use the running statistics blended from those of the policy
+        target = self._modules.get('target')
+        if target is not None:
+            target.eval()
+        return self
+
     def layer_summary(self, x_shape: List[int]) -> None:
         """
         Prints a summary of all the Conv2d, Flatten and Linear layers and their outputs to
@@ -22,6 +35,48 @@ class Module(nn.Module):
                 print(f'{title:30}{x.shape}')
 
 
+class CompiledForward:
+    """
+    Runs the forward pass of `module` compiled with `torch.compile` if `name` is 'compile', or with
+    TorchScript if it is 'script', passing `config` to either of them. The compiled module shares the
+    parameters and buffers of `module`, so in-place updates of the latter, e.g. optimizer steps or
+    `load_state_dict`, are seen by the former. If compiling or running the compiled module fails, it
+    warns and falls back to eager execution of `module` for good.
+
+    If `cache_dir` is not None, `torch.compile` caches its compiled graphs in that directory, so that
+    later processes reuse them instead of compiling again.
+    """
+
+    def __init__(self, module: nn.Module, params: Compile) -> None:
+        self.module = module
+        self.name = params['name']
+        if self.name == 'compile' and params['cache_dir'] is not None:
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(
+                params['cache_dir'])
+            os.environ['TORCHINDUCTOR_FX_GRAPH_CACHE'] = '1'
+        try:
+            self._forward = torch.compile(module, **params['config']) if self.name == 'compile' \
+                else torch.jit.script(module, **params['config'])
+        except Exception as error:
+            self._fall_back(error)
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self._forward is not self.module:
+            try:
+                return self._forward(x)
+            except Exception as error:
+                self._fall_back(error)
+        return self.module(x)
+
+    def _fall_back(self, error: Exception) -> None:
+        """
+        Switches to eager execution after `error`.
+        """
+        warnings.warn(
+            f"Could not run {self.module.__class__.__name__} with {self.name}, falling back to eager execution: {error}")
+        self._forward = self.module
+
+
 class ConnectFourNet(Module):
     def __init__(self, out_features: int):
         super(ConnectFourNet, self).__init__()
@@ -105,6 +160,59 @@ class ResBlock(Module):
         return F.leaky_relu(x + self.net(x))
 
 
+def fuse_for_inference(module: nn.Module, channels_last: bool = False) -> nn.Module:
+    """
+    Returns a copy of `module` in evaluation mode and without gradients, in which every batch normalization
+    that follows a convolution in a `nn.Sequential` is folded into the weights and bias of the latter. Its
+    outputs equal those of `module` in evaluation mode up to float rounding. Activations are not fused here,
+    ONNX Runtime and `torch.compile` fuse them with the convolutions.
+
+    Args:
+        - `module`: the module, which is not modified.
+        - `channels_last`: whether to store the weights of the copy in channels last memory format, which
+        is faster for convolutions on some CPUs if the inputs are channels last too.
+
+    Returns:
+        - The fused copy.
+    """
+    fused = copy.deepcopy(module).eval()
+    for sequential in [x for x in fused.modules() if isinstance(x, nn.Sequential)]:
+        names = list(sequential._modules)
+        for name, next_name in zip(names, names[1:]):
+            conv, bn = sequential._modules[name], sequential._modules[next_name]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                sequential._modules[name] = fuse_conv_bn_eval(conv, bn)
+                sequential._modules[next_name] = nn.Identity()
+    for param in fused.parameters():
+        param.requires_grad = False
+    if channels_last:
+        fused = fused.to(memory_format=torch.channels_last)
+    return fused
+
+
+@torch.no_grad()
+def soft_update(target: nn.Module, policy: nn.Module, tau: float) -> None:
+    """
+    Blends the parameters and buffers of `policy` into those of `target` in place, i.e.
+    `target = tau * policy + (1 - tau) * target`, with one fused multi-tensor operation. Integer
+    buffers, e.g. the number of batches tracked by batch normalization, are copied.
+
+    Args:
+        - `target`: the module whose tensors are updated.
+        - `policy`: the module with the same architecture whose tensors are blended in.
+        - `tau`: the weight of `policy`.
+    """
+    target_floats, policy_floats = [], []
+    for target_tensor, policy_tensor in zip([*target.parameters(), *target.buffers()],
+                                            [*policy.parameters(), *policy.buffers()]):
+        if target_tensor.is_floating_point():
+            target_floats.append(target_tensor)
+            policy_floats.append(policy_tensor)
+        else:
+            target_tensor.copy_(policy_tensor)
+    torch._foreach_lerp_(target_floats, policy_floats, tau)
+
+
 def block(residuals, channels, kernel_size, padding, stride):
     block = [
         ResBlock(
@@ -120,7 +228,8 @@ class CNNResNet(Module):
     def __init__(self, out_features):
         super(CNNResNet, self).__init__()
         channels = 32
-        self.conv = nn.Sequential(
+        self.policy = nn.Sequential(
+            # (N, Cin, Hin, Win) -> (N, Cout, Hout, Wout)
             nn.Conv2d(
                 in_channels=2,
                 out_channels=channels,
@@ -128,24 +237,24 @@ class CNNResNet(Module):
                 padding=2,
                 stride=1
             ),
-            nn.ReLU()
-        )
-        self.block1 = block(
-            residuals=2,
-            channels=channels,
-            kernel_size=5,
-            padding=2,
-            stride=1
-        )
-        self.block2 = block(
-            residuals=2,
-            channels=channels,
-            kernel_size=5,
-            padding=2,
-            stride=1
-        )
-
-        self.fc = nn.Sequential(
+            nn.ReLU(),
+            # (N, Cin, Hin, Win) -> (N, Cout, Hout, Wout)
+            block(
+                residuals=2,
+                channels=channels,
+                kernel_size=5,
+                padding=2,
+                stride=1
+            ),
+            # (N, Cin, Hin, Win) -> (N, Cout, Hout, Wout)
+            block(
+                residuals=2,
+                channels=channels,
+                kernel_size=5,
+                padding=2,
+                stride=1
+            ),
+            # (N, Cin, Hin, Win) -> (N, Hout)
             nn.Flatten(),
             nn.Linear(
                 in_features=1344,
@@ -165,15 +274,17 @@ class CNNResNet(Module):
             x, nn.Conv2d) | isinstance(x, nn.Linear)]
         self._init_wnb(*modules)
 
-    def forward(self, x):
-        # (N, Cin, Hin, Win) -> (N, Cout, Hout, Wout)
-        x = self.conv(x)
-        # (N, Cin, Hin, Win) -> (N, Cout, Hout, Wout)
-        x = self.block1(x)
-        # (N, Cin, Hin, Win) -> (N, Cout, Hout, Wout)
-        x = self.block2(x)
-        # (N, Cin, Hin, Win) -> (N, Hout)
-        return self.fc(x)
+        self.target = copy.deepcopy(self.policy)
+        for param in self.target.parameters():
+            param.requires_grad = False
+        self.target.eval()
+
+    def forward(self, x: torch.Tensor, model: Literal['policy', 'target']):
+        if model == 'policy':
+            return self.policy(x)
+
+        elif model == 'target':
+            return self.target(x)
 
     def _init_wnb(self, *args):
         for module in args:
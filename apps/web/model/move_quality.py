@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+import time
+from bitboard import from_observations, mirrors, to_observations
+from constants import MOVE_QUALITY_PATH
+from os.path import dirname
+from pathlib import Path
+from puzzles import play_games
+from solver import Solver
+from typing import Any
+
+_depth = 0
+_exact_counters = 0
+_solver: Any = None
+
+
+def generate(num_positions: int, processes: int, depth: int = 8, exact_counters: int = 20, min_counters: int = 0,
+             seed: int = 0, tactical: float = 0.5, num_envs: int = 256, rows: int = 6,
+             cols: int = 7) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Generates a benchmark of `num_positions` positions labelled with the score of every legal move, split
+    evenly among the game phases with at least `min_counters` counters, i.e. the opening, the middle game
+    and the endgame, which span a third of the board each. Positions are sampled from games in which every
+    move takes a win or blocks a threat with probability `tactical` and is random otherwise, deduplicated
+    up to mirroring, and labelled by a pool of `processes` solvers. Positions with at least `exact_counters`
+    counters are scored exactly, and the rest, which are too slow to solve, by a search `depth` plies deep,
+    in which outcomes not decided within them score 0. Positions in which every legal move has the same
+    score are left out, since they tell nothing about the quality of a move, so the early positions are
+    those in which a move wins or loses within `depth` plies.
+
+    Args:
+        - `num_positions`: number of positions.
+        - `processes`: number of processes.
+        - `depth`: number of plies searched by the solvers in the positions not scored exactly.
+        - `exact_counters`: minimum number of counters of the positions scored exactly.
+        - `min_counters`: minimum number of counters of the positions.
+        - `seed`: seed of the first batch of games, the next ones use the following integers.
+        - `tactical`: probability of taking a win or blocking a threat.
+        - `num_envs`: number of games played at once.
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - Array with the boards with values 0, 1 or 2, of shape (`num_positions`, `rows`, `cols`).
+        - Array with the scores of the moves for the player in turn, 0 for the illegal ones, of shape
+        (`num_positions`, `cols`) and type int8.
+    """
+    phases = [phase for phase, (_, end) in enumerate(get_phase_bounds(rows, cols)) if end > min_counters]
+    quotas = {phase: num_positions // len(phases) + (i < num_positions % len(phases))
+              for i, phase in enumerate(phases)}
+    found: dict[int, list] = {phase: [] for phase in phases}
+    ends = [end for _, end in get_phase_bounds(rows, cols)]
+    keys: set[int] = set()
+    rng = np.random.default_rng(seed)
+    context = mp.get_context('spawn')
+    with context.Pool(processes, initializer=_init_worker, initargs=(rows, cols, depth, exact_counters)) as pool:
+        for batch in itertools.count(seed):
+            batch_keys, boards = _sample_positions(batch, min_counters, tactical, num_envs, rows, cols)
+            is_new = np.array([key not in keys for key in batch_keys], dtype=bool)
+            keys.update(batch_keys)
+            boards_phases = np.searchsorted(ends, (boards != 0).sum(axis=(1, 2)), side='right')
+            # only as many positions as still needed by every phase are labelled, drawn at random so
+            # that every number of counters is represented
+            selected = np.concatenate([
+                rng.permutation(np.flatnonzero(is_new & (boards_phases == phase)))[:quotas[phase] - len(found[phase])]
+                for phase in phases
+            ])
+            for board, phase, scores in zip(boards[selected], boards_phases[selected],
+                                            pool.imap(_analyze, boards[selected], chunksize=4)):
+                legal = board[0] == 0
+                if len(found[phase]) < quotas[phase] and scores[legal].min() < scores[legal].max():
+                    found[phase].append((board, scores))
+            if all(len(found[phase]) == quotas[phase] for phase in phases):
+                break
+
+    positions = [position for phase in phases for position in found[phase]]
+    return np.stack([board for board, _ in positions]), np.stack([scores for _, scores in positions])
+
+
+def get_phase_bounds(rows: int = 6, cols: int = 7) -> list[tuple[int, int]]:
+    """
+    Returns the range of numbers of counters of the opening, the middle game and the endgame, i.e. the first,
+    second and last third of the board, e.g. [0, 14), [14, 28) and [28, 42) in the standard board.
+
+    Args:
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - List with the first and the last plus one number of counters of every phase.
+    """
+    size = rows * cols
+    return [(0, size // 3), (size // 3, 2 * size // 3), (2 * size // 3, size)]
+
+
+def load_move_quality(path: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Loads the positions saved by `save_move_quality`.
+
+    Args:
+        - `path`: path to the `.npz` file.
+
+    Returns:
+        - Tuple with the boards and the scores of their moves.
+    """
+    with np.load(path) as file:
+        return to_observations(file['p1'], file['p2'], int(file['rows']), int(file['cols'])), file['scores']
+
+
+def save_move_quality(path: str, boards: np.ndarray, scores: np.ndarray) -> None:
+    """
+    Saves the positions returned by `generate` to a compressed `.npz` file with the bitboards of both players.
+
+    Args:
+        - `path`: path to the `.npz` file.
+        - `boards`: array with the boards of shape (N, rows, cols).
+        - `scores`: array with the scores of the moves of shape (N, cols).
+    """
+    Path(dirname(path) or '.').mkdir(
+        parents=True,
+        exist_ok=True
+    )
+    p1, p2 = from_observations(boards)
+    np.savez_compressed(path, p1=p1, p2=p2, scores=scores, rows=boards.shape[1], cols=boards.shape[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates positions of Connect Four labelled with the scores of their moves by a solver.")
+    parser.add_argument('--positions', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=mp.cpu_count())
+    parser.add_argument('--depth', type=int, default=8)
+    parser.add_argument('--exact-counters', type=int, default=20)
+    parser.add_argument('--min-counters', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tactical', type=float, default=0.5)
+    parser.add_argument('--path', default=MOVE_QUALITY_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    boards, scores = generate(num_positions=args.positions, processes=args.processes, depth=args.depth,
+                              exact_counters=args.exact_counters, min_counters=args.min_counters, seed=args.seed,
+                              tactical=args.tactical)
+    save_move_quality(args.path, boards, scores)
+    print(f"{len(boards)} positions saved to {args.path} in {time.perf_counter() - start:.1f} s")
+
+
+def _analyze(board: np.ndarray) -> np.ndarray:
+    """
+    Returns the scores of the moves of `board` given by the solver of a worker of `generate`.
+    """
+    scores = np.zeros(board.shape[1], dtype=np.int8)
+    depth = None if (board != 0).sum() >= _exact_counters else _depth
+    for col, score in _solver.analyze(board, depth).items():
+        scores[col] = score
+    return scores
+
+
+def _init_worker(rows: int, cols: int, depth: int, exact_counters: int) -> None:
+    """
+    Creates the solver of a worker of `generate`.
+    """
+    global _depth, _exact_counters, _solver
+    _depth = depth
+    _exact_counters = exact_counters
+    _solver = Solver(rows, cols)
+
+
+def _sample_positions(seed: int, min_counters: int, tactical: float, num_envs: int, rows: int,
+                      cols: int) -> tuple[list[int], np.ndarray]:
+    """
+    Plays `num_envs` games with `play_games` for as many steps as the cells of the board and returns the
+    canonical keys and the boards of the positions with at least `min_counters` counters found on the way,
+    deduplicated up to mirroring.
+    """
+    envs = np.arange(num_envs)
+    keys: dict[int, np.ndarray] = {}
+    for env, _, _ in play_games(seed, num_envs, rows * cols, tactical, rows, cols):
+        current = env.bitboards[envs, env.turns - 1]
+        position_keys = (current | env.bitboards[envs, 2 - env.turns]) + current
+        canonical = np.minimum(position_keys, mirrors(position_keys, rows, cols))
+        deep = env.num_counters >= min_counters
+        for key, bitboards in zip(canonical[deep], env.bitboards[deep]):
+            keys.setdefault(int(key), bitboards)
+
+    if not keys:
+        return [], np.zeros((0, rows, cols), dtype=np.int8)
+    bitboards = np.stack(list(keys.values()))
+    return list(keys), to_observations(bitboards[:, 0], bitboards[:, 1], rows, cols)
+
+
+if __name__ == '__main__':
+    main()
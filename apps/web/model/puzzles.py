@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+import time
+import torch
+from bitboard import from_observations, get_winning_cells, mirrors, to_observations
+from constants import PUZZLES_PATH
+from custom_types import ParamsEnv
+from env import VectorConnectFourEnv
+from functools import partial
+from os.path import dirname
+from pathlib import Path
+from typing import Any, Iterator
+
+SUITES = ('finishes', 'blocks')
+
+
+def generate(num_puzzles: int, processes: int, seed: int = 0, tactical: float = 0.5, num_envs: int = 1024,
+             num_steps: int = 64, rows: int = 6, cols: int = 7) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    """
+    Generates `num_puzzles` finish puzzles, i.e. positions in which the player in turn can win, whose
+    solutions are all their winning moves, and as many block puzzles, i.e. positions in which the player
+    in turn cannot win but the opponent threatens to win in a single column, whose solution is that column.
+    Positions are sampled from games played in lockstep by a pool of `processes` processes, in which
+    every move takes a win or blocks a threat with probability `tactical`, so that positions are closer
+    to those of real games, and is random otherwise. Puzzles are labelled with the winning cells of the
+    bitboards of both players and deduplicated by canonical key, i.e. mirror positions count once.
+
+    Args:
+        - `num_puzzles`: number of puzzles of every suite.
+        - `processes`: number of processes.
+        - `seed`: seed of the first batch of games, the next ones use the following integers.
+        - `tactical`: probability of taking a win or blocking a threat.
+        - `num_envs`: number of games played at once by every process.
+        - `num_steps`: number of steps of every batch of games.
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - Dictionary with the boards with values 0, 1 or 2, of shape (`num_puzzles`, `rows`, `cols`), and the
+        boolean masks of the solutions, of shape (`num_puzzles`, `cols`), of the 'finishes' and the 'blocks'.
+    """
+    play = partial(_find_puzzles, tactical=tactical, num_envs=num_envs,
+                   num_steps=num_steps, rows=rows, cols=cols)
+    keys: dict[str, set] = {suite: set() for suite in SUITES}
+    found: dict[str, list] = {suite: [] for suite in SUITES}
+    context = mp.get_context('spawn')
+    with context.Pool(processes) as pool:
+        for batch in pool.imap_unordered(play, itertools.count(seed)):
+            for suite in SUITES:
+                for key, bitboards, solution in zip(*batch[suite]):
+                    if len(keys[suite]) < num_puzzles and key not in keys[suite]:
+                        keys[suite].add(key)
+                        found[suite].append((bitboards, solution))
+            if all(len(keys[suite]) == num_puzzles for suite in SUITES):
+                break
+
+    suites = {}
+    for suite in SUITES:
+        bitboards = np.stack([bitboards for bitboards, _ in found[suite]])
+        solutions = np.stack([solution for _, solution in found[suite]])
+        suites[suite] = (to_observations(bitboards[:, 0], bitboards[:, 1], rows, cols), solutions)
+    return suites
+
+
+def load_puzzles(path: str) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    """
+    Loads the puzzles saved by `save_puzzles`.
+
+    Args:
+        - `path`: path to the `.npz` file.
+
+    Returns:
+        - Dictionary with the boards and the masks of the solutions of the 'finishes' and the 'blocks'.
+    """
+    with np.load(path) as file:
+        rows, cols = int(file['rows']), int(file['cols'])
+        return {
+            suite: (
+                to_observations(file[f'{suite}_p1'], file[f'{suite}_p2'], rows, cols),
+                np.unpackbits(file[f'{suite}_solutions'], axis=1, count=cols, bitorder='little').astype(bool)
+            ) for suite in SUITES
+        }
+
+
+def play_games(seed: int, num_envs: int, num_steps: int, tactical: float = 0., rows: int = 6,
+               cols: int = 7) -> Iterator[tuple[VectorConnectFourEnv, np.ndarray, np.ndarray]]:
+    """
+    Plays `num_envs` games in lockstep for `num_steps` steps, in which every move takes a win or blocks a
+    threat with probability `tactical` and is random otherwise. The games which finish are reset by the
+    environment, so every game goes on from the empty board.
+
+    Args:
+        - `seed`: seed of the moves.
+        - `num_envs`: number of games.
+        - `num_steps`: number of steps.
+        - `tactical`: probability of taking a win or blocking a threat.
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - Iterator which yields before every step the environment, with the positions reached so far, and
+        the boolean masks of shape (`num_envs`, `cols`) of the columns in which the player in turn wins
+        and in which the opponent would win.
+    """
+    params_env: ParamsEnv = {
+        'action_space': cols,
+        'observation_space': rows,
+        'rewards': {'win': 1., 'loss': -1., 'draw': 0., 'prolongation': 0.}
+    }
+    rng = np.random.default_rng(seed)
+    env = VectorConnectFourEnv(params=params_env, num_envs=num_envs, device=torch.device('cpu'))
+    env.reset()
+    height = rows + 1
+    bottom = np.uint64(sum(1 << col * height for col in range(cols)))
+    columns = np.array([((1 << rows) - 1) << col * height for col in range(cols)], dtype=np.uint64)
+    envs = np.arange(num_envs)
+    for _ in range(num_steps):
+        current = env.bitboards[envs, env.turns - 1]
+        opponent = env.bitboards[envs, 2 - env.turns]
+        mask = current | opponent
+        # the lowest empty cell of every column, or the sentinel bit on top of a full one
+        playable = mask + bottom
+        wins = (get_winning_cells(current, mask, rows, cols) & playable)[:, None] & columns != 0
+        threats = (get_winning_cells(opponent, mask, rows, cols) & playable)[:, None] & columns != 0
+        yield env, wins, threats
+
+        valid_actions = env.get_valid_actions()
+        actions = np.argmax(rng.random(valid_actions.shape) * valid_actions, axis=1)
+        can_win = wins.any(axis=1)
+        forced = can_win | threats.any(axis=1)
+        forced_actions = np.where(can_win, wins.argmax(axis=1), threats.argmax(axis=1))
+        takes = forced & (rng.random(num_envs) < tactical)
+        actions[takes] = forced_actions[takes]
+        env.step(actions)
+
+
+def save_puzzles(path: str, suites: dict[str, tuple[np.ndarray, np.ndarray]]) -> None:
+    """
+    Saves the puzzles returned by `generate` to a compressed `.npz` file with the bitboards of both
+    players and the solutions packed into bits.
+
+    Args:
+        - `path`: path to the `.npz` file.
+        - `suites`: dictionary with the boards and the masks of the solutions of the 'finishes' and the 'blocks'.
+    """
+    Path(dirname(path) or '.').mkdir(
+        parents=True,
+        exist_ok=True
+    )
+    arrays: dict[str, Any] = {}
+    for suite, (boards, solutions) in suites.items():
+        arrays[f'{suite}_p1'], arrays[f'{suite}_p2'] = from_observations(boards)
+        arrays[f'{suite}_solutions'] = np.packbits(solutions, axis=1, bitorder='little')
+    arrays['rows'], arrays['cols'] = next(iter(suites.values()))[0].shape[1:]
+    np.savez_compressed(path, **arrays)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates finish and block puzzles from games of Connect Four.")
+    parser.add_argument('--puzzles', type=int, default=100000)
+    parser.add_argument('--processes', type=int, default=mp.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tactical', type=float, default=0.5)
+    parser.add_argument('--path', default=PUZZLES_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    suites = generate(num_puzzles=args.puzzles, processes=args.processes,
+                      seed=args.seed, tactical=args.tactical)
+    save_puzzles(args.path, suites)
+    print(f"{args.puzzles} finish and {args.puzzles} block puzzles saved to {args.path} in "
+          f"{time.perf_counter() - start:.1f} s")
+
+
+def _find_puzzles(seed: int, tactical: float, num_envs: int, num_steps: int, rows: int,
+                  cols: int) -> dict[str, tuple[np.ndarray, ...]]:
+    """
+    Plays `num_envs` games with `play_games` and returns the canonical keys, the bitboards of both players
+    and the masks of the solutions of the finish and the block puzzles found on the way.
+    """
+    found: dict[str, list] = {suite: [] for suite in SUITES}
+    envs = np.arange(num_envs)
+    for env, wins, threats in play_games(seed, num_envs, num_steps, tactical, rows, cols):
+        current = env.bitboards[envs, env.turns - 1]
+        can_win = wins.any(axis=1)
+        # blocking is forced only if the opponent threatens a single column
+        puzzles = {'finishes': (can_win, wins), 'blocks': (~can_win & (threats.sum(axis=1) == 1), threats)}
+        keys = (current | env.bitboards[envs, 2 - env.turns]) + current
+        keys = np.minimum(keys, mirrors(keys, rows, cols))
+        for suite, (is_puzzle, solutions) in puzzles.items():
+            found[suite].append((keys[is_puzzle], env.bitboards[is_puzzle], solutions[is_puzzle]))
+
+    return {
+        suite: tuple(np.concatenate(arrays) for arrays in zip(*found[suite]))
+        for suite in SUITES
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,471 @@
-import random
-from collections import deque, namedtuple
+import multiprocessing as mp
+import queue
+import threading
+from collections import namedtuple
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
+import torch
+from bitboard import from_observations, play_moves
+from utils import encode_bitboards, encode_boards
 
 
 Transition = namedtuple('Transition',
                         ('state', 'action', 'next_state', 'reward'))
 
+Batch = namedtuple('Batch',
+                   ('state', 'action', 'next_state', 'reward', 'non_final', 'index', 'weight'), defaults=(None, None))
+
 
 class ExperienceReplay(object):
+    """
+    Ring buffer of transitions backed by preallocated arrays, i.e. the states, actions, next states,
+    rewards and non-final mask of every transition are stored at the same index of contiguous arrays.
+
+    If `packed` is True, every state is stored as two 64-bit bitboards (one per player) and next states
+    are not stored at all, but rebuilt from the state, the action and the player who took it. This assumes
+    that the next state is always the result of dropping the counter in the state, and that player 1 starts.
+    """
 
-    def __init__(self, maxlen: int,  batch_size: int) -> None:
-        self.transitions: deque = deque([], maxlen=maxlen)
+    def __init__(self, maxlen: int,  batch_size: int, observation_shape: tuple[int, int] = (6, 7), packed: bool = False) -> None:
+        self.maxlen = maxlen
         self.batch_size = batch_size
+        self.observation_shape = observation_shape
+        self.packed = packed
+        if packed:
+            self.states = self._allocate('states', [maxlen, 2], np.uint64)
+            self.players = self._allocate('players', [maxlen], np.int8)
+        else:
+            self.states = self._allocate(
+                'states', [maxlen, *observation_shape], np.int8)
+            self.next_states = self._allocate(
+                'next_states', [maxlen, *observation_shape], np.int8)
+        self.actions = self._allocate('actions', [maxlen], np.int8)
+        self.rewards = self._allocate('rewards', [maxlen], np.float32)
+        self.non_final = self._allocate('non_final', [maxlen], bool)
+        self.index = 0
+        self.size = 0
 
-    def push(self, *args: np.ndarray | float | int | None) -> None:
+    def push(self, state: np.ndarray, action: int, next_state: np.ndarray | None, reward: float) -> None:
         """
-        Appends a transition in memory.
+        Writes a transition in memory, overwriting the oldest one if the memory is full.
 
         Args:
-            - tuple with a state array, action array, next state array and
-            reward array.
+            - `state`: the state at time t.
+            - `action`: the chosen action.
+            - `next_state`:  the state at time t + 1, or None if the state at time t is final.
+            - `reward`: the reward after performing the action.
         """
-        self.transitions.append(Transition(*args))
+        if self.packed:
+            p1, p2 = from_observations(state[None])
+            self.states[self.index] = p1[0], p2[0]
+            # player 1 starts, so it is their turn if the number of counters is even
+            self.players[self.index] = 1 if np.count_nonzero(
+                state) % 2 == 0 else 2
+        else:
+            self.states[self.index] = state
+            if next_state is not None:
+                self.next_states[self.index] = next_state
+        self.actions[self.index] = action
+        self.rewards[self.index] = reward
+        self.non_final[self.index] = next_state is not None
+        self.index = (self.index + 1) % self.maxlen
+        self.size = min(self.size + 1, self.maxlen)
 
-    def recall(self) -> list:
+    def recall(self, num_batches: int = 1) -> Batch:
         """
-        Samples and returns a random batch of size `batch_size`.
+        Samples (with replacement) a random batch of size `batch_size` and returns it as arrays ready
+        to be used, i.e. states and next states already have two channels and are of type float32.
+        Next states of final transitions are left as they are and must be masked with `non_final`.
+
         Args:
-            - `batch_size`: the size of the batch to sample.
+            - `num_batches`: number of batches sampled at once, which are concatenated.
 
         Returns:
             - the sampled batch.
         """
-        return random.sample(self.transitions, self.batch_size)
+        return self._get_batch(np.random.randint(0, self.size, size=num_batches * self.batch_size))
 
     def __len__(self):
-        return len(self.transitions)
+        return self.size
+
+    def _allocate(self, name: str, shape: list, dtype: type) -> np.ndarray:
+        """
+        Allocates the zero-initialized array of the storage `name`.
+
+        Args:
+            - `name`: name of the storage.
+            - `shape`: shape of the array.
+            - `dtype`: type of the array.
+
+        Returns:
+            - The array.
+        """
+        return np.zeros(shape=shape, dtype=dtype)
+
+    def _get_batch(self, indices: np.ndarray) -> Batch:
+        """
+        Gathers the transitions at `indices` into a batch of arrays ready to be used.
+
+        Args:
+            - `indices`: array with the indices of the transitions.
+
+        Returns:
+            - the batch.
+        """
+        actions = self.actions[indices]
+        if self.packed:
+            # decode only the sampled bitboards
+            rows, cols = self.observation_shape
+            states = self.states[indices]
+            next_states = play_moves(
+                states, self.players[indices], actions, rows)
+            state_batch = encode_bitboards(states, rows, cols).numpy()
+            next_state_batch = encode_bitboards(next_states, rows, cols).numpy()
+        else:
+            state_batch = encode_boards(self.states[indices]).numpy()
+            next_state_batch = encode_boards(self.next_states[indices]).numpy()
+        return Batch(
+            state=state_batch,
+            action=actions.astype(np.int64),
+            next_state=next_state_batch,
+            reward=self.rewards[indices],
+            non_final=self.non_final[indices]
+        )
+
+
+class SharedExperienceReplay(ExperienceReplay):
+    """
+    `ExperienceReplay` whose arrays live in shared memory blocks and whose write index and size are
+    shared values, so that it can be passed to other processes, which attach to the same memory.
+    Pushes from different processes are serialized with a lock, while recalls do not take it.
+    `close` must be called by the process that created it once no other process uses it.
+    """
+
+    def __init__(self, maxlen: int,  batch_size: int, observation_shape: tuple[int, int] = (6, 7), packed: bool = False) -> None:
+        context = mp.get_context('spawn')
+        self._blocks: dict[str, SharedMemory] = {}
+        self._lock = context.Lock()
+        self._index = context.Value('q', 0, lock=False)
+        self._size = context.Value('q', 0, lock=False)
+        self._is_owner = True
+        super(SharedExperienceReplay, self).__init__(
+            maxlen=maxlen,
+            batch_size=batch_size,
+            observation_shape=observation_shape,
+            packed=packed
+        )
+
+    @property
+    def index(self) -> int:  # type: ignore[override]
+        return self._index.value
+
+    @index.setter
+    def index(self, value: int) -> None:
+        self._index.value = value
+
+    @property
+    def size(self) -> int:  # type: ignore[override]
+        return self._size.value
+
+    @size.setter
+    def size(self, value: int) -> None:
+        self._size.value = value
+
+    def push(self, state: np.ndarray, action: int, next_state: np.ndarray | None, reward: float) -> None:
+        """
+        Writes a transition in memory, overwriting the oldest one if the memory is full.
+
+        Args:
+            - `state`: the state at time t.
+            - `action`: the chosen action.
+            - `next_state`:  the state at time t + 1, or None if the state at time t is final.
+            - `reward`: the reward after performing the action.
+        """
+        with self._lock:
+            super(SharedExperienceReplay, self).push(
+                state, action, next_state, reward)
+
+    def close(self) -> None:
+        """
+        Closes the shared memory blocks, and releases them if this is the process that created them.
+        """
+        for name, block in self._blocks.items():
+            # drop the views on the block before closing it
+            setattr(self, name, None)
+            block.close()
+            if self._is_owner:
+                block.unlink()
+        self._blocks = {}
+
+    def __getstate__(self) -> dict:
+        # pickle the names of the shared memory blocks instead of the arrays
+        state = {key: value for key, value in self.__dict__.items()
+                 if key not in self._blocks}
+        state['_blocks'] = {name: (block.name, getattr(self, name).shape, getattr(self, name).dtype)
+                            for name, block in self._blocks.items()}
+        state['_is_owner'] = False
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        blocks = state.pop('_blocks')
+        self.__dict__.update(state)
+        self._blocks = {}
+        for name, (block_name, shape, dtype) in blocks.items():
+            block = SharedMemory(name=block_name)
+            self._blocks[name] = block
+            setattr(self, name, np.ndarray(
+                shape=shape, dtype=dtype, buffer=block.buf))
+
+    def _allocate(self, name: str, shape: list, dtype: type) -> np.ndarray:
+        """
+        Allocates the array of the storage `name` in a new shared memory block, which is zero-initialized.
+
+        Args:
+            - `name`: name of the storage.
+            - `shape`: shape of the array.
+            - `dtype`: type of the array.
+
+        Returns:
+            - The array.
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        block = SharedMemory(create=True, size=max(nbytes, 1))
+        self._blocks[name] = block
+        return np.ndarray(shape=shape, dtype=dtype, buffer=block.buf)
+
+
+class SumTree(object):
+    """
+    Binary tree stored in an array in which every node holds the sum of its children, so that values
+    can be sampled proportionally to their priority, and priorities updated, in O(log n).
+    Node 1 is the root and the children of node i are nodes 2i and 2i + 1.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.depth = max(int(np.ceil(np.log2(capacity))), 1)
+        self.offset = 2 ** self.depth
+        self.tree = np.zeros(shape=[2 * self.offset], dtype=np.float64)
+
+    def total(self) -> float:
+        """
+        Returns the sum of all the priorities.
+        """
+        return self.tree[1]
+
+    def get(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Returns the priorities at `indices`.
+        """
+        return self.tree[indices + self.offset]
+
+    def set(self, index: int, priority: float) -> None:
+        """
+        Sets `priority` at `index` and updates the sums of its ancestors. Faster than `update` for a single leaf.
+
+        Args:
+            - `index`: index of the leaf.
+            - `priority`: the new priority.
+        """
+        tree = self.tree
+        node = index + self.offset
+        tree[node] = priority
+        while node > 1:
+            node //= 2
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+
+    def update(self, indices: np.ndarray, priorities: np.ndarray) -> None:
+        """
+        Sets `priorities` at `indices` and updates the sums of all their ancestors level by level.
+
+        Args:
+            - `indices`: array with the indices of the leaves.
+            - `priorities`: array with the new priorities.
+        """
+        nodes = indices + self.offset
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values: np.ndarray) -> np.ndarray:
+        """
+        Descends the tree for all `values` at once to find the leaves whose cumulative sum interval
+        contains every value.
+
+        Args:
+            - `values`: array with values in [0, total).
+
+        Returns:
+            - Array with the indices of the leaves.
+        """
+        nodes = np.ones(shape=values.shape, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = values >= self.tree[left]
+            values = np.where(right, values - self.tree[left], values)
+            nodes = np.where(right, left + 1, left)
+        return nodes - self.offset
+
+
+class PrioritizedExperienceReplay(ExperienceReplay):
+    """
+    `ExperienceReplay` which samples transitions with probability proportional to their priority to
+    the power of `alpha`, and returns the indices and importance-sampling weights of the sampled
+    transitions, so that priorities can be updated with their TD errors. New transitions get the
+    maximum priority seen so far, and `beta` is annealed linearly from `beta_start` to 1 in `beta_steps` recalls.
+    """
+
+    def __init__(self, maxlen: int,  batch_size: int, alpha: float, beta_start: float, beta_steps: int, epsilon: float,
+                 observation_shape: tuple[int, int] = (6, 7), packed: bool = False) -> None:
+        super(PrioritizedExperienceReplay, self).__init__(
+            maxlen=maxlen,
+            batch_size=batch_size,
+            observation_shape=observation_shape,
+            packed=packed
+        )
+        self.alpha = alpha
+        self.beta = beta_start
+        self.beta_increment = (1. - beta_start) / max(beta_steps, 1)
+        self.epsilon = epsilon
+        self.max_priority = 1.
+        self.priorities = SumTree(capacity=maxlen)
+
+    def push(self, state: np.ndarray, action: int, next_state: np.ndarray | None, reward: float) -> None:
+        """
+        Writes a transition in memory with the maximum priority, overwriting the oldest one if the memory is full.
+
+        Args:
+            - `state`: the state at time t.
+            - `action`: the chosen action.
+            - `next_state`:  the state at time t + 1, or None if the state at time t is final.
+            - `reward`: the reward after performing the action.
+        """
+        self.priorities.set(self.index, self.max_priority ** self.alpha)
+        super(PrioritizedExperienceReplay, self).push(
+            state, action, next_state, reward)
+
+    def recall(self, num_batches: int = 1) -> Batch:
+        """
+        Samples a batch of size `batch_size` with stratified proportional prioritization, i.e. one
+        transition from each of `batch_size` equal segments of the total priority.
+
+        Args:
+            - `num_batches`: number of batches sampled at once, which are concatenated. Their weights are
+            normalized together and beta is annealed once per batch.
+
+        Returns:
+            - the sampled batch, including the indices and the normalized importance-sampling weights.
+        """
+        size = num_batches * self.batch_size
+        segment = self.priorities.total() / size
+        values = (np.arange(size) + np.random.random(size)) * segment
+        # guard against rounding errors reaching leaves that are still empty
+        indices = np.minimum(self.priorities.find(values), self.size - 1)
+        probabilities = self.priorities.get(indices) / self.priorities.total()
+        weights = (self.size * probabilities) ** -self.beta
+        self.beta = min(self.beta + num_batches * self.beta_increment, 1.)
+        return self._get_batch(indices)._replace(
+            index=indices,
+            weight=(weights / weights.max()).astype(np.float32)
+        )
+
+    def update_priorities(self, indices: np.ndarray, td_errors: np.ndarray) -> None:
+        """
+        Sets the priorities of the transitions at `indices` from their absolute TD errors.
+
+        Args:
+            - `indices`: array with the indices of the transitions.
+            - `td_errors`: array with the TD errors of the transitions.
+        """
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.priorities.update(indices, priorities ** self.alpha)
+
+
+class BatchPrefetcher:
+    """
+    Samples batches of `num_batches` batches from `memory` in a background thread and keeps up to `depth`
+    of them ready as tensors, pinned if `device` is a CUDA device, in a bounded queue, so that sampling,
+    collating and encoding are off the critical path of the learner. Every access to `memory` from the
+    thread takes `lock`, which must also be taken by any other access to `memory` meanwhile.
+    """
+
+    def __init__(self, memory: ExperienceReplay, lock: threading.Lock, num_batches: int, depth: int,
+                 device: torch.device) -> None:
+        self.num_batches = num_batches
+        self._batches: queue.Queue[Batch] = queue.Queue(maxsize=depth)
+        self._stop_event = threading.Event()
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(
+            target=self._run,
+            kwargs={
+                'memory': memory,
+                'lock': lock,
+                'pin_memory': device.type == 'cuda'
+            },
+            daemon=True
+        )
+        self._thread.start()
+
+    def get(self) -> Batch:
+        """
+        Returns the next batch, waiting for it if none is ready.
+
+        Returns:
+            - the batch, with tensors instead of arrays, except for the indices.
+        """
+        while True:
+            try:
+                return self._batches.get(timeout=0.1)
+            except queue.Empty:
+                if not self._thread.is_alive():
+                    raise RuntimeError(
+                        "The batch prefetcher has stopped.") from self._error
+
+    def close(self) -> None:
+        """
+        Stops the background thread and discards the batches which are ready.
+        """
+        self._stop_event.set()
+        self._thread.join()
+        while not self._batches.empty():
+            self._batches.get_nowait()
+
+    def _run(self, memory: ExperienceReplay, lock: threading.Lock, pin_memory: bool) -> None:
+        """
+        Background thread: samples batches until it is stopped.
+        """
+        try:
+            while not self._stop_event.is_set():
+                with lock:
+                    batch = memory.recall(self.num_batches)
+                batch = to_tensors(batch, pin_memory)
+                while not self._stop_event.is_set():
+                    try:
+                        self._batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except BaseException as error:
+            self._error = error
+
+
+def to_tensors(batch: Batch, pin_memory: bool = False) -> Batch:
+    """
+    Turns the arrays of `batch` into tensors which share their memory, or into pinned copies if
+    `pin_memory` is True. The indices are left as an array.
+
+    Args:
+        - `batch`: the batch.
+        - `pin_memory`: whether to copy the arrays into page-locked memory, for faster and asynchronous
+        copies to a CUDA device.
+
+    Returns:
+        - the batch of tensors.
+    """
+    tensors = {
+        field: torch.from_numpy(value).pin_memory() if pin_memory else torch.from_numpy(value)
+        for field, value in batch._asdict().items() if value is not None and field != 'index'
+    }
+    return batch._replace(**tensors)
+
@@ -0,0 +1,341 @@
+import numpy as np
+from bitboard import from_observations, get_bitboard_height, is_win
+from functools import lru_cache
+
+# Positions are kept as in `bitboard.py`, with the counters of the player in turn `current` and those of
+# both players `mask`, so that `current + mask` is a unique key of the position. Scores follow the
+# usual convention: 0 for a draw, and for a win of the player in turn, the number of counters they
+# have left when the game ends plus one, i.e. the sooner the win the higher the score, negative for a loss.
+
+
+class Solver:
+    """
+    Connect Four solver: a negamax search with alpha-beta pruning of the bitboards of the position, which
+    tries the moves that create the most winning spots first, breaking ties from the center out, never
+    expands moves that let the opponent win in one move and stores the bounds of the scores of the
+    positions it searches in a transposition table of `table_size` entries. Exact scores are found by
+    iterative null window searches that narrow the range of possible scores.
+
+    Searches are slow in Python beyond the middle game, so `best_move` offers a search limited to a
+    number of plies, deepened iteratively.
+    """
+
+    def __init__(self, rows: int = 6, cols: int = 7, table_size: int = 1 << 20) -> None:
+        self.rows = rows
+        self.cols = cols
+        self.height = get_bitboard_height(rows, cols)
+        self.size = rows * cols
+        self.min_score = -(self.size // 2) + 3
+        self.max_score = (self.size + 1) // 2 - 3
+        self.bottom_mask = sum(1 << col * self.height for col in range(cols))
+        self.board_mask = self.bottom_mask * ((1 << rows) - 1)
+        self.column_masks = [((1 << rows) - 1) << col * self.height for col in range(cols)]
+        # columns from the center out
+        self.column_order = [cols // 2 + (1 - 2 * (i % 2)) * (i + 1) // 2 for i in range(cols)]
+        self._shifts = [(shift, 2 * shift, 3 * shift) for shift in (self.height, self.height - 1, self.height + 1)]
+        self.table_size = table_size
+        self.nodes = 0
+        self.reset()
+
+    def best_move(self, board: np.ndarray, depth: int) -> int:
+        """
+        Returns the best column for the player in turn found by a search `depth` plies deep, which is
+        deepened iteratively and tries first the best moves of the previous iteration. Positions whose
+        outcome is not decided within `depth` plies score 0, and ties are broken from the center out.
+
+        Args:
+            - `board`: observation of shape (rows, cols) with values 0, 1 or 2.
+            - `depth`: number of plies searched.
+
+        Returns:
+            - The index of the column.
+        """
+        current, mask, moves = self._from_board(board)
+        playable = [col for col in self.column_order if self._can_play(mask, col)]
+        if not playable:
+            raise ValueError("The board is full.")
+        for col in playable:
+            if self._is_winning_move(current, mask, col):
+                return col
+
+        scores = {col: 0 for col in playable}
+        for limit in range(1, depth + 1):
+            # the best moves of the previous iteration are searched first
+            order = sorted(playable, key=lambda col: -scores[col])
+            alpha = -self.size
+            for col in order:
+                move = (mask + (1 << col * self.height)) & self.column_masks[col]
+                # scores equal to the best so far are exact, so that ties are real
+                scores[col] = -self._search(current ^ mask, mask | move, moves + 1, -self.size, 1 - alpha,
+                                            limit - 1)
+                alpha = max(alpha, scores[col])
+        best_score = max(scores.values())
+        return next(col for col in playable if scores[col] == best_score)
+
+    def reset(self) -> None:
+        """
+        Empties the transposition table and resets the node counter.
+        """
+        # -1 marks an empty entry, since keys are never negative and 0 is the key of the empty board
+        self._keys = [-1] * self.table_size
+        self._values = [0] * self.table_size
+        self.nodes = 0
+
+    def score(self, board: np.ndarray) -> int:
+        """
+        Returns the exact score of the position for the player in turn.
+
+        Args:
+            - `board`: observation of shape (rows, cols) with values 0, 1 or 2.
+
+        Returns:
+            - The score.
+        """
+        return self._score(*self._from_board(board))
+
+    def solve(self, board: np.ndarray) -> tuple[int, list[int]]:
+        """
+        Returns the exact score of the position for the player in turn and all the columns which achieve it.
+
+        Args:
+            - `board`: observation of shape (rows, cols) with values 0, 1 or 2.
+
+        Returns:
+            - Tuple with the score and the list of the best columns.
+        """
+        scores = self.analyze(board)
+        if not scores:
+            return 0, []
+        best_score = max(scores.values())
+        return best_score, sorted(col for col, score in scores.items() if score == best_score)
+
+    def analyze(self, board: np.ndarray, depth: int | None = None) -> dict[int, int]:
+        """
+        Returns the score for the player in turn of every legal move, exact if `depth` is None, or found
+        by a search `depth` plies deep otherwise, in which outcomes not decided within them score 0.
+
+        Args:
+            - `board`: observation of shape (rows, cols) with values 0, 1 or 2.
+            - `depth`: number of plies searched, if None, the scores are exact.
+
+        Returns:
+            - Dictionary with the score of every legal column.
+        """
+        current, mask, moves = self._from_board(board)
+        scores = {}
+        for col in range(self.cols):
+            if not self._can_play(mask, col):
+                continue
+            if self._is_winning_move(current, mask, col):
+                scores[col] = (self.size + 1 - moves) // 2
+                continue
+            move = (mask + (1 << col * self.height)) & self.column_masks[col]
+            if moves + 1 == self.size:
+                scores[col] = 0
+            elif depth is None:
+                scores[col] = -self._score(current ^ mask, mask | move, moves + 1)
+            else:
+                scores[col] = -self._search(current ^ mask, mask | move, moves + 1, -self.size, self.size, depth - 1)
+        return scores
+
+    def _can_play(self, mask: int, col: int) -> bool:
+        """
+        Returns True if column `col` is not full.
+        """
+        return mask & (1 << (self.rows - 1 + col * self.height)) == 0
+
+    def _from_board(self, board: np.ndarray) -> tuple[int, int, int]:
+        """
+        Returns the counters of the player in turn, those of both players and the number of counters of
+        an observation in which player 1 moves first, and which is not won.
+        """
+        p1, p2 = (int(bitboard[0]) for bitboard in from_observations(board[None]))
+        if is_win(p1, self.rows) or is_win(p2, self.rows):
+            raise ValueError("The game is already won.")
+        moves = p1.bit_count() + p2.bit_count()
+        return p1 if moves % 2 == 0 else p2, p1 | p2, moves
+
+    def _is_winning_move(self, current: int, mask: int, col: int) -> bool:
+        """
+        Returns True if the player in turn wins by playing in column `col`.
+        """
+        return self._winning_positions(current, mask) & (mask + self.bottom_mask) & self.column_masks[col] != 0
+
+    def _negamax(self, current: int, mask: int, moves: int, alpha: int, beta: int) -> int:
+        """
+        Returns the score of a position in which the player in turn cannot win in one move if it lies
+        within (`alpha`, `beta`), a lower bound greater than or equal to `beta` if the score is, or an upper
+        bound lower than or equal to `alpha` if the score is.
+        """
+        self.nodes += 1
+        possible = self._non_losing_moves(current, mask)
+        if possible == 0:
+            return -((self.size - moves) // 2)
+        if moves >= self.size - 2:
+            return 0
+
+        # the opponent cannot win in their next move
+        low = -((self.size - 2 - moves) // 2)
+        if alpha < low:
+            alpha = low
+            if alpha >= beta:
+                return alpha
+        # nor can the player in turn
+        high = (self.size - 1 - moves) // 2
+        key = current + mask
+        index = key % self.table_size
+        if self._keys[index] == key:
+            value = self._values[index]
+            if value > self.max_score - self.min_score + 1:
+                low = value + 2 * self.min_score - self.max_score - 2
+                if alpha < low:
+                    alpha = low
+                    if alpha >= beta:
+                        return alpha
+            else:
+                high = value + self.min_score - 1
+        if beta > high:
+            beta = high
+            if alpha >= beta:
+                return beta
+
+        for move in self._sort_moves(current, mask, possible):
+            score = -self._negamax(current ^ mask, mask | move, moves + 1, -beta, -alpha)
+            if score >= beta:
+                # lower bound
+                self._keys[index] = key
+                self._values[index] = score + self.max_score - 2 * self.min_score + 2
+                return score
+            if score > alpha:
+                alpha = score
+        # upper bound
+        self._keys[index] = key
+        self._values[index] = alpha - self.min_score + 1
+        return alpha
+
+    def _non_losing_moves(self, current: int, mask: int) -> int:
+        """
+        Returns the bits of the moves of the player in turn after which the opponent cannot win in one move.
+        """
+        possible = (mask + self.bottom_mask) & self.board_mask
+        opponent_wins = self._winning_positions(current ^ mask, mask)
+        forced = possible & opponent_wins
+        if forced:
+            # the opponent wins anyway if they have two winning moves
+            if forced & (forced - 1):
+                return 0
+            possible = forced
+        # playing right below a winning spot of the opponent gives it away
+        return possible & ~(opponent_wins >> 1)
+
+    def _score(self, current: int, mask: int, moves: int) -> int:
+        """
+        Returns the exact score of a position by narrowing the range of possible scores with null window
+        searches, which are probed closer to 0 first since most scores are small.
+        """
+        if self._winning_positions(current, mask) & (mask + self.bottom_mask) & self.board_mask:
+            return (self.size + 1 - moves) // 2
+        low = -((self.size - moves) // 2)
+        high = (self.size + 1 - moves) // 2
+        while low < high:
+            mid = low + (high - low) // 2
+            # halves rounded towards 0
+            if mid <= 0 and -(-low // 2) < mid:
+                mid = -(-low // 2)
+            elif mid >= 0 and high // 2 > mid:
+                mid = high // 2
+            score = self._negamax(current, mask, moves, mid, mid + 1)
+            if score <= mid:
+                high = score
+            else:
+                low = score
+        return low
+
+    def _search(self, current: int, mask: int, moves: int, alpha: int, beta: int, depth: int) -> int:
+        """
+        Returns the score of a position searched `depth` plies deep, or 0 if the outcome is not decided
+        within them, with alpha-beta pruning in (`alpha`, `beta`).
+        """
+        self.nodes += 1
+        if self._winning_positions(current, mask) & (mask + self.bottom_mask) & self.board_mask:
+            return (self.size + 1 - moves) // 2
+        possible = self._non_losing_moves(current, mask)
+        if possible == 0:
+            return -((self.size - moves) // 2)
+        if moves >= self.size - 2 or depth == 0:
+            return 0
+        for move in self._sort_moves(current, mask, possible):
+            score = -self._search(current ^ mask, mask | move, moves + 1, -beta, -alpha, depth - 1)
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def _sort_moves(self, current: int, mask: int, possible: int) -> list[int]:
+        """
+        Returns the bits of the moves in `possible` sorted by the number of winning spots of the player in
+        turn after them, from the center out among equals.
+        """
+        moves = [move for move in (possible & self.column_masks[col] for col in self.column_order) if move]
+        if len(moves) == 1:
+            return moves
+        return sorted(moves, key=lambda move: -self._winning_positions(current | move, mask).bit_count())
+
+    def _winning_positions(self, position: int, mask: int) -> int:
+        """
+        Returns the bits of the empty cells which complete four aligned counters of `position`.
+        """
+        wins = (position << 1) & (position << 2) & (position << 3)
+        # horizontal, diagonal and anti-diagonal, the hottest path of the search
+        for shift, double_shift, triple_shift in self._shifts:
+            left = position << shift
+            right = position >> shift
+            pairs = left & (position << double_shift)
+            wins |= pairs & ((position << triple_shift) | right)
+            pairs = right & (position >> double_shift)
+            wins |= pairs & (left | (position >> triple_shift))
+        return wins & (self.board_mask ^ mask)
+
+
+@lru_cache(maxsize=None)
+def get_solver(rows: int = 6, cols: int = 7) -> Solver:
+    """
+    Returns the solver of `rows` x `cols` boards of this process, which is built only once, so that its
+    transposition table is shared by all the searches.
+
+    Args:
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+
+    Returns:
+        - The solver.
+    """
+    return Solver(rows, cols)
+
+
+def best_move(board: np.ndarray, depth: int) -> int:
+    """
+    Returns the best column for the player in turn found by a search `depth` plies deep.
+
+    Args:
+        - `board`: observation of shape (rows, cols) with values 0, 1 or 2, in which player 1 moved first.
+        - `depth`: number of plies searched.
+
+    Returns:
+        - The index of the column.
+    """
+    return get_solver(*board.shape).best_move(board, depth)
+
+
+def solve(board: np.ndarray) -> tuple[int, list[int]]:
+    """
+    Returns the exact score of the position for the player in turn and all the columns which achieve it.
+
+    Args:
+        - `board`: observation of shape (rows, cols) with values 0, 1 or 2, in which player 1 moved first.
+
+    Returns:
+        - Tuple with the score and the list of the best columns.
+    """
+    return get_solver(*board.shape).solve(board)
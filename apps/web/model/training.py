@@ -1,17 +1,20 @@
+import copy
 import datetime
 import numpy as np
+import queue
+import random
 import pandas as pd
 import matplotlib.pyplot as plt
 import time
 import torch
 import torch.nn as nn
-from constants import finishes_boards_solutions, blocks_boards_solutions
-from custom_types import ParamsTrain, ParamsEval
+from custom_types import ParamsAgent, ParamsDistributed, ParamsEnv, ParamsTrain, ParamsEval, Rewards
 from typing import List
 from agent import DQNAgent
-from env import ConnectFourEnv
-from replay import Transition
-from utils import moving_average, get_actions
+from evaluation import AsyncEvaluator, evaluate
+from env import BitboardConnectFourEnv, ConnectFourEnv, VectorConnectFourEnv
+from replay import PrioritizedExperienceReplay, SharedExperienceReplay, Transition
+from utils import moving_average
 from os.path import join
 from pathlib import Path
 
@@ -21,12 +24,20 @@ plt.rcParams.update({'axes.grid': True, 'axes.edgecolor': '#ffffff', 'axes.facec
                      'legend.fontsize': 13, 'xtick.color': '#3f3f3f', 'xtick.labelsize': 14,
                      'ytick.color': '#3f3f3f', 'ytick.labelsize': 14})
 
+EVAL_COLUMNS = [
+    'rewards_median', 'rewards_mean', 'rewards_std', 'steps_median', 'steps_mean', 'steps_std', 'win_rate',
+    'loss_rate', 'draw_rate', 'fnsh_perc', 'blck_perc'
+]
+MOVE_QUALITY_COLUMNS = ['optm_perc', 'scr_loss', 'blndr_opng_perc', 'blndr_mdgm_perc', 'blndr_endg_perc']
+
 
 def train(agent: DQNAgent, env: ConnectFourEnv,  params_train: ParamsTrain, params_eval: ParamsEval, checkpoints_dir_path: str,
           device: torch.device) -> tuple[pd.DataFrame, pd.DataFrame, list, str]:
     """
     Trains a policy on the Connect Four task. Loss is computed at every episode once 
-    the buffer has more transitions than the batch size value.
+    the buffer has more transitions than the batch size value, on `batches_per_update` batches, or
+    on `replay_ratio` batches per step of the episode if it is not None. If `parallel_games` is greater
+    than one, episodes are played in batches of self-play games in lockstep.
 
     Args:
         - `agent`: agent of type `DQNAgent`.
@@ -45,103 +56,131 @@ def train(agent: DQNAgent, env: ConnectFourEnv,  params_train: ParamsTrain, para
     train_history: dict[str, list] = {
         'steps': [],
         'time': [],
+        'play_time': [],
         'rewards': [],
-        'lr': []
+        'lr': [],
+        'updates': [],
+        'learn_time': []
     }
     evaluations: List[list] = []
     evaluations_idcs: List[int] = []
     running_loss: List[float] = []
-    eval_columns = [
-        'rewards_median', 'rewards_mean', 'rewards_std', 'steps_median', 'steps_mean', 'steps_std', 'win_rate',
-        'loss_rate', 'draw_rate', 'fnsh_perc', 'blck_perc'
-    ]
+    parallel_games = params_train.get('parallel_games', 1)
+    batches_per_update = params_train.get('batches_per_update', 1)
+    replay_ratio = params_train.get('replay_ratio')
     if params_train['scheduler'] is not None:
         scheduler = getattr(torch.optim.lr_scheduler, params_train["scheduler"]['name'])(
             optimizer=agent.optimizer, **params_train['scheduler']['config'])
 
+    vector_env = VectorConnectFourEnv(
+        params=env.params,
+        num_envs=parallel_games,
+        device=device
+    ) if parallel_games > 1 else None
+    # episodes already played but not processed yet, and the time and steps it took to play them
+    pending_episodes: List[List[Transition]] = []
+    play_time = 0.
+    play_steps = 0
+    # batches owed to the learner, whose fractional part is carried over to the next episode
+    update_credit = 0.
+    evaluator = AsyncEvaluator(
+        net=agent.net,
+        params_agent=agent.params,
+        params_env=env.params,
+        params_eval=params_eval
+    ) if params_eval.get('asynchronous', False) else None
+
     print(
         f"Training policy in {agent.net.__class__.__name__}.\n"
         f"{'Episode':^10}{'Step':^10}{'Train rewards (avg)':^20}{'steps (avg)':^14}{'running loss (avg)':^20}"
-        f"{'Eval reward (mean std)':^25}{'win rate(%)':^10}{'Eps':^10}{'LR':^6}{'Time':^11}"
+        f"{'Eval reward (mean std)':^25}{'win rate(%)':^10}{'Eps':^10}{'LR':^6}{'Steps/s':^10}{'Updates/s':^11}{'Time':^11}"
     )
 
     try:
         for episode in range(params_train['episodes']):
-            episode_s = time.time()
-            transitions = _play_episode(
-                agent, env, sum(train_history['steps']), params_train['enforce_valid_action'])
-            rewards = 0.
-            steps = len(transitions)
-
-            for i in range(len(transitions)):
-                if i == len(transitions) - 2:
-                    state, action, next_state, reward = transitions[i]
-                    if transitions[-1].reward == env.params['rewards']['win']:
-                        transition = Transition(
-                            state=state,
-                            action=action,
-                            next_state=next_state,
-                            reward=reward + env.params['rewards']['loss']
-                        )
-
-                    else:
-                        transition = Transition(
-                            state=state,
-                            action=action,
-                            next_state=next_state,
-                            reward=reward + env.params['rewards']['draw']
-                        )
-
+            if len(pending_episodes) == 0:
+                play_s = time.time()
+                if vector_env is None:
+                    pending_episodes = [_play_episode(
+                        agent, env, sum(train_history['steps']), params_train['enforce_valid_action'])]
                 else:
-                    transition = transitions[i]
+                    pending_episodes = _play_episodes(
+                        agent=agent,
+                        env=vector_env,
+                        total_steps=sum(train_history['steps']),
+                        enforce_valid_action=params_train['enforce_valid_action'],
+                        num_episodes=min(
+                            parallel_games, params_train['episodes'] - episode)
+                    )
+                play_time = time.time() - play_s
+                play_steps = sum(len(transitions)
+                                 for transitions in pending_episodes)
 
-                agent.cache(*transition)
-                rewards += transition.reward
+            episode_s = time.time()
+            transitions = pending_episodes.pop(0)
+            steps = len(transitions)
+            rewards = _cache_episode(
+                agent=agent,
+                transitions=transitions,
+                params_rewards=env.params['rewards']
+            )
 
+            learn_s = time.time()
+            num_batches = 0
             if len(agent.memory) >= params_train['batch_size']:
-                _optimize(
-                    agent=agent,
-                    running_loss=running_loss,
-                    episode=episode
-                )
-
-            train_history['steps'].append(steps)
-            train_history['rewards'].append(rewards)
-            train_history['time'].append(time.time() - episode_s)
-            train_history['lr'].append(agent.optimizer.param_groups[0]['lr'])
-
-            if (len(agent.memory) >= params_train['batch_size']) and ((episode+1) % params_eval['period'] == 0):
-                evaluation = _evaluate(
-                    agent=agent,
-                    env=env,
-                    params=params_eval,
-                    device=device
-                )
-
-                if ((episode+1) % params_train['display_period'] == 0):
-                    _print_metrics(
+                update_credit += batches_per_update if replay_ratio is None \
+                    else steps * replay_ratio
+                while update_credit >= batches_per_update:
+                    _optimize(
                         agent=agent,
-                        evaluation=evaluation,
-                        train_history=train_history,
-                        params_eval=params_eval,
                         running_loss=running_loss,
-                        episode=episode
+                        episode=episode,
+                        num_batches=batches_per_update
                     )
-                evaluations.append(evaluation)
-                evaluations_idcs.append(episode)
+                    update_credit -= batches_per_update
+                    num_batches += batches_per_update
+            learn_time = time.time() - learn_s
 
-            if episode != 0 and params_train['checkpoint']['save_every'] is not None and (episode + 1) % params_train['checkpoint']['save_every'] == 0 \
-                    and not (episode == params_train['episodes']-1 and params_train['checkpoint']['save_on_exit'] == True):
-                model_id = _get_model_id(agent)
-                agent.save(
-                    checkpoints_dir_path=checkpoints_dir_path,
-                    model_id=model_id,
-                    current_step=sum(train_history['steps'])
-                )
+            # share the time it took to play the batch of episodes proportionally to their steps
+            episode_play_time = play_time * steps / play_steps
+            train_history['steps'].append(steps)
+            train_history['rewards'].append(rewards)
+            train_history['time'].append(
+                time.time() - episode_s + episode_play_time)
+            train_history['play_time'].append(episode_play_time)
+            train_history['lr'].append(agent.optimizer.param_groups[0]['lr'])
+            train_history['updates'].append(num_batches)
+            train_history['learn_time'].append(learn_time)
+
+            _evaluate_and_checkpoint(
+                agent=agent,
+                env=env,
+                evaluator=evaluator,
+                params_train=params_train,
+                params_eval=params_eval,
+                train_history=train_history,
+                evaluations=evaluations,
+                evaluations_idcs=evaluations_idcs,
+                running_loss=running_loss,
+                episode=episode,
+                checkpoints_dir_path=checkpoints_dir_path,
+                device=device
+            )
 
             if params_train['scheduler'] is not None and len(agent.memory) >= params_train['batch_size']:
                 scheduler.step()
 
+        if evaluator is not None:
+            # wait for the evaluations still in progress
+            for evaluation_episode, evaluation, training_metrics in evaluator.close():
+                _record_evaluation(
+                    evaluation=evaluation,
+                    training_metrics=training_metrics,
+                    evaluations=evaluations,
+                    evaluations_idcs=evaluations_idcs,
+                    episode=evaluation_episode
+                )
+
         model_id = _get_model_id(agent)
         if params_train['checkpoint']['save_on_exit']:
             agent.save(
@@ -150,7 +189,7 @@ def train(agent: DQNAgent, env: ConnectFourEnv,  params_train: ParamsTrain, para
                 current_step=sum(train_history['steps'])
             )
 
-        return pd.DataFrame.from_dict(data=train_history), pd.DataFrame(evaluations, columns=eval_columns, index=evaluations_idcs), \
+        return pd.DataFrame.from_dict(data=train_history), pd.DataFrame(evaluations, columns=_get_eval_columns(params_eval), index=evaluations_idcs), \
             running_loss, model_id
 
     except KeyboardInterrupt:
@@ -162,35 +201,241 @@ def train(agent: DQNAgent, env: ConnectFourEnv,  params_train: ParamsTrain, para
                 current_step=sum(train_history['steps'])
             )
 
-        return pd.DataFrame.from_dict(data=train_history), pd.DataFrame(evaluations, columns=eval_columns, index=evaluations_idcs), \
+        return pd.DataFrame.from_dict(data=train_history), pd.DataFrame(evaluations, columns=_get_eval_columns(params_eval), index=evaluations_idcs), \
             running_loss, model_id
 
+    finally:
+        agent.close()
+        if evaluator is not None:
+            evaluator.close(wait=False)
+
 
-def export_onnx(policy: nn.Module, policies_dir_path: str, model_id: str, device: torch.device) -> None:
+def train_distributed(agent: DQNAgent, env: ConnectFourEnv, params_train: ParamsTrain, params_eval: ParamsEval,
+                      params_distributed: ParamsDistributed, checkpoints_dir_path: str,
+                      device: torch.device) -> tuple[pd.DataFrame, pd.DataFrame, list, str]:
     """
-    Exports a policy into ONNX format to `policies_dir_path`.
+    Trains a policy on the Connect Four task like `train`, but with `actors` processes that play self-play
+    episodes with their own copy of the policy and push the transitions into a replay memory in shared
+    memory. This process is the learner: it optimizes the policy as long as there are enough transitions,
+    publishes its weights every `sync_period` updates for the actors to refresh their copies, evaluates
+    the policy and saves checkpoints as episodes are reported, and logs the env steps/s of the actors and
+    the batches/s of the learner every `log_period` seconds. Every update optimizes on `batches_per_update`
+    batches and, if `replay_ratio` is not None, the learner waits for the actors whenever it is ahead of
+    `replay_ratio` batches per env step.
 
     Args:
-        - `policy`: model to be exported
-        - `policies_dir_path`: path to the policies directory
-        - `model_id`: id of the model
+        - `agent`: agent of type `DQNAgent`.
+        - `env`: environment of type `ConnectFourEnv`, used for evaluations.
+        - `params_train`: `ParamsTrain` object with the parameters of the training.
+        - `params_eval`: `ParamsEval` object with the parameters of the evaluations.
+        - `params_distributed`: `ParamsDistributed` object with the parameters of the actors and the learner.
+        - `checkpoints_dir_path`: path to the checkpoints directory.
+        - `device`: torch device of the learner.
+
+    Returns:
+        - Pandas dataframe with the history of the training.
+        - Pandas dataframe with the history of the evaluations.
+        - List with the values of the running loss at each step.
+        - The model id.
     """
-    policy.eval()
-    dummy_input = torch.zeros([1, 2, 6, 7], dtype=torch.float, device=device)
-    Path(policies_dir_path).mkdir(
-        parents=True,
-        exist_ok=True
+    if isinstance(agent.memory, PrioritizedExperienceReplay):
+        raise ValueError(
+            "Prioritized experience replay is not supported in distributed training.")
+    train_history: dict[str, list] = {
+        'steps': [],
+        'time': [],
+        'play_time': [],
+        'rewards': [],
+        'lr': [],
+        'updates': [],
+        'learn_time': []
+    }
+    evaluations: List[list] = []
+    evaluations_idcs: List[int] = []
+    running_loss: List[float] = []
+    batches_per_update = params_train.get('batches_per_update', 1)
+    replay_ratio = params_train.get('replay_ratio')
+    if params_train['scheduler'] is not None:
+        scheduler = getattr(torch.optim.lr_scheduler, params_train["scheduler"]['name'])(
+            optimizer=agent.optimizer, **params_train['scheduler']['config'])
+
+    evaluator = AsyncEvaluator(
+        net=agent.net,
+        params_agent=agent.params,
+        params_env=env.params,
+        params_eval=params_eval
+    ) if params_eval.get('asynchronous', False) else None
+
+    context = torch.multiprocessing.get_context('spawn')
+    local_memory = agent.memory
+    agent.memory = SharedExperienceReplay(
+        maxlen=local_memory.maxlen,
+        batch_size=local_memory.batch_size,
+        observation_shape=local_memory.observation_shape,
+        packed=local_memory.packed
     )
-    file_path = join(policies_dir_path, f'{model_id}.onnx')
-    torch.onnx.export(
-        model=policy,
-        args=dummy_input,
-        f=file_path,
-        export_params=True,
-        opset_version=10,
-        do_constant_folding=True
+    shared_policy = copy.deepcopy(agent.net.policy).cpu().share_memory()
+    policy_lock = context.Lock()
+    policy_version = context.Value('q', 0)
+    num_steps = context.Value('q', 0)
+    episodes_queue = context.Queue()
+    stop_event = context.Event()
+    actors = [context.Process(
+        target=_run_actor,
+        kwargs={
+            'net': copy.deepcopy(agent.net).cpu(),
+            'params_agent': agent.params,
+            'params_env': env.params,
+            'params_train': params_train,
+            'memory': agent.memory,
+            'shared_policy': shared_policy,
+            'policy_lock': policy_lock,
+            'policy_version': policy_version,
+            'num_steps': num_steps,
+            'episodes_queue': episodes_queue,
+            'stop_event': stop_event,
+            'seed': random.randrange(2 ** 32) + actor_id
+        },
+        daemon=True
+    ) for actor_id in range(params_distributed['actors'])]
+    for actor in actors:
+        actor.start()
+
+    print(
+        f"Training policy in {agent.net.__class__.__name__} with {len(actors)} actors.\n"
+        f"{'Episode':^10}{'Step':^10}{'Train rewards (avg)':^20}{'steps (avg)':^14}{'running loss (avg)':^20}"
+        f"{'Eval reward (mean std)':^25}{'win rate(%)':^10}{'Eps':^10}{'LR':^6}{'Steps/s':^10}{'Updates/s':^11}{'Time':^11}"
     )
-    print(f"Model in ONNX format saved to {file_path}")
+
+    episode = 0
+    num_updates = 0
+    num_batches = 0
+    # batches and time spent learning since the last episode was recorded
+    pending_batches = 0
+    pending_learn_time = 0.
+    log_s = time.time()
+    log_steps = 0
+    log_updates = 0
+    try:
+        while episode < params_train['episodes']:
+            # process the episodes reported by the actors so far
+            while episode < params_train['episodes']:
+                try:
+                    steps, rewards, play_time = episodes_queue.get_nowait()
+                except queue.Empty:
+                    break
+                train_history['steps'].append(steps)
+                train_history['rewards'].append(rewards)
+                train_history['time'].append(play_time)
+                train_history['play_time'].append(play_time)
+                train_history['lr'].append(
+                    agent.optimizer.param_groups[0]['lr'])
+                train_history['updates'].append(pending_batches)
+                train_history['learn_time'].append(pending_learn_time)
+                pending_batches = 0
+                pending_learn_time = 0.
+                log_steps += steps
+                # keep track of the exploration of the actors
+                agent.update_eps_threshold(num_steps.value)
+
+                _evaluate_and_checkpoint(
+                    agent=agent,
+                    env=env,
+                    evaluator=evaluator,
+                    params_train=params_train,
+                    params_eval=params_eval,
+                    train_history=train_history,
+                    evaluations=evaluations,
+                    evaluations_idcs=evaluations_idcs,
+                    running_loss=running_loss,
+                    episode=episode,
+                    checkpoints_dir_path=checkpoints_dir_path,
+                    device=device
+                )
+
+                if params_train['scheduler'] is not None and len(agent.memory) >= params_train['batch_size']:
+                    scheduler.step()
+                episode += 1
+
+            if len(agent.memory) >= params_train['batch_size'] and (replay_ratio is None or
+                                                                     num_batches < replay_ratio * num_steps.value):
+                learn_s = time.time()
+                _optimize(
+                    agent=agent,
+                    running_loss=running_loss,
+                    episode=episode,
+                    num_batches=batches_per_update
+                )
+                pending_learn_time += time.time() - learn_s
+                num_updates += 1
+                num_batches += batches_per_update
+                pending_batches += batches_per_update
+                log_updates += batches_per_update
+                if num_updates % params_distributed['sync_period'] == 0:
+                    _publish_policy(
+                        policy=agent.net.policy,
+                        shared_policy=shared_policy,
+                        policy_lock=policy_lock,
+                        policy_version=policy_version
+                    )
+            else:
+                time.sleep(0.01)
+
+            log_time = time.time() - log_s
+            if log_time >= params_distributed['log_period']:
+                print(f"Actors: {round(log_steps / log_time)} env steps/s, learner: {round(log_updates / log_time, 2)} "
+                      f"batches/s ({num_batches} batches)")
+                log_s = time.time()
+                log_steps = 0
+                log_updates = 0
+
+        if evaluator is not None:
+            # wait for the evaluations still in progress
+            for evaluation_episode, evaluation, training_metrics in evaluator.close():
+                _record_evaluation(
+                    evaluation=evaluation,
+                    training_metrics=training_metrics,
+                    evaluations=evaluations,
+                    evaluations_idcs=evaluations_idcs,
+                    episode=evaluation_episode
+                )
+
+        model_id = _get_model_id(agent)
+        if params_train['checkpoint']['save_on_exit']:
+            agent.save(
+                checkpoints_dir_path=checkpoints_dir_path,
+                model_id=model_id,
+                current_step=sum(train_history['steps'])
+            )
+
+        return pd.DataFrame.from_dict(data=train_history), pd.DataFrame(evaluations, columns=_get_eval_columns(params_eval), index=evaluations_idcs), \
+            running_loss, model_id
+
+    except KeyboardInterrupt:
+        model_id = _get_model_id(agent)
+        if params_train['checkpoint']['save_on_exit']:
+            agent.save(
+                checkpoints_dir_path=checkpoints_dir_path,
+                model_id=model_id,
+                current_step=sum(train_history['steps'])
+            )
+
+        return pd.DataFrame.from_dict(data=train_history), pd.DataFrame(evaluations, columns=_get_eval_columns(params_eval), index=evaluations_idcs), \
+            running_loss, model_id
+
+    finally:
+        agent.close()
+        if evaluator is not None:
+            evaluator.close(wait=False)
+        stop_event.set()
+        for actor in actors:
+            actor.join(timeout=10)
+            if actor.is_alive():
+                actor.terminate()
+        shared_memory = agent.memory
+        agent.memory = local_memory
+        if isinstance(shared_memory, SharedExperienceReplay):
+            shared_memory.close()
 
 
 def plot(train_history: pd.DataFrame, eval_history: pd.DataFrame, running_loss: list, model_id: str, figures_dir_path: str | None = None) -> None:
@@ -318,6 +563,135 @@ def plot(train_history: pd.DataFrame, eval_history: pd.DataFrame, running_loss:
     plt.show()
 
 
+def _cache_episode(agent: DQNAgent, transitions: List[Transition], params_rewards: Rewards) -> float:
+    """
+    Pushes all the transitions of an episode into the memory of `agent`. The reward of the second to
+    last transition, i.e. the last move of the player who did not finish the game, is rewritten adding
+    the `loss` reward if the game was won or the `draw` reward otherwise.
+
+    Args:
+        - `agent`: agent of type `DQNAgent`.
+        - `transitions`: list with all the transitions of the episode unaltered.
+        - `params_rewards`: `Rewards` object with the rewards of the environment.
+
+    Returns:
+        - The sum of the rewards of the cached transitions.
+    """
+    rewards = 0.
+    for i in range(len(transitions)):
+        if i == len(transitions) - 2:
+            state, action, next_state, reward = transitions[i]
+            if transitions[-1].reward == params_rewards['win']:
+                transition = Transition(
+                    state=state,
+                    action=action,
+                    next_state=next_state,
+                    reward=reward + params_rewards['loss']
+                )
+
+            else:
+                transition = Transition(
+                    state=state,
+                    action=action,
+                    next_state=next_state,
+                    reward=reward + params_rewards['draw']
+                )
+
+        else:
+            transition = transitions[i]
+
+        agent.cache(*transition)
+        rewards += transition.reward
+    return rewards
+
+
+def _evaluate_and_checkpoint(agent: DQNAgent, env: ConnectFourEnv, evaluator: AsyncEvaluator | None, params_train: ParamsTrain,
+                             params_eval: ParamsEval, train_history: dict[str, list], evaluations: List[list],
+                             evaluations_idcs: List[int], running_loss: list, episode: int, checkpoints_dir_path: str,
+                             device: torch.device) -> None:
+    """
+    Evaluates the policy in `agent` every `period` episodes, either right away or by submitting a snapshot
+    to `evaluator`, in which case the evaluations it has finished so far are recorded, and saves a
+    checkpoint every `save_every` episodes.
+
+    Args:
+        - `agent`: agent of type `DQNAgent`.
+        - `env`: environment of type `ConnectFourEnv`.
+        - `evaluator`: `AsyncEvaluator` or None to evaluate synchronously.
+        - `params_train`: `ParamsTrain` object with the parameters of the training.
+        - `params_eval`: `ParamsEval` object with the parameters of the evaluations.
+        - `train_history`: dictionary with the training metrics.
+        - `evaluations`: list with the evaluation metrics, where new evaluations are appended.
+        - `evaluations_idcs`: list with the episodes of the evaluations.
+        - `running_loss`: list with the running losses.
+        - `episode`: current episode of the training.
+        - `checkpoints_dir_path`: path to the checkpoints directory.
+        - `device`: torch device.
+    """
+    if (len(agent.memory) >= params_train['batch_size']) and ((episode+1) % params_eval['period'] == 0):
+        training_metrics = _get_training_metrics(
+            agent=agent,
+            train_history=train_history,
+            params_train=params_train,
+            params_eval=params_eval,
+            running_loss=running_loss,
+            episode=episode
+        )
+        if evaluator is None:
+            evaluation = evaluate(
+                agent=agent,
+                env=env,
+                params=params_eval,
+                device=device
+            )
+            _record_evaluation(
+                evaluation=evaluation,
+                training_metrics=training_metrics,
+                evaluations=evaluations,
+                evaluations_idcs=evaluations_idcs,
+                episode=episode
+            )
+
+        else:
+            evaluator.submit(
+                episode=episode,
+                policy=agent.net.policy,
+                metrics=training_metrics
+            )
+
+    if evaluator is not None:
+        for evaluation_episode, evaluation, training_metrics in evaluator.collect():
+            _record_evaluation(
+                evaluation=evaluation,
+                training_metrics=training_metrics,
+                evaluations=evaluations,
+                evaluations_idcs=evaluations_idcs,
+                episode=evaluation_episode
+            )
+
+    if episode != 0 and params_train['checkpoint']['save_every'] is not None and (episode + 1) % params_train['checkpoint']['save_every'] == 0 \
+            and not (episode == params_train['episodes']-1 and params_train['checkpoint']['save_on_exit'] == True):
+        model_id = _get_model_id(agent)
+        agent.save(
+            checkpoints_dir_path=checkpoints_dir_path,
+            model_id=model_id,
+            current_step=sum(train_history['steps'])
+        )
+
+
+def _get_eval_columns(params_eval: ParamsEval) -> list[str]:
+    """
+    Get the names of the evaluation metrics, which include those of the move quality if it is scored.
+
+    Args:
+        - `params_eval`: `ParamsEval` object with the parameters of the evaluations.
+
+    Returns:
+        - List with the names of the columns of the evaluation history.
+    """
+    return EVAL_COLUMNS + MOVE_QUALITY_COLUMNS if params_eval.get('move_quality_path') is not None else EVAL_COLUMNS
+
+
 def _get_model_id(agent: DQNAgent) -> str:
     """
     Get the id of the model.
@@ -331,6 +705,103 @@ def _get_model_id(agent: DQNAgent) -> str:
     return f"{agent.net.__class__.__name__}_{datetime.datetime.now().strftime('%Y_%m_%d_T_%H_%M_%S')}"
 
 
+def _publish_policy(policy: nn.Module, shared_policy: nn.Module, policy_lock, policy_version) -> None:
+    """
+    Copies the weights of `policy` into `shared_policy` and increases `policy_version`.
+
+    Args:
+        - `policy`: the policy being optimized.
+        - `shared_policy`: copy of the policy in shared memory which the actors read.
+        - `policy_lock`: lock held while the shared policy is written or read.
+        - `policy_version`: shared counter of the published weights.
+    """
+    with policy_lock, torch.no_grad():
+        for shared_tensor, tensor in zip(shared_policy.state_dict().values(), policy.state_dict().values()):
+            shared_tensor.copy_(tensor)
+        policy_version.value += 1
+
+
+def _run_actor(net: nn.Module, params_agent: ParamsAgent, params_env: ParamsEnv, params_train: ParamsTrain,
+               memory: SharedExperienceReplay, shared_policy: nn.Module, policy_lock, policy_version, num_steps,
+               episodes_queue, stop_event, seed: int) -> None:
+    """
+    Actor process of `train_distributed`: plays self-play episodes until `stop_event` is set, pushes
+    their transitions into `memory` and reports their steps, rewards and play time in `episodes_queue`.
+    It refreshes its copy of the policy whenever `policy_version` changes.
+
+    Args:
+        - `net`: CPU copy of the network of the learner.
+        - `params_agent`: `ParamsAgent` object with the parameters of the agent.
+        - `params_env`: `ParamsEnv` object with the parameters of the environment.
+        - `params_train`: `ParamsTrain` object with the parameters of the training.
+        - `memory`: replay memory shared with the learner.
+        - `shared_policy`: copy of the policy in shared memory with the weights published by the learner.
+        - `policy_lock`: lock held while the shared policy is written or read.
+        - `policy_version`: shared counter of the published weights.
+        - `num_steps`: shared counter of the steps taken by all the actors.
+        - `episodes_queue`: queue where the episodes are reported.
+        - `stop_event`: event set by the learner when the actors have to stop.
+        - `seed`: seed of the random number generators of the actor.
+    """
+    # the learner and every other actor need their own cores
+    torch.set_num_threads(1)
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    torch.manual_seed(seed)
+    # do not wait for the learner to read the queue when exiting
+    episodes_queue.cancel_join_thread()
+    parallel_games = params_train.get('parallel_games', 1)
+    device = torch.device('cpu')
+    agent = DQNAgent(
+        net=net,
+        params=params_agent,
+        device=device,
+        memory=memory
+    )
+    env = BitboardConnectFourEnv(
+        params=params_env,
+        device=device
+    )
+    vector_env = VectorConnectFourEnv(
+        params=params_env,
+        num_envs=parallel_games,
+        device=device
+    ) if parallel_games > 1 else None
+    version = -1
+    while not stop_event.is_set():
+        if policy_version.value != version:
+            with policy_lock:
+                version = policy_version.value
+                agent.net.policy.load_state_dict(shared_policy.state_dict())
+            agent.inference.refresh()
+
+        play_s = time.time()
+        if vector_env is None:
+            episodes = [_play_episode(
+                agent, env, num_steps.value, params_train['enforce_valid_action'])]
+        else:
+            episodes = _play_episodes(
+                agent=agent,
+                env=vector_env,
+                total_steps=num_steps.value,
+                enforce_valid_action=params_train['enforce_valid_action'],
+                num_episodes=parallel_games
+            )
+        play_time = time.time() - play_s
+        play_steps = sum(len(transitions) for transitions in episodes)
+
+        for transitions in episodes:
+            rewards = _cache_episode(
+                agent=agent,
+                transitions=transitions,
+                params_rewards=params_env['rewards']
+            )
+            with num_steps.get_lock():
+                num_steps.value += len(transitions)
+            episodes_queue.put(
+                (len(transitions), rewards, play_time * len(transitions) / play_steps))
+
+
 def _play_episode(agent: DQNAgent, env: ConnectFourEnv, total_steps: int, enforce_valid_action: bool) -> List[Transition]:
     """
     Plays an entire episode and return a list with all the transitions unaltered.
@@ -389,138 +860,161 @@ def _play_episode(agent: DQNAgent, env: ConnectFourEnv, total_steps: int, enforc
     return transitions
 
 
-def _evaluate(agent: DQNAgent, env: ConnectFourEnv, params: ParamsEval, device: torch.device) -> list:
+def _play_episodes(agent: DQNAgent, env: VectorConnectFourEnv, total_steps: int, enforce_valid_action: bool,
+                   num_episodes: int) -> List[List[Transition]]:
     """
-    Evaluates policy in `agent` agains a random agent in both turns, i.e. both strategies.
+    Plays `num_episodes` entire episodes in the games of `env` in lockstep, choosing the actions of all
+    the games with a single call to `agent.act_batch`, and returns the transitions of every episode unaltered.
 
     Args:
         - `agent`: agent of type `DQNAgent`.
-        - `env`: environment of type `ConnectFourEnv`.
-        - `params`: object of type `ParamsEval` with the evaluation parameters.
-        - `device`: torch device.
+        - `env`: environment of type `VectorConnectFourEnv`.
+        - `total_steps`: total number of steps taken during the training so far.
+        - `enforce_valid_action`: whether to enforce that the action is valid or not.
+        - `num_episodes`: number of episodes to play.
 
     Returns:
-        - A list with the evaluation metrics.
+        - A list with the lists of transitions of every episode in the order they finished.
     """
-    agent.net.policy.eval()
-    episodes_rewards = []
-    episodes_steps = []
-    rates = np.zeros([params['episodes']], dtype=np.int8)
-    for episode in range(0, params['episodes']):
-        player = np.random.choice([1, 2])
-        state = env.reset()
-        episode_rewards = 0.
-        episode_steps = 0
-        while True:
-            valid_actions = env.get_valid_actions()
-            if player == env.turn:
-                action = agent.exploit(
-                    state, valid_actions, params['enforce_valid_action'])
-                if not params['enforce_valid_action'] and action not in valid_actions:
-                    episode_rewards += env.params['rewards']['loss']
-                    episodes_rewards.append(episode_rewards)
-                    episodes_steps.append(episode_steps)
-                    rates[episode] = -1
-                    break
-
+    agent.net.policy.train()
+    episodes: List[List[Transition]] = []
+    # transitions of the episode in progress in every game
+    transitions: List[List[Transition]] = [[] for _ in range(env.num_envs)]
+    # games whose episode is still to be returned, they stop once enough episodes have started
+    active = np.arange(env.num_envs) < num_episodes
+    num_started = int(active.sum())
+    num_steps = total_steps
+    states = env.reset()
+    valid_actions = env.get_valid_actions()
+    while len(episodes) < num_episodes:
+        actions = agent.act_batch(
+            states=states,
+            valid_actions=valid_actions,
+            num_steps=num_steps,
+            enforce_valid_action=enforce_valid_action
+        )
+        next_states, rewards, dones, valid_actions, info = env.step(actions)
+        for i in np.flatnonzero(active):
+            if info['invalid'][i]:
+                next_state = None
+            elif dones[i]:
+                next_state = info['final_observations'][i]
             else:
-                action = np.random.choice(valid_actions)
-
-            next_state, reward, is_done = env.step(action)
-            episode_steps += 1
-            if is_done:
-                if env.winner == player:
-                    episode_rewards += reward
-
-                episodes_rewards.append(episode_rewards)
-                episodes_steps.append(episode_steps)
-                rates[episode] = 0 if env.winner is None else 1 if env.winner == player else -1
-                break
-
-            if env.turn == player:
-                episode_rewards += reward
-
-            state = next_state
-            env.switch_turn()
-
-    values, counts = np.unique(rates, return_counts=True)
-    value_counts = dict(zip(values, counts))
-    win_rate = value_counts[1] / \
-        len(rates) if 1 in value_counts else 0
-    draw_rate = value_counts[0] / len(rates) if 0 in value_counts else 0
-    loss_rate = 1 - win_rate - draw_rate
-
-    finish_boards, finish_solutions, block_boards,  block_solutions = [], [], [], []
-    for finish_board_solution, block_board_solution in zip(finishes_boards_solutions, blocks_boards_solutions):
-        finish_boards.append(finish_board_solution[0])
-        finish_solutions.append(finish_board_solution[1])
-        block_boards.append(block_board_solution[0])
-        block_solutions.append(block_board_solution[1])
-
-    finish_actions = get_actions(
-        policy=agent.net.policy,
-        observations=finish_boards,
-        device=device
-    )
-    block_actions = get_actions(
-        policy=agent.net.policy,
-        observations=block_boards,
-        device=device
-    )
+                next_state = next_states[i].copy()
+            transitions[i].append(Transition(
+                state=states[i].copy() if len(transitions[i]) == 0 else transitions[i][-1].next_state,
+                action=int(actions[i]),
+                next_state=next_state,
+                reward=float(rewards[i])
+            ))
+            num_steps += 1
+            if dones[i]:
+                episodes.append(transitions[i])
+                transitions[i] = []
+                if num_started < num_episodes:
+                    num_started += 1
+                else:
+                    active[i] = False
 
-    finish_perc = sum([finish_solutions[i] == action for i,
-                       action in enumerate(finish_actions)])/len(finish_boards) * 100
-    block_perc = sum([block_solutions[i] == action for i,
-                     action in enumerate(block_actions)])/len(block_boards) * 100
+        states = next_states
 
-    evaluation = [np.median(episodes_rewards), np.mean(episodes_rewards), np.std(episodes_rewards), np.median(
-        episodes_steps),  np.mean(episodes_steps), np.std(episodes_steps),
-        win_rate, loss_rate, draw_rate, finish_perc, block_perc]
-    agent.net.policy.train()
-    return evaluation
+    return episodes
 
 
-def _optimize(agent: DQNAgent, running_loss: list, episode: int) -> None:
+def _optimize(agent: DQNAgent, running_loss: list, episode: int, num_batches: int = 1) -> None:
     """
-    Optimizes the policy in `agent`, updates the target in `agent` and appends the loss 
-    to `running_loss`.
+    Optimizes the policy in `agent` on `num_batches` batches, updates the target in `agent` and
+    appends the mean loss to `running_loss`.
 
     Args:
         - `agent`: agent of type `DQNAgent`.
         - `running_loss`: list with the running losses.
         - `episode`: current episode of the training.
+        - `num_batches`: number of batches sampled at once.
     """
-    loss = agent.optimize()
+    loss = agent.optimize(num_batches)
     running_loss.append(loss)
 
     agent.update_target(episode)
 
 
-def _print_metrics(agent: DQNAgent, evaluation: list, train_history: dict[str, list], params_eval: ParamsEval, running_loss: list, episode: int) -> None:
+def _record_evaluation(evaluation: list, training_metrics: dict | None, evaluations: List[list],
+                       evaluations_idcs: List[int], episode: int) -> None:
     """
-    Prints evaluation and training metrics.
+    Appends an evaluation and its episode to the evaluations history and prints the metrics if the
+    training metrics of the episode were recorded, i.e. every `display_period` episodes.
 
     Args:
-        - `agent`: agent of type `DQNAgent`.
         - `evaluation`: list with the evaluation metrics.
+        - `training_metrics`: training metrics at the episode, as returned by `_get_training_metrics`, or None.
+        - `evaluations`: list with the evaluation metrics.
+        - `evaluations_idcs`: list with the episodes of the evaluations.
+        - `episode`: episode at which the evaluated policy was taken.
+    """
+    if training_metrics is not None:
+        _print_metrics(
+            evaluation=evaluation,
+            training_metrics=training_metrics,
+            episode=episode
+        )
+    evaluations.append(evaluation)
+    evaluations_idcs.append(episode)
+
+
+def _get_training_metrics(agent: DQNAgent, train_history: dict[str, list], params_train: ParamsTrain,
+                          params_eval: ParamsEval, running_loss: list, episode: int) -> dict | None:
+    """
+    Get the training metrics printed along with the evaluation of the policy at `episode`, which are taken
+    when the policy is evaluated, so that they match it even if its evaluation finishes later.
+
+    Args:
+        - `agent`: agent of type `DQNAgent`.
         - `train_history`: dictionary with the training metrics.
+        - `params_train`: `ParamsTrain` object with the parameters of the training.
         - `params_eval`: `ParamsEval` object with the parameters of the evaluations.
         - `running_loss`: list with the running losses.
         - `episode`: current episode of the training.
+
+    Returns:
+        - Dictionary with the formatted training metrics, or None if they are not displayed at `episode`.
     """
+    if (episode+1) % params_train['display_period'] != 0:
+        return None
+
     minutes, seconds = divmod(
         train_history['time'][episode-1], 60)
-    duration = f'{int(minutes)}m {round(seconds, 2)}s' if minutes > 0 else f'{round(seconds, 2)}s'
     running_loss_window = len(running_loss) if len(
         running_loss) < params_eval['period'] else params_eval['period']
     train_history_window = len(train_history['rewards']) if len(
         train_history['rewards']) < params_eval['period'] else params_eval['period']
-    train_rewards_str = f"{round(train_history['rewards'][-1], 4)} ({round(moving_average(train_history['rewards'], train_history_window)[-1], 4)})"
-    train_steps_str = f"{round(train_history['steps'][-1], 4)} ({round(moving_average(train_history['steps'], train_history_window)[-1], 4)})"
-    running_loss_str = f"{round(running_loss[-1], 4)} ({round(moving_average(running_loss, running_loss_window)[-1], 4)})"
-    eval_reward = f"{np.round(evaluation[1], 4)}  {np.round(evaluation[2], 4)}"
+    return {
+        'steps': sum(train_history['steps']),
+        'train_rewards': f"{round(train_history['rewards'][-1], 4)} ({round(moving_average(train_history['rewards'], train_history_window)[-1], 4)})",
+        'train_steps': f"{round(train_history['steps'][-1], 4)} ({round(moving_average(train_history['steps'], train_history_window)[-1], 4)})",
+        'running_loss': f"{round(running_loss[-1], 4)} ({round(moving_average(running_loss, running_loss_window)[-1], 4)})",
+        'eps_threshold': str(round(agent.eps_threshold, 4)),
+        'lr': str(round(agent.optimizer.param_groups[0]['lr'], 8)),
+        'steps_per_second': sum(train_history['steps'][-train_history_window:]) /
+        max(sum(train_history['play_time'][-train_history_window:]), 1e-9),
+        'batches_per_second': sum(train_history['updates'][-train_history_window:]) /
+        max(sum(train_history['learn_time'][-train_history_window:]), 1e-9),
+        'duration': f'{int(minutes)}m {round(seconds, 2)}s' if minutes > 0 else f'{round(seconds, 2)}s'
+    }
+
 
+def _print_metrics(evaluation: list, training_metrics: dict, episode: int) -> None:
+    """
+    Prints evaluation and training metrics.
+
+    Args:
+        - `evaluation`: list with the evaluation metrics.
+        - `training_metrics`: training metrics at the episode, as returned by `_get_training_metrics`.
+        - `episode`: episode at which the evaluated policy was taken.
+    """
+    eval_reward = f"{np.round(evaluation[1], 4)}  {np.round(evaluation[2], 4)}"
     print(
-        f"{episode:^10}{sum(train_history['steps']):^10}{train_rewards_str:^20}{train_steps_str:^14}{running_loss_str:^20}{eval_reward:^25}"
-        f"{round(evaluation[6]*100, 2):^10}{str(round(agent.eps_threshold, 4)):^10}{str(round(agent.optimizer.param_groups[0]['lr'], 8)):^6}{duration:^11}"
+        f"{episode:^10}{training_metrics['steps']:^10}{training_metrics['train_rewards']:^20}{training_metrics['train_steps']:^14}"
+        f"{training_metrics['running_loss']:^20}{eval_reward:^25}{round(evaluation[6]*100, 2):^10}{training_metrics['eps_threshold']:^10}"
+        f"{training_metrics['lr']:^6}{round(training_metrics['steps_per_second']):^10}"
+        f"{round(training_metrics['batches_per_second'], 1):^11}{training_metrics['duration']:^11}"
     )
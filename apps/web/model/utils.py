@@ -2,39 +2,132 @@ import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
-from typing import List
+from bitboard import get_cell_shifts
+from functools import lru_cache
+from typing import Callable, List
 
 
-def get_actions(policy: nn.Module, observations: list, device: torch.device) -> List:
+class StateEncoder:
     """
-    Gets the policy `policy` to predict actions on `boards`.
+    Encodes states into a preallocated float32 buffer of shape (`capacity`, 2, rows, cols) on `device`,
+    which is reused by every call, so only the temporaries of the encoding itself are allocated. The
+    returned tensor is a view on the buffer and is overwritten by the next call, so every forward pass
+    whose inputs must outlive it, e.g. those kept for a backward pass, needs its own encoder.
+    """
+
+    def __init__(self, capacity: int, device: torch.device, observation_shape: tuple[int, int] = (6, 7)) -> None:
+        self.device = device
+        self.observation_shape = observation_shape
+        self.buffer = torch.empty(
+            size=[capacity, 2, *observation_shape],
+            dtype=torch.float,
+            device=device
+        )
+
+    def encode(self, observations: np.ndarray) -> torch.Tensor:
+        """
+        Encodes boards with values 0, 1 or 2 with `encode_boards`.
+
+        Args:
+            - `observations`: array of shape (N, rows, cols).
+
+        Returns:
+            - View of shape (N, 2, rows, cols) on the buffer.
+        """
+        return encode_boards(observations, out=self._get_out(len(observations)))
+
+    def encode_bitboards(self, bitboards: np.ndarray) -> torch.Tensor:
+        """
+        Encodes bitboards with `encode_bitboards`.
+
+        Args:
+            - `bitboards`: uint64 array of shape (N, 2) with the counters of player 1 and player 2.
+
+        Returns:
+            - View of shape (N, 2, rows, cols) on the buffer.
+        """
+        return encode_bitboards(bitboards, *self.observation_shape, out=self._get_out(len(bitboards)))
+
+    def _get_out(self, size: int) -> torch.Tensor:
+        """
+        Returns the first `size` states of the buffer, which is grown if it is too small.
+        """
+        if size > len(self.buffer):
+            self.buffer = torch.empty(
+                size=[size, *self.buffer.shape[1:]],
+                dtype=self.buffer.dtype,
+                device=self.device
+            )
+        return self.buffer[:size]
+
+
+def encode_bitboards(bitboards: np.ndarray, rows: int, cols: int, out: torch.Tensor | None = None) -> torch.Tensor:
+    """
+    Encodes bitboards into a float32 tensor with a binary channel per player, i.e. the same layout as
+    `get_two_channels`, written straight into `out`.
 
     Args:
-        - `policy`: the policy used to predict actions.
+        - `bitboards`: uint64 array of shape (N, 2) with the counters of player 1 and player 2.
+        - `rows`: number of rows of the board.
+        - `cols`: number of columns of the board.
+        - `out`: float32 tensor of shape (N, 2, rows, cols) to write into, or None to allocate it on the CPU.
+
+    Returns:
+        - Tensor of shape (N, 2, rows, cols).
+    """
+    if out is None:
+        out = torch.empty(size=[len(bitboards), 2, rows, cols])
+    # bitboards never use the sign bit, so they can be shifted as int64, which torch supports
+    counters = torch.from_numpy(np.ascontiguousarray(bitboards).view(np.int64)).to(
+        out.device, non_blocking=True)
+    bits = torch.bitwise_right_shift(
+        counters[:, :, None, None], _get_shifts(rows, cols, out.device))
+    out.copy_(bits.bitwise_and_(1))
+    return out
+
+
+def encode_boards(observations: np.ndarray, out: torch.Tensor | None = None) -> torch.Tensor:
+    """
+    Encodes boards with values 0, 1 or 2 into a float32 tensor with a binary channel per player, i.e.
+    the same layout as `get_two_channels`, with a single comparison written straight into `out`.
+
+    Args:
+        - `observations`: array of shape (N, rows, cols).
+        - `out`: float32 tensor of shape (N, 2, rows, cols) to write into, or None to allocate it on the CPU.
+
+    Returns:
+        - Tensor of shape (N, 2, rows, cols).
+    """
+    # no copy unless the boards are not contiguous
+    boards = torch.from_numpy(np.ascontiguousarray(observations))
+    if out is None:
+        out = torch.empty(size=[len(boards), 2, *boards.shape[1:]])
+    boards = boards.to(out.device, non_blocking=True)
+    torch.eq(boards.unsqueeze(1), _get_players(boards.dtype, out.device), out=out)
+    return out
+
+
+def get_actions(policy: Callable[[torch.Tensor], torch.Tensor], observations: list, device: torch.device) -> List:
+    """
+    Gets the policy `policy` to predict actions on `boards` with a single forward pass.
+
+    Args:
+        - `policy`: the policy used to predict actions, or any other forward pass of it, e.g. an
+        inference backend.
         - `observations`: list of board observations.
         - `device`: torch device.
 
     Returns:
         - List with all the predicted actions.
     """
-    actions = []
-    for observation in observations:
-        valid_actions = []
-        for col in np.arange(len(observation[0]), dtype=np.int8):
-            for row in range(0, len(observation)):
-                if observation[row][col] == 0:
-                    valid_actions.append(col)
-                    break
-
-        action_pred = _get_action(
-            policy=policy,
-            observation=observation,
-            valid_actions=valid_actions,
-            device=device
-        )
-        actions.append(action_pred)
-
-    return actions
+    boards = np.stack(observations)
+    with torch.no_grad():
+        outputs = policy(encode_boards(
+            boards, out=torch.empty(size=[len(boards), 2, *boards.shape[1:]], device=device)))
+        # a column is valid while its top cell is empty
+        valid_actions = torch.tensor(boards[:, 0] == 0, device=device)
+        actions = outputs.masked_fill(~valid_actions, -torch.inf).argmax(dim=1)
+    return list(actions.cpu().numpy())
 
 
 def get_html(policy: nn.Module, observations: np.ndarray, titles: list, device: torch.device) -> str:
@@ -149,12 +242,8 @@ def _get_action(policy: nn.Module, observation: np.ndarray, valid_actions: list,
         - Predicted action.
     """
     with torch.no_grad():
-        two_channel_tensor = torch.tensor(
-            data=get_two_channels(observation=np.expand_dims(observation, 0)),
-            dtype=torch.float,
-            device=device
-        )
-        output = policy(two_channel_tensor).squeeze().cpu().numpy()
+        output = policy(encode_boards(
+            observation[None], out=torch.empty(size=[1, 2, *observation.shape], device=device))).squeeze().cpu().numpy()
         # only outputs in valid actions can be considered
         all_actions = np.arange(len(observation[0]))
         valid_action_mask = [
@@ -187,6 +276,22 @@ def _get_frames_html(dfs: List[pd.DataFrame], title: str, df_titles: list) -> st
     return html
 
 
+@lru_cache(maxsize=None)
+def _get_players(dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+    """
+    Returns the values of player 1 and player 2 with shape (1, 2, 1, 1) to compare boards with.
+    """
+    return torch.tensor([1, 2], dtype=dtype, device=device).view(1, 2, 1, 1)
+
+
+@lru_cache(maxsize=None)
+def _get_shifts(rows: int, cols: int, device: torch.device) -> torch.Tensor:
+    """
+    Returns `bitboard.get_cell_shifts` as an int64 tensor on `device`.
+    """
+    return torch.from_numpy(get_cell_shifts(rows, cols).astype(np.int64)).to(device)
+
+
 def _update_board(observation: np.ndarray, col_index: int) -> pd.DataFrame:
     """
     Updates the board with the new counter in `col_index` and enerates a Connect 